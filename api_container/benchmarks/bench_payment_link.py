@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+# Benchmarks concurrent payment link creation against a local Stripe stub server.
+# Run with the following command:
+# python PaymentsService/api_container/benchmarks/bench_payment_link.py --requests 500 --concurrency 100 --latency 0.2
+
+os.environ.setdefault('TESTING', '1')
+os.environ.setdefault('MONGOMOCK', '1')
+os.environ.setdefault('MONGO_TEST_DB', 'bench_db')
+os.environ.setdefault('DEBUG_MODE', 'False')
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tests')))
+import httpx
+from stripe_stub import StripeStubServer
+from stripe_gateway import StripeGateway
+import payments_api
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def run(requests: int, concurrency: int) -> dict:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=payments_api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def create_link(i):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(f"/pay/service{i % 10}/paymentlink",
+                                            params={'amount': 1000, 'currency': 'usd', 'description': 'Bench'})
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*[create_link(i) for i in range(requests)])
+        elapsed = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'rps': requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2, help="Stripe stub latency (seconds)")
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    stub = StripeStubServer(latency=args.latency).start()
+    try:
+        payments_api.stripe_gateway = StripeGateway(api_key='sk_test', api_base=stub.url)
+        results = asyncio.run(run(args.requests, args.concurrency))
+    finally:
+        stub.stop()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
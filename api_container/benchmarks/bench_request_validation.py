@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+# Compares the CPU time of validating the request bodies and query locations, per request:
+# - dict: the previous handlers (validate_fields + validate_location on the raw body)
+# - request_model: the route request model, as FastAPI does with one (parsed once by pydantic-core)
+# Run with the following command:
+# python PaymentsService/api_container/benchmarks/bench_request_validation.py --rounds 100000
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from lib.utils import REQUIRED_LOCATION_FIELDS, validate_fields, validate_location
+from request_models import (CreateCouponRequest, RefundCouponRequest, TransactionRequest, ActivateCouponRequest,
+                            AvailableCouponsQuery)
+
+COUPON_CREATE_FIELDS = set(CreateCouponRequest.valid_fields)
+COUPON_CREATE_REQUIRED = set(CreateCouponRequest.required_fields)
+
+
+def create_coupon_dict(body: dict):
+    validate_fields(body, COUPON_CREATE_REQUIRED, COUPON_CREATE_FIELDS)
+    if 'location_rule' in body:
+        validate_location(body['location_rule'], REQUIRED_LOCATION_FIELDS)
+
+
+def refund_dict(body: dict):
+    validate_fields(body, {'user_id', 'amount'}, {'user_id', 'amount'})
+
+
+def transaction_dict(body: dict):
+    validate_fields(body, {'points', 'description'}, {'points', 'description'})
+
+
+def activate_dict(body: dict):
+    needed = {'client_location', 'category', 'service_id', 'provider_id'}
+    if not all([field in body for field in needed]):
+        raise ValueError(needed - set(body.keys()))
+    validate_location(body['client_location'], REQUIRED_LOCATION_FIELDS)
+
+
+def available_coupons_dict(params: dict):
+    validate_location(params['client_location'], REQUIRED_LOCATION_FIELDS)
+
+
+# name -> (payload, previous validation, request model)
+CASES = {
+    'create_coupon': ({
+        'coupon_code': 'BENCH_COUPON', 'discount_percent': 10.0, 'expiration_date': '2050-01-31 23:59:59',
+        'category_rules': ['category1', 'category2'], 'location_rule': '-58.38,-34.6', 'max_distance': 10,
+        'max_redemptions': 100
+    }, create_coupon_dict, CreateCouponRequest),
+    'new_refund': ({'user_id': 'bench_user', 'amount': 100}, refund_dict, RefundCouponRequest),
+    'sum_points': ({'points': 10, 'description': 'Bench points'}, transaction_dict, TransactionRequest),
+    'activate': ({
+        'client_location': '-58.38,-34.6', 'category': 'category1', 'service_id': 'service1', 'provider_id': 'provider1'
+    }, activate_dict, ActivateCouponRequest),
+    'available_coupons_query': ({
+        'user_id': 'bench_user', 'client_location': '-58.38,-34.6', 'category': 'category1',
+        'service_id': 'service1', 'provider_id': 'provider1'
+    }, available_coupons_dict, AvailableCouponsQuery),
+}
+
+
+def cpu_time(func, payload, rounds: int) -> float:
+    func(payload)  # Warm up
+    start = time.process_time()
+    for _ in range(rounds):
+        func(payload)
+    return (time.process_time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=100_000)
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.cases:
+        payload, previous, model = CASES[name]
+        dict_time = cpu_time(previous, payload, args.rounds)
+        model_time = cpu_time(model.model_validate, payload, args.rounds)
+        results.append({
+            'case': name,
+            'dict_us': dict_time * 1_000_000,
+            'request_model_us': model_time * 1_000_000,
+            'difference_us': (model_time - dict_time) * 1_000_000,
+        })
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
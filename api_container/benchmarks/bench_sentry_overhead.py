@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures the request overhead of each Sentry configuration. Every mode runs in its own process,
+# events are built as in production and dropped by a local transport.
+# Run with the following command:
+# python PaymentsService/api_container/benchmarks/bench_sentry_overhead.py --requests 2000
+
+os.environ.setdefault('TESTING', '1')
+os.environ.setdefault('MONGOMOCK', '1')
+os.environ.setdefault('MONGO_TEST_DB', 'bench_db')
+os.environ.setdefault('DEBUG_MODE', 'False')
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+BENCH_DSN = 'https://public@sentry.invalid/1'
+
+# mode -> environment of the benchmarked process
+MODES = {
+    'disabled': {},
+    'sampled': {'SENTRY_DSN': BENCH_DSN},
+    'traces_all': {'SENTRY_DSN': BENCH_DSN, 'SENTRY_TRACES_SAMPLE_RATE': '1.0', 'SENTRY_TRACES_ROUTE_RATES': ' '},
+    'traces_all_profiling': {'SENTRY_DSN': BENCH_DSN, 'SENTRY_TRACES_SAMPLE_RATE': '1.0', 'SENTRY_TRACES_ROUTE_RATES': ' ',
+                             'SENTRY_PROFILING': 'trace'},
+    'continuous_profiling': {'SENTRY_DSN': BENCH_DSN, 'SENTRY_TRACES_SAMPLE_RATE': '1.0', 'SENTRY_TRACES_ROUTE_RATES': ' ',
+                             'SENTRY_PROFILING': 'continuous'},
+}
+
+USERS = 100
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def null_transport():
+    from sentry_sdk.transport import Transport
+
+    class NullTransport(Transport):
+        def capture_envelope(self, envelope):
+            pass
+    return NullTransport
+
+
+async def run(requests: int, concurrency: int) -> dict:
+    import httpx
+    import payments_api
+    from lib.utils import sentry_init
+    if os.getenv('SENTRY_DSN'):
+        # The API already called sentry_init with the default transport, replace it
+        sentry_init(transport=null_transport())
+
+    for i in range(USERS):
+        payments_api.loyalty_manager.add_transaction(f"user_{i}", 100, 'Bench points')
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=payments_api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def request(i):
+            async with semaphore:
+                # Polling of the points and history reads, as the mobile app does
+                path = f"/loyalty/points/user_{i % USERS}" if i % 2 else f"/loyalty/history/user_{i % USERS}"
+                start = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*[request(i) for i in range(requests)])
+        elapsed = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'rps': requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def run_mode(mode: str, requests: int, concurrency: int) -> dict:
+    env = {key: value for key, value in os.environ.items() if not key.startswith('SENTRY_')}
+    env.update(MODES[mode])
+    result = subprocess.run(
+        [sys.executable, __file__, '--worker', '--requests', str(requests), '--concurrency', str(concurrency)],
+        env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(asyncio.run(run(args.requests, args.concurrency))))
+        return
+
+    results = {mode: run_mode(mode, args.requests, args.concurrency) for mode in args.modes}
+    if 'disabled' in results:
+        baseline = results['disabled']['mean_ms']
+        for result in results.values():
+            result['overhead_ms'] = result['mean_ms'] - baseline
+            result['overhead_percent'] = 100 * (result['mean_ms'] - baseline) / baseline
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+# Compares the CPU time of serializing the coupon and loyalty payloads, per response size:
+# - untyped: plain dicts, as FastAPI does without a response model (jsonable_encoder + stdlib json)
+# - response_model: the route response model, as FastAPI does with one (pydantic-core, straight to JSON bytes)
+# Run with the following command:
+# python PaymentsService/api_container/benchmarks/bench_serialization.py --sizes 10 100 1000 10000
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from response_models import CouponsResponse, HistoryResponse
+
+
+def coupon(i: int) -> dict:
+    return {
+        'uuid': f"COUPON_{i}",
+        'discount_percent': 10,
+        'max_discount': 100.5,
+        'expiration_date': '2030-01-01 00:00:00',
+        'used_by': {f"user_{j}": '2024-01-01 00:00:00' for j in range(20)},
+        'category_rules': ['category_1', 'category_2'],
+        'service_rules': None,
+        'provider_rules': None,
+        'location_rule': {'type': 'Point', 'coordinates': [-58.38, -34.6]},
+        'max_distance': 10,
+        'users_rules': None,
+        'max_redemptions': None,
+        'redemption_count': 20,
+        'created_at': '2024-01-01 00:00:00',
+        'updated_at': '2024-01-01 00:00:00'
+    }
+
+
+def history_entry(i: int) -> dict:
+    if i % 3 == 0:
+        return {'cash': -15.5, 'timestamp': '2024-01-01 00:00:00', 'description': f"Payment {i}"}
+    if i % 3 == 1:
+        return {'coupon_id': f"COUPON_{i}", 'timestamp': '2024-01-01 00:00:00', 'description': f"Used coupon {i}"}
+    return {'points': 10, 'timestamp': '2024-01-01 00:00:00', 'description': f"Points {i}"}
+
+
+def untyped(content) -> bytes:
+    # What JSONResponse.render does with the output of jsonable_encoder
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+def typed(adapter: TypeAdapter):
+    def serialize(content) -> bytes:
+        return adapter.dump_json(adapter.validate_python(content), exclude_unset=True)
+    return serialize
+
+
+def cpu_time(func, content, rounds: int) -> float:
+    func(content)  # Warm up
+    start = time.process_time()
+    for _ in range(rounds):
+        func(content)
+    return (time.process_time() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    payloads = {
+        'coupons': (CouponsResponse, lambda size: {'status': 'ok', 'coupons': [coupon(i) for i in range(size)]}),
+        'history': (HistoryResponse, lambda size: {'status': 'ok', 'history': [history_entry(i) for i in range(size)]}),
+    }
+    results = []
+    for name, (model, build) in payloads.items():
+        serialize = typed(TypeAdapter(model))
+        for size in args.sizes:
+            content = build(size)
+            assert json.loads(untyped(content)) == json.loads(serialize(content))
+            rounds = max(3, 20_000 // size)
+            untyped_time, typed_time = cpu_time(untyped, content, rounds), cpu_time(serialize, content, rounds)
+            results.append({
+                'payload': name,
+                'size': size,
+                'bytes': len(serialize(content)),
+                'untyped_ms': untyped_time * 1000,
+                'response_model_ms': typed_time * 1000,
+                'cpu_saved_ms': (untyped_time - typed_time) * 1000,
+                'speedup': untyped_time / typed_time if typed_time else None,
+            })
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+# End to end load test of the payments API with a weighted mix of the endpoints, over a seeded dataset.
+# Backends:
+# - mongomock: in-process API over mongomock (no server needed)
+# - mongod: in-process API over a MongoDB server (--mongo-uri, a local mongod by default)
+# With --url the requests go to a running API instead (the dataset is seeded through --mongo-uri).
+# Run with the following command:
+# python PaymentsService/api_container/benchmarks/load_test.py --backend mongod --coupons 100000 --users 10000 --history-length 1000
+# Results are written to --output (JSON). With --baseline, the run fails if a scenario regressed more than --max-regression.
+
+CATEGORIES = [f"category_{i}" for i in range(20)]
+SERVICES = [f"service_{i}" for i in range(200)]
+PROVIDERS = [f"provider_{i}" for i in range(50)]
+LOCATION = "-58.3816,-34.6037"
+SEED_CHUNK_SIZE = 10_000
+INVALID_ACTIVATION_SHARE = 0.05  # Activations with a random category, service and provider (mostly rejected with 400)
+
+# scenario -> default weight. Scenarios with weight 0 are run only if enabled with --mix.
+DEFAULT_MIX = {
+    'coupon_lookup': 30,
+    'coupon_activation': 10,
+    'points_credit': 15,
+    'points_read': 15,
+    'history_read': 10,
+    'user_coupons': 3,
+    'coupon_search': 4,
+    'refund_coupons': 3,
+    'new_refund': 2,
+    'payment_done': 2,
+    'notifications_read': 3,
+    'notifications_mark_read': 1,
+    'coupon_create': 1,
+    'buy_cash_coupon': 1,
+    'buy_discount_coupon': 0,
+    'use_refund': 0,
+    'coupon_delete': 0,
+    'all_coupons': 0,  # Returns the whole collection
+    'metrics': 0,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['mongomock', 'mongod'], default='mongomock')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--db', default='payments_load_test')
+    parser.add_argument('--url', help="Base URL of a running API, instead of the in-process app")
+    parser.add_argument('--coupons', type=int, default=10_000)
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--history-length', type=int, default=100, help="History entries per seeded user")
+    parser.add_argument('--requests', type=int, default=5_000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mix', nargs='*', default=[], help="Overrides of the scenario weights, as scenario=weight")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-seed', action='store_true', help="Reuse the dataset of a previous run (mongod)")
+    parser.add_argument('--output', default='load_test_results.json')
+    parser.add_argument('--baseline', help="Results file of a previous run to compare with")
+    parser.add_argument('--max-regression', type=float, default=0.2, help="Allowed p95 increase and RPS decrease (ratio)")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # Must run before importing the API
+    os.environ.setdefault('DEBUG_MODE', 'False')
+    # The load test measures capacity, the rate limits would reject most of the generated requests
+    os.environ.setdefault('RATE_LIMIT_PER_USER', '0')
+    os.environ.setdefault('RATE_LIMIT_PER_ROUTE', '0')
+    os.environ['MONGO_TEST_DB'] = args.db
+    if args.backend == 'mongomock':
+        os.environ['TESTING'] = '1'
+        os.environ['MONGOMOCK'] = '1'
+    else:
+        os.environ.pop('TESTING', None)
+        os.environ.pop('MONGOMOCK', None)
+        os.environ['MONGO_URI'] = args.mongo_uri
+        os.environ['MONGO_DB'] = args.db
+        os.environ.setdefault('STRIPE_SECRET', 'sk_test_load')
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+
+def build_mix(overrides):
+    mix = dict(DEFAULT_MIX)
+    for override in overrides:
+        name, weight = override.split('=')
+        if name not in mix:
+            raise SystemExit(f"Unknown scenario '{name}', must be one of {sorted(mix)}")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+class Dataset:
+    """
+    Seeded coupons and users. The requests are built from these ids.
+    """
+
+    def __init__(self, coupons: int, users: int, history_length: int, rng: random.Random):
+        self.rng = rng
+        self.coupon_codes = [f"LOAD_COUPON_{i}" for i in range(coupons)]
+        self.user_ids = [f"load_user_{i}" for i in range(users)]
+        self.history_length = history_length
+        self.created = 0
+        self.coupon_rules = {}  # code -> (category_rules, service_rules, provider_rules), filled when seeding
+
+    def coupon_docs(self):
+        from lib.utils import get_actual_time, get_timestamp_after_days
+        now, expiration = get_actual_time(), get_timestamp_after_days(365)
+        for code in self.coupon_codes:
+            rules = (self.rng.sample(CATEGORIES, 2),
+                     None if self.rng.random() < 0.8 else self.rng.sample(SERVICES, 5),
+                     None if self.rng.random() < 0.8 else self.rng.sample(PROVIDERS, 3))
+            self.coupon_rules[code] = rules
+            yield {
+                'uuid': code,
+                'discount_percent': self.rng.choice([5, 10, 15, 20, 50]),
+                'max_discount': self.rng.choice([None, 100, 500]),
+                'expiration_date': expiration,
+                'used_by': {},
+                'category_rules': rules[0],
+                'service_rules': rules[1],
+                'provider_rules': rules[2],
+                'location_rule': None,
+                'max_distance': None,
+                'users_rules': None,
+                'max_redemptions': None,
+                'redemption_count': 0,
+                'created_at': now,
+                'updated_at': now
+            }
+
+    def loyalty_docs(self):
+        from lib.utils import get_actual_time, get_timestamp_after_days
+        now, expiration = get_actual_time(), get_timestamp_after_days(365)
+        for user_id in self.user_ids:
+            yield {
+                'uuid': user_id,
+                'points': [(expiration, 10)] * min(self.history_length, 100),
+                'created_at': now,
+                'updated_at': now,
+                'history': [{'points': 10, 'timestamp': now, 'description': f"Seed {i}"} for i in range(self.history_length)]
+            }
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def coupon(self):
+        return self.rng.choice(self.coupon_codes)
+
+
+async def seed(api, dataset: Dataset):
+    for collection, docs in [(api.async_coupons_manager.collection, dataset.coupon_docs()),
+                             (api.async_loyalty_manager.collection, dataset.loyalty_docs())]:
+        await collection.delete_many({})
+        chunk = []
+        for doc in docs:
+            chunk.append(doc)
+            if len(chunk) == SEED_CHUNK_SIZE:
+                await collection.insert_many(chunk)
+                chunk = []
+        if chunk:
+            await collection.insert_many(chunk)
+
+
+def build_request(scenario: str, dataset: Dataset):
+    """
+    Returns (method, path, request kwargs) for the scenario.
+    """
+    rng = dataset.rng
+    user = dataset.user()
+    lookup = {'user_id': user, 'client_location': LOCATION, 'category': rng.choice(CATEGORIES),
+              'service_id': rng.choice(SERVICES), 'provider_id': rng.choice(PROVIDERS)}
+    if scenario == 'coupon_lookup':
+        return 'GET', '/coupons', {'params': lookup}
+    if scenario == 'coupon_activation':
+        code = dataset.coupon()
+        body = {key: value for key, value in lookup.items() if key != 'user_id'}
+        if rng.random() >= INVALID_ACTIVATION_SHARE:
+            # Valid for the coupon rules, so the request reaches the guarded update
+            category_rules, service_rules, provider_rules = dataset.coupon_rules[code]
+            body['category'] = rng.choice(category_rules)
+            body['service_id'] = rng.choice(service_rules or SERVICES)
+            body['provider_id'] = rng.choice(provider_rules or PROVIDERS)
+        return 'PUT', f"/coupons/activate/{code}/{user}", {'json': body}
+    if scenario == 'points_credit':
+        return 'PUT', f"/loyalty/sum_points/{user}", {'json': {'points': rng.randint(1, 100), 'description': 'Load test'}}
+    if scenario == 'points_read':
+        return 'GET', f"/loyalty/points/{user}", {}
+    if scenario == 'history_read':
+        return 'GET', f"/loyalty/history/{user}", {}
+    if scenario == 'user_coupons':
+        return 'GET', '/coupons/all', {'params': {'user_id': user, 'client_location': LOCATION}}
+    if scenario == 'coupon_search':
+        return 'GET', '/coupons/search', {'params': {'category': rng.choice(CATEGORIES), 'limit': 50}}
+    if scenario == 'refund_coupons':
+        return 'GET', '/coupons/refund', {'params': {'user_id': user}}
+    if scenario == 'new_refund':
+        return 'POST', '/coupons/new_refund', {'json': {'user_id': user, 'amount': rng.randint(1, 100)}}
+    if scenario == 'payment_done':
+        return 'POST', f"/pay/{user}/paymentdone", {'json': {'amount': rng.randint(1, 100), 'description': 'Load test'}}
+    if scenario == 'notifications_read':
+        return 'GET', f"/notifications/{user}", {}
+    if scenario == 'notifications_mark_read':
+        return 'PUT', f"/notifications/{user}/read", {}
+    if scenario == 'coupon_create':
+        dataset.created += 1
+        return 'POST', '/coupons/create', {'json': {
+            'coupon_code': f"LOAD_NEW_{dataset.created}_{rng.random()}", 'discount_percent': 10,
+            'expiration_date': '2099-01-01 00:00:00', 'category_rules': [rng.choice(CATEGORIES)]}}
+    if scenario == 'buy_cash_coupon':
+        return 'PUT', f"/loyalty/use_points/cash_coupon/{user}", {'json': {'CASH_DISCOUNT': 1}}
+    if scenario == 'buy_discount_coupon':
+        return 'PUT', f"/loyalty/use_points/discount_coupon/{user}", {'json': {'DISCOUNT': 1}}
+    if scenario == 'use_refund':
+        return 'PUT', f"/coupons/use_refund/{dataset.coupon()}/{user}", {}
+    if scenario == 'coupon_delete':
+        return 'DELETE', f"/coupons/delete/LOAD_NEW_{rng.randint(1, max(dataset.created, 1))}", {}
+    if scenario == 'all_coupons':
+        return 'GET', '/coupons/all_coupons', {}
+    if scenario == 'metrics':
+        return 'GET', '/metrics', {}
+    raise ValueError(f"Unknown scenario '{scenario}'")
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0.0
+
+
+def summarize(latencies, statuses, elapsed):
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else 0.0,
+        'rejected': sum(1 for status in statuses if 400 <= status < 500),  # Business rule rejections
+        'errors': sum(1 for status in statuses if status >= 500 or status < 0),
+    }
+
+
+async def run_load(client, dataset: Dataset, mix: dict, requests: int, concurrency: int) -> dict:
+    scenarios = dataset.rng.choices(list(mix), weights=list(mix.values()), k=requests)
+    results = {scenario: ([], []) for scenario in mix}
+    queue = asyncio.Queue()
+    for scenario in scenarios:
+        queue.put_nowait(scenario)
+
+    async def worker():
+        while not queue.empty():
+            scenario = queue.get_nowait()
+            method, path, kwargs = build_request(scenario, dataset)
+            start = time.perf_counter()
+            try:
+                status = (await client.request(method, path, **kwargs)).status_code
+            except Exception as e:
+                logging.error(f"{scenario} failed: {e}")
+                status = -1
+            latencies, statuses = results[scenario]
+            latencies.append(time.perf_counter() - start)
+            statuses.append(status)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    all_latencies = [latency for latencies, _ in results.values() for latency in latencies]
+    all_statuses = [status for _, statuses in results.values() for status in statuses]
+    return {
+        'total': summarize(all_latencies, all_statuses, elapsed),
+        'scenarios': {scenario: summarize(latencies, statuses, elapsed) for scenario, (latencies, statuses) in results.items()}
+    }
+
+
+async def run(args) -> dict:
+    import httpx
+    import payments_api
+    logging.getLogger().setLevel(logging.WARNING)
+    dataset = Dataset(args.coupons, args.users, args.history_length, random.Random(args.seed))
+    mix = build_mix(args.mix)
+
+    lifespan = payments_api.app.router.lifespan_context(payments_api.app)
+    async with lifespan:
+        if not args.no_seed:
+            start = time.perf_counter()
+            await seed(payments_api, dataset)
+            logging.warning(f"Seeded {args.coupons} coupons and {args.users} users in {time.perf_counter() - start:.1f}s")
+        transport = None if args.url else httpx.ASGITransport(app=payments_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url=args.url or "http://load-test", timeout=60) as client:
+            results = await run_load(client, dataset, mix, args.requests, args.concurrency)
+
+    results['config'] = {
+        'backend': 'http' if args.url else args.backend,
+        'coupons': args.coupons,
+        'users': args.users,
+        'history_length': args.history_length,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'mix': mix,
+        'seed': args.seed,
+    }
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, max_regression: float) -> list:
+    regressions = []
+    for scenario, current in [('total', results['total']), *results['scenarios'].items()]:
+        previous = baseline['total'] if scenario == 'total' else baseline.get('scenarios', {}).get(scenario)
+        if not previous or not previous['requests']:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{scenario}: p95 {previous['p95_ms']:.1f}ms -> {current['p95_ms']:.1f}ms")
+        if scenario == 'total' and current['rps'] < previous['rps'] * (1 - max_regression):
+            regressions.append(f"{scenario}: RPS {previous['rps']:.1f} -> {current['rps']:.1f}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    results = asyncio.run(run(args))
+
+    print(json.dumps(results['total'], indent=2))
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.max_regression)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import json
+import os
+import sys
+import tracemalloc
+import pytest
+import mongomock
+
+# Microbenchmarks of the Loyalty and Coupons methods whose cost grows with the document size
+# ('history' and 'points' of a user, 'used_by' of a coupon). Needs pytest-benchmark.
+# Run with the following command:
+# pytest PaymentsService/api_container/benchmarks/microbench_documents.py --benchmark-json=microbench.json
+# Check for regressions against a previous run (time with pytest-benchmark, peak memory with MICROBENCH_BASELINE):
+# MICROBENCH_BASELINE=microbench.json pytest PaymentsService/api_container/benchmarks/microbench_documents.py \
+#     --benchmark-json=microbench_new.json --benchmark-compare --benchmark-compare-fail=median:20%
+# Environment:
+# - MICROBENCH_SIZES: document sizes, comma separated (default 10,100,1000,10000,100000)
+# - MICROBENCH_BASELINE: pytest-benchmark JSON of a previous run, its peak memory is the reference
+# - MICROBENCH_MAX_MEMORY_REGRESSION: allowed peak memory increase (ratio, default 0.2)
+
+os.environ['TESTING'] = '1'
+os.environ['MONGOMOCK'] = '1'
+os.environ.setdefault('MONGO_TEST_DB', 'bench_db')
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from loyalty_nosql import Loyalty
+from coupons_nosql import Coupons
+from lib.utils import get_actual_time, get_timestamp_after_days
+
+SIZES = [int(size) for size in (os.getenv('MICROBENCH_SIZES') or '10,100,1000,10000,100000').split(',')]
+MAX_MEMORY_REGRESSION = float(os.getenv('MICROBENCH_MAX_MEMORY_REGRESSION') or 0.2)
+ENTRIES_PER_BENCH = 200_000  # Bounds rounds * size, so the big documents keep the suite short
+
+
+def load_baseline() -> dict:
+    if not os.getenv('MICROBENCH_BASELINE'):
+        return {}
+    with open(os.getenv('MICROBENCH_BASELINE')) as file:
+        return {bench['name']: bench.get('extra_info', {}) for bench in json.load(file)['benchmarks']}
+
+
+BASELINE = load_baseline()
+
+
+def rounds_for(size: int) -> int:
+    return max(2, min(50, ENTRIES_PER_BENCH // size))
+
+
+def peak_memory(func, *args) -> int:
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def check_memory(benchmark, request, peak: int):
+    benchmark.extra_info['peak_memory_bytes'] = peak
+    reference = BASELINE.get(request.node.name, {}).get('peak_memory_bytes')
+    if reference:
+        assert peak <= reference * (1 + MAX_MEMORY_REGRESSION), \
+            f"Peak memory regressed: {reference} -> {peak} bytes"
+
+
+@pytest.fixture(scope='module')
+def mongo_client():
+    client = mongomock.MongoClient()
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope='module')
+def loyalty(mongo_client):
+    return Loyalty(test_client=mongo_client)
+
+
+@pytest.fixture(scope='module')
+def coupons(mongo_client):
+    return Coupons(test_client=mongo_client)
+
+
+def reset_user(loyalty, size: int):
+    actual_time, expiration = get_actual_time(), get_timestamp_after_days(365)
+    loyalty.collection.delete_many({})
+    loyalty.collection.insert_one({
+        'uuid': 'bench_user',
+        'points': [(expiration, 10)] * size,
+        'created_at': actual_time,
+        'updated_at': actual_time,
+        'history': [{'points': 10, 'timestamp': actual_time, 'description': f"Bench {i}"} for i in range(size)]
+    })
+
+
+def reset_coupon(coupons, size: int):
+    coupons.collection.delete_many({})
+    coupons.insert('BENCH_COUPON', 10, '2099-01-01 00:00:00', category_rules=['bench'])
+    coupons.collection.update_one({'uuid': 'BENCH_COUPON'}, {'$set': {
+        'used_by': {f"user_{i}": get_actual_time() for i in range(size)},
+        'redemption_count': size
+    }})
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_add_transaction(benchmark, request, loyalty, size):
+    def setup():
+        reset_user(loyalty, size)
+        return ('bench_user', 5, 'Bench transaction'), {}
+
+    setup()
+    check_memory(benchmark, request, peak_memory(loyalty.add_transaction, 'bench_user', 5, 'Bench transaction'))
+    result = benchmark.pedantic(loyalty.add_transaction, setup=setup, rounds=rounds_for(size))
+    assert result == True
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_get_history(benchmark, request, loyalty, size):
+    reset_user(loyalty, size)
+    check_memory(benchmark, request, peak_memory(loyalty.get_history, 'bench_user'))
+    history = benchmark.pedantic(loyalty.get_history, args=('bench_user',), rounds=rounds_for(size))
+    assert len(history) == size
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_add_user_to_coupon(benchmark, request, coupons, size):
+    reset_coupon(coupons, size)
+    users = iter(range(10 ** 9))
+
+    def setup():
+        # A new user per round, the coupon grows by one entry
+        return ('BENCH_COUPON', f"bench_user_{next(users)}"), {}
+
+    check_memory(benchmark, request, peak_memory(coupons.add_user_to_coupon, 'BENCH_COUPON', 'memory_user'))
+    result = benchmark.pedantic(coupons.add_user_to_coupon, setup=setup, rounds=rounds_for(size))
+    assert result == True
@@ -5,20 +5,34 @@ from pymongo import ASCENDING
 from pymongo.errors import DuplicateKeyError, OperationFailure
 import logging as logger
 import os
+import re
 import sys
 import uuid
-from lib.utils import get_actual_time, get_mongo_client
+from lib.utils import get_actual_time, get_async_mongo_client, spherical_distance, SingleFlight
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
 
 HOUR = 60 * 60
 MINUTE = 60
 MILLISECOND = 1_000
 
+# Seconds an available coupons query is shared by the requests with the same category, service and provider
+AVAILABLE_COUPONS_WINDOW = float(os.getenv('AVAILABLE_COUPONS_WINDOW') or 1)
+AVAILABLE_COUPON_FIELDS = ('uuid', 'discount_percent', 'max_discount', 'expiration_date')
+
+# Coupons created by the system are identified by the prefix of their code
+COUPON_KINDS = {'refund': 'REFUND_', 'cash': 'CASH_', 'discount': 'DISCOUNT_'}
+REGULAR_COUPON_KIND = 'regular'
+SEARCHABLE_FIELDS = {'uuid', 'discount_percent', 'max_discount', 'expiration_date', 'used_by', 'category_rules', 'service_rules', 'provider_rules',
+                     'location_rule', 'max_distance', 'users_rules', 'max_redemptions', 'redemption_count', 'created_at', 'updated_at'}
+
 # TODO: (General) -> Create tests for each method && add the required checks in each method
 
 
-class Coupons:
+@instrument_manager('coupons')
+class AsyncCoupons:
     """
-    Coupons class that stores data in a MongoDB collection.
+    AsyncCoupons class that stores data in a MongoDB collection.
     Fields:
     - id: str (unique) (coupon code)
     - discount_percent: float
@@ -33,45 +47,67 @@ class Coupons:
     - location_rule: (longitude and latitude) (optional) -> Location where the coupon is valid (center point)
     - max_distance: int (optional) -> Max distance from the location_rule where the coupon is valid (kilometers)
     - users_rules: List[str] (optional) -> List of user ids that the coupon is valid for
+    - max_redemptions: int (optional) -> Max number of times the coupon can be redeemed (across all users)
+    - redemption_count: int -> Number of times the coupon was redeemed
+    - version: int -> Incremented by every change of the coupon (ETag of the refund coupons endpoint)
+    Redemptions (activations and refund coupon uses) are also counted in the coupon_daily_stats collection:
+    - coupon: str, day: str ('YYYY-MM-DD'), category: str (optional) -> unique together
+    - redemptions: int
     """
 
-    def __init__(self, test_client=None, test_db=None):
-        self.client = test_client or get_mongo_client()
-        if not self._check_connection():
-            raise Exception("Failed to connect to MongoDB")
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
         if test_client:
             self.db = self.client[os.getenv('MONGO_TEST_DB')]
         else:
             self.db = self.client[test_db or os.getenv('MONGO_DB')]
         self.collection = self.db['payments']
-        self._create_collection()
+        self.daily_stats = self.db['coupon_daily_stats']
+        self.available_coupons_flights = SingleFlight('available_coupons', AVAILABLE_COUPONS_WINDOW)
 
-    def _check_connection(self):
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
+
+    async def _check_connection(self):
         try:
-            self.client.admin.command('ping')
+            await self.client.admin.command('ping')
         except Exception as e:
             logger.error(e)
             return False
         return True
 
-    def _create_collection(self):
-        self.collection.create_index([('uuid', ASCENDING)], unique=True)
-        self.collection.create_index([('location', '2dsphere')])
-
-    def insert(self,
-               coupon_code: str,
-               discount_percent: float,
-               expiration_date: int,
-               max_discount: Optional[float] = None,
-               category_rules: Optional[List[str]] = None,
-               service_rules: Optional[List[str]] = None,
-               provider_rules: Optional[List[str]] = None,
-               location_rule: Optional[dict] = None,
-               max_distance: Optional[int] = None,
-               users_rules: Optional[List[str]] = None
-               ) -> bool:
+    async def _create_collection(self):
+        await self.collection.create_index([('uuid', ASCENDING)], unique=True)
+        await self.collection.create_index([('location', '2dsphere')])
+        # Admin search: keyset pagination is always ordered by uuid
+        await self.collection.create_index([('expiration_date', ASCENDING), ('uuid', ASCENDING)])
+        await self.collection.create_index([('category_rules', ASCENDING), ('uuid', ASCENDING)])
+        await self.collection.create_index([('service_rules', ASCENDING), ('uuid', ASCENDING)])
+        await self.collection.create_index([('provider_rules', ASCENDING), ('uuid', ASCENDING)])
+        await self.daily_stats.create_index([('coupon', ASCENDING), ('day', ASCENDING), ('category', ASCENDING)], unique=True)
+
+    async def insert(self,
+                     coupon_code: str,
+                     discount_percent: float,
+                     expiration_date: int,
+                     max_discount: Optional[float] = None,
+                     category_rules: Optional[List[str]] = None,
+                     service_rules: Optional[List[str]] = None,
+                     provider_rules: Optional[List[str]] = None,
+                     location_rule: Optional[dict] = None,
+                     max_distance: Optional[int] = None,
+                     users_rules: Optional[List[str]] = None,
+                     max_redemptions: Optional[int] = None,
+                     session=None
+                     ) -> bool:
+        """
+        Returns False if the code already exists. Inside a transaction (session) every write error is raised,
+        so the transaction is aborted (and retried on a transient error, like a write conflict).
+        """
         try:
-            self.collection.insert_one({
+            await self.collection.insert_one({
                 'uuid': coupon_code,
                 'discount_percent': discount_percent,
                 'max_discount': max_discount,
@@ -83,41 +119,49 @@ class Coupons:
                 'location_rule': {'type': 'Point', 'coordinates': [location_rule['longitude'], location_rule['latitude']]} if location_rule else None,
                 'max_distance': max_distance,
                 'users_rules': users_rules,
+                'max_redemptions': max_redemptions,
+                'redemption_count': 0,
+                'version': 0,
                 'created_at': get_actual_time(),
                 'updated_at': get_actual_time()
-            })
+            }, session=session)
+            self.available_coupons_flights.clear()
             return True
         except DuplicateKeyError as e:
+            if session is not None:
+                raise
             logger.error(f"DuplicateKeyError: {e}")
             return False
         except OperationFailure as e:
+            if session is not None:
+                raise
             logger.error(f"OperationFailure: {e}")
             return False
 
-    def get(self, coupon_code: str) -> Optional[Dict]:
-        return self.collection.find_one({'uuid': coupon_code}) or None
+    async def get(self, coupon_code: str) -> Optional[Dict]:
+        return await self.collection.find_one({'uuid': coupon_code}) or None
 
-    def delete(self, coupon_code: str) -> bool:
-        result = self.collection.delete_one({'uuid': coupon_code})
+    async def delete(self, coupon_code: str) -> bool:
+        result = await self.collection.delete_one({'uuid': coupon_code})
+        self.available_coupons_flights.clear()
         return result.deleted_count > 0
 
-    def update(self, coupon_code: str, data: Dict) -> bool:
+    async def update(self, coupon_code: str, data: Dict) -> bool:
         data['updated_at'] = get_actual_time()
         try:
-            result = self.collection.update_one(
-                {'uuid': coupon_code}, {'$set': data})
+            result = await self.collection.update_one(
+                {'uuid': coupon_code}, {'$set': data, '$inc': {'version': 1}})
+            self.available_coupons_flights.clear()
             return result.modified_count > 0
         except Exception as e:
             logger.error(f"Error updating service with uuid '{uuid}': {e}")
             return False
 
-    def obtain_available_coupons(self,
-                                 user_id: str,
-                                 client_location: dict,
-                                 category: str,
-                                 service_id: str,
-                                 provider_id: str
-                                 ) -> List[Dict]:
+    async def _available_coupon_candidates(self, category: str, service_id: str, provider_id: str) -> List[Dict]:
+        """
+        User independent part of obtain_available_coupons: expiration, category, service and provider.
+        Returns the coupons with what is needed to apply the user and location rules in-process.
+        """
         pipeline = []
 
         # Filter by expiration date
@@ -139,47 +183,58 @@ class Coupons:
         pipeline.append({'$match': {'$or': [{'provider_rules': {'$exists': False}}, {
                         'provider_rules': None}, {'provider_rules': {'$in': [provider_id]}}]}})
 
-        # Filter by location and max distance
-        # If the coupon has no location rule, it is valid for all locations
-        if not os.environ.get('MONGOMOCK'):
-            geo_near_stage = {
-                '$geoNear': {
-                    'near': {
-                        'type': 'Point',
-                        'coordinates': [client_location['longitude'], client_location['latitude']]
-                    },
-                    'distanceField': 'distance',
-                    'spherical': True
-                }
-            }
-            pipeline.append(geo_near_stage)
-
-            match_stage = {
-                '$match': {
-                    # Convert kilometers to meters
-                    '$or': [{'max_distance': {'$exists': False}}, {'max_distance': None}, {'$expr': {'$lte': ['$distance', {'$multiply': ['$max_distance', 1000]}]}}]
-                }
-            }
-            pipeline.append(match_stage)
-
-        # Filter by user
-        # If the coupon has no user rules, it is valid for all users
-        pipeline.append({'$match': {'$or': [{'users_rules': {'$exists': False}}, {
-                        'users_rules': None}, {'users_rules': {'$in': [user_id]}}]}})
-
-        # Filter by used_by (avoid multiple uses of the same coupon by the same user)
-        # used_by is a dictionary with the following structure: {'user_id': 'used_at'}
-        pipeline.append({'$match': {'$or': [{'used_by': {'$exists': False}}, {
-                        'used_by': {}}, {'used_by.' + user_id: {'$exists': False}}]}})
-
-        # Project only the necessary fields
-        pipeline.append({'$project': {'_id': 0, 'uuid': 1,
-                        'discount_percent': 1, 'max_discount': 1, 'expiration_date': 1}})
-
-        return list(self.collection.aggregate(pipeline))
-
-    def get_refund_coupons(self, user_id: str) -> List[Dict]:
-        return list(self.collection.find({
+        pipeline.append({'$project': {'_id': 0, 'uuid': 1, 'discount_percent': 1, 'max_discount': 1, 'expiration_date': 1,
+                                      'users_rules': 1, 'used_by': 1, 'location_rule': 1, 'max_distance': 1}})
+
+        candidates = []
+        for coupon in await (await self.collection.aggregate(pipeline)).to_list(None):
+            users_rules = coupon.get('users_rules')
+            location_rule = coupon.get('location_rule')
+            candidates.append({
+                'coupon': {field: coupon[field] for field in AVAILABLE_COUPON_FIELDS if field in coupon},
+                'users_rules': set(users_rules) if users_rules is not None else None,
+                'used_by': set(coupon.get('used_by') or {}),
+                'location': location_rule['coordinates'] if location_rule and coupon.get('max_distance') is not None else None,
+                'max_distance': coupon.get('max_distance')
+            })
+        return candidates
+
+    async def obtain_available_coupons(self,
+                                       user_id: str,
+                                       client_location: dict,
+                                       category: str,
+                                       service_id: str,
+                                       provider_id: str
+                                       ) -> List[Dict]:
+        """
+        The user independent query is shared by the concurrent requests with the same category, service and
+        provider (and reused for AVAILABLE_COUPONS_WINDOW seconds). The user and location rules are applied
+        in-process, so a coupon activated meanwhile may be listed until the window ends (activation checks it again).
+        """
+        candidates = await self.available_coupons_flights.run(
+            (category, service_id, provider_id),
+            lambda: self._available_coupon_candidates(category, service_id, provider_id))
+
+        actual_time = get_actual_time()
+        coupons = []
+        for candidate in candidates:
+            if candidate['coupon']['expiration_date'] < actual_time:
+                continue
+            # If the coupon has no user rules, it is valid for all users
+            if candidate['users_rules'] is not None and user_id not in candidate['users_rules']:
+                continue
+            # Avoid multiple uses of the same coupon by the same user
+            if user_id in candidate['used_by']:
+                continue
+            # If the coupon has no location rule, it is valid for all locations
+            if candidate['location'] is not None and spherical_distance(
+                    client_location['longitude'], client_location['latitude'], *candidate['location']) > candidate['max_distance']:
+                continue
+            coupons.append(dict(candidate['coupon']))
+        return coupons
+
+    async def get_refund_coupons(self, user_id: str) -> List[Dict]:
+        return await self.collection.find({
             'uuid': {'$regex': f'^REFUND_{user_id}_'},
             f'used_by.{user_id}': {'$exists': False}
         }, {
@@ -189,12 +244,61 @@ class Coupons:
             'max_discount': 1,
             'expiration_date': 1,
             'discount_percent': 1,
-        }))
-
-    def get_all_coupons(self) -> List[Dict]:
-        return list(self.collection.find({}, {'_id': 0}))
-
-    def obtain_user_coupons(self, user_id: str, client_location: dict) -> List[Dict]:
+        }).to_list(None)
+
+    async def get_all_coupons(self) -> List[Dict]:
+        return await self.collection.find({}, {'_id': 0}).to_list(None)
+
+    async def search(self,
+                     code_prefix: Optional[str] = None,
+                     kind: Optional[str] = None,
+                     category: Optional[str] = None,
+                     service_id: Optional[str] = None,
+                     provider_id: Optional[str] = None,
+                     expires_after: Optional[str] = None,
+                     expires_before: Optional[str] = None,
+                     has_location_rule: Optional[bool] = None,
+                     after: Optional[str] = None,
+                     limit: int = 50,
+                     fields: Optional[List[str]] = None
+                     ) -> List[Dict]:
+        """
+        Admin search over all the coupons, ordered by code.
+        Pagination is keyset based: 'after' is the last code of the previous page.
+        """
+        conditions = []
+        if code_prefix:
+            conditions.append({'uuid': {'$regex': f'^{re.escape(code_prefix)}'}})
+        if kind == REGULAR_COUPON_KIND:
+            prefixes = '|'.join(re.escape(prefix) for prefix in COUPON_KINDS.values())
+            conditions.append({'uuid': {'$not': re.compile(f'^({prefixes})')}})
+        elif kind:
+            conditions.append({'uuid': {'$regex': f'^{COUPON_KINDS[kind]}'}})
+        if after:
+            conditions.append({'uuid': {'$gt': after}})
+        if category:
+            conditions.append({'category_rules': category})
+        if service_id:
+            conditions.append({'service_rules': service_id})
+        if provider_id:
+            conditions.append({'provider_rules': provider_id})
+        if expires_after or expires_before:
+            expiration_range = {}
+            if expires_after:
+                expiration_range['$gte'] = expires_after
+            if expires_before:
+                expiration_range['$lte'] = expires_before
+            conditions.append({'expiration_date': expiration_range})
+        if has_location_rule is not None:
+            conditions.append({'location_rule': {'$ne': None} if has_location_rule else None})
+
+        query = {'$and': conditions} if conditions else {}
+        projection = {'_id': 0}
+        if fields:
+            projection.update({field: 1 for field in set(fields) | {'uuid'}})
+        return await self.collection.find(query, projection).sort('uuid', ASCENDING).limit(limit).to_list(None)
+
+    async def obtain_user_coupons(self, user_id: str, client_location: dict) -> List[Dict]:
         pipeline = []
 
         if not os.environ.get('MONGOMOCK'):
@@ -264,43 +368,132 @@ class Coupons:
             }
         })
 
-        return list(self.collection.aggregate(pipeline))
+        return await (await self.collection.aggregate(pipeline)).to_list(None)
 
-    def mark_coupon_as_used(self, coupon_code: str, user_id: str) -> bool:
+    async def _count_redemption(self, coupon_code: str, day: str, category: Optional[str], redemptions: int = 1) -> None:
+        # A failure is only logged, the coupon was already updated
         try:
-            result = self.collection.update_one(
-                {'uuid': coupon_code},
-                {'$set': {f'used_by.{user_id}': get_actual_time()}}
+            await self.daily_stats.update_one({'coupon': coupon_code, 'day': day, 'category': category},
+                                              {'$inc': {'redemptions': redemptions}}, upsert=True)
+        except Exception as e:
+            logger.error(f"Error updating the stats of coupon '{coupon_code}': {e}")
+
+    async def mark_coupon_as_used(self, coupon_code: str, user_id: str) -> bool:
+        try:
+            used_at = get_actual_time()
+            # Guarded: of two concurrent uses only one marks the coupon (and is counted)
+            result = await self.collection.update_one(
+                {'uuid': coupon_code, f'used_by.{user_id}': {'$exists': False}},
+                {'$set': {f'used_by.{user_id}': used_at}, '$inc': {'version': 1}}
             )
-            return result.modified_count > 0
+            if result.modified_count == 1:
+                await self._count_redemption(coupon_code, used_at[:10], None)
+            return result.modified_count == 1
         except Exception as e:
             logger.error(f"Error marking coupon {coupon_code} as used: {e}")
             return False
 
-    def add_user_to_coupon(self, coupon_code: str, user_id: str) -> bool:
-        coupon = self.get(coupon_code)
-        if not coupon:
-            return False
-        used_by = {**coupon.get('used_by', {}), user_id: get_actual_time()}
+    async def add_user_to_coupon(self, coupon_code: str, user_id: str, category: Optional[str] = None) -> bool:
+        # Single guarded update: the user must not have used the coupon yet and,
+        # if the coupon has a quota, it must not be exhausted (checked atomically)
         try:
-            result = self.collection.update_one(
-                {'uuid': coupon_code}, {'$set': {'used_by': used_by}})
+            used_at = get_actual_time()
+            result = await self.collection.update_one(
+                {
+                    'uuid': coupon_code,
+                    f'used_by.{user_id}': {'$exists': False},
+                    '$or': [
+                        {'max_redemptions': {'$exists': False}},
+                        {'max_redemptions': None},
+                        {'$expr': {'$lt': ['$redemption_count', '$max_redemptions']}}
+                    ]
+                },
+                {
+                    '$set': {f'used_by.{user_id}': used_at},
+                    '$inc': {'redemption_count': 1, 'version': 1}
+                })
+            if result.modified_count > 0:
+                await self._count_redemption(coupon_code, used_at[:10], category)
             return result.modified_count > 0
         except Exception as e:
             logger.error(
                 f"Error adding user '{user_id}' to coupon '{coupon_code}': {e}")
             return False
 
-    def add_item_to_rule(self, coupon_code: str, rule: str, item: str) -> bool:
+    async def remove_user_from_coupon(self, coupon_code: str, user_id: str, category: Optional[str] = None) -> bool:
+        # The redemption is discounted from the stats of the day it was counted (the previous used_by value)
+        try:
+            coupon = await self.collection.find_one_and_update(
+                {'uuid': coupon_code, f'used_by.{user_id}': {'$exists': True}},
+                {
+                    '$unset': {f'used_by.{user_id}': ''},
+                    '$inc': {'redemption_count': -1, 'version': 1}
+                },
+                projection={'_id': 0, f'used_by.{user_id}': 1})
+            if coupon:
+                await self._count_redemption(coupon_code, coupon['used_by'][user_id][:10], category, -1)
+            return coupon is not None
+        except Exception as e:
+            logger.error(
+                f"Error removing user '{user_id}' from coupon '{coupon_code}': {e}")
+            return False
+
+    async def add_item_to_rule(self, coupon_code: str, rule: str, item: str) -> bool:
         # verify rule
-        coupon = self.get(coupon_code)
+        coupon = await self.get(coupon_code)
         if not coupon or rule not in coupon or len(coupon[rule] or []) == 0:
             return False
         try:
-            result = self.collection.update_one(
-                {'uuid': coupon_code}, {'$push': {rule: item}})
+            result = await self.collection.update_one(
+                {'uuid': coupon_code}, {'$push': {rule: item}, '$inc': {'version': 1}})
             return result.modified_count > 0
         except Exception as e:
             logger.error(
                 f"Error adding item '{item}' to rule '{rule}' of coupon '{coupon_code}': {e}")
             return False
+
+    async def get_refund_coupons_versions(self, user_id: str) -> List[Dict]:
+        """
+        Same coupons as get_refund_coupons, only with what identifies their current state: {'uuid', 'version'}.
+        """
+        return await self.collection.find({
+            'uuid': {'$regex': f'^REFUND_{user_id}_'},
+            f'used_by.{user_id}': {'$exists': False}
+        }, {'_id': 0, 'uuid': 1, 'version': 1}).sort('uuid', ASCENDING).to_list(None)
+
+    async def get_redemption_stats(self, coupon_code: str, from_day: Optional[str] = None, to_day: Optional[str] = None) -> List[Dict]:
+        """
+        Redemptions of a coupon per day ('YYYY-MM-DD', both limits included), ordered by day:
+        [{'day', 'redemptions', 'categories': {category: redemptions}}]. Uses without a category are only in the total.
+        """
+        query = {'coupon': coupon_code}
+        if from_day or to_day:
+            query['day'] = {}
+            if from_day:
+                query['day']['$gte'] = from_day
+            if to_day:
+                query['day']['$lte'] = to_day
+        days = {}
+        async for counter in self.daily_stats.find(query, {'_id': 0}).sort('day', ASCENDING):
+            day = days.setdefault(counter['day'], {'day': counter['day'], 'redemptions': 0, 'categories': {}})
+            day['redemptions'] += counter['redemptions']
+            if counter.get('category') is not None:
+                day['categories'][counter['category']] = counter['redemptions']
+        return list(days.values())
+
+    async def get_used_by_size_stats(self) -> Dict:
+        """
+        Max and average number of users in 'used_by', over all the coupons.
+        """
+        stats = await (await self.collection.aggregate([
+            {'$project': {'size': {'$size': {'$objectToArray': {'$ifNull': ['$used_by', {}]}}}}},
+            {'$group': {'_id': None, 'max': {'$max': '$size'}, 'avg': {'$avg': '$size'}}}
+        ])).to_list(None)
+        return {'max': stats[0]['max'], 'avg': stats[0]['avg']} if stats else {'max': 0, 'avg': 0}
+
+
+class Coupons(SyncManager):
+    """
+    Synchronous interface of AsyncCoupons.
+    """
+    async_class = AsyncCoupons
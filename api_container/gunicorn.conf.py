@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+import shutil
+
+# Production server: gunicorn master with uvicorn workers, one event loop per worker.
+# Run with the following command (from the directory of payments_api.py):
+# gunicorn -c gunicorn.conf.py payments_api:app
+# Graceful restart of the workers (new code, new configuration): kill -HUP <master pid>
+# Environment:
+# - WEB_CONCURRENCY: number of workers (default: number of cores)
+# - SERVICES_API_PORT: listening port (default 9212)
+# - GUNICORN_PRELOAD: import the app once in the master before forking (default True)
+# - GUNICORN_TIMEOUT / GUNICORN_GRACEFUL_TIMEOUT / GUNICORN_KEEPALIVE: seconds
+# - GUNICORN_MAX_REQUESTS / GUNICORN_MAX_REQUESTS_JITTER: recycle workers after N requests (0 disables it)
+# - PROMETHEUS_MULTIPROC_DIR: where the workers write their metrics (default /tmp/payments_metrics)
+#
+# Preloading is safe: the shared Mongo clients do not connect before the first operation and
+# the lifespan (ping, indexes, cache warmup, background tasks) runs in each worker after the fork.
+# Every worker has its own in-process caches: the Stripe prices never change once created and the
+# mobile tokens cache evicts the users updated by other processes (AsyncMobileToken.sync_tokens_cache).
+# Balances are not cached in-process. The available coupons query is shared by the concurrent requests
+# of a worker for up to AVAILABLE_COUPONS_WINDOW seconds (AsyncCoupons.obtain_available_coupons).
+
+bind = f"0.0.0.0:{os.getenv('SERVICES_API_PORT') or 9212}"
+workers = int(os.getenv('WEB_CONCURRENCY') or multiprocessing.cpu_count())
+worker_class = 'uvicorn_worker.UvicornWorker'
+preload_app = (os.getenv('GUNICORN_PRELOAD') or 'True').lower() == 'true'
+timeout = int(os.getenv('GUNICORN_TIMEOUT') or 30)
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE') or 5)
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS') or 0)
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER') or 0)
+accesslog = '-'
+
+# Must be set before prometheus_client is imported (by the preloaded app or by the workers)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/payments_metrics')
+
+
+def on_starting(server):
+    # Samples of a previous run would be added to the new ones
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+    from lib.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -0,0 +1,127 @@
+from typing import Optional, Dict
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+import asyncio
+import datetime
+import logging as logger
+import os
+from lib.utils import get_actual_time, get_async_mongo_client, get_timestamp_after_seconds
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+DEFAULT_IDEMPOTENCY_KEY_TTL = 24 * 60 * 60  # Seconds
+LOCK_TIMEOUT = 60  # Seconds, after this an in progress request is considered dead and its key can be reused
+COMPLETE_RETRIES = 3  # A key left in progress after a successful request would let a retry run it again
+COMPLETE_RETRY_DELAY = 0.1  # Seconds, doubled on each attempt
+
+
+@instrument_manager('idempotency_keys')
+class AsyncIdempotencyKeys:
+    """
+    AsyncIdempotencyKeys class that stores the responses of the requests sent with an Idempotency-Key header.
+    A repeated request (same scope and key) gets the stored response instead of running again.
+    Keys are removed by a TTL index once expired.
+    Fields:
+    - scope: str -> Endpoint (and user) the key belongs to
+    - key: str -> Idempotency-Key header
+    - fingerprint: str -> Hash of the request body, a key can not be reused with another body
+    - status: str -> 'in_progress' | 'completed'
+    - status_code: int (optional)
+    - response: Dict (optional)
+    - locked_at: datetime -> Start of the request that owns the key
+    - expires_at: Date (BSON date, needed by the TTL index)
+    - created_at: datetime
+    (scope, key) is unique
+    """
+
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
+        if test_client:
+            self.db = self.client[os.getenv('MONGO_TEST_DB')]
+        else:
+            self.db = self.client[test_db or os.getenv('MONGO_DB')]
+        self.collection = self.db['idempotency_keys']
+        self.ttl = int(os.getenv('IDEMPOTENCY_KEY_TTL') or DEFAULT_IDEMPOTENCY_KEY_TTL)
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
+
+    async def _check_connection(self):
+        try:
+            await self.client.admin.command('ping')
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    async def _create_collection(self):
+        await self.collection.create_index([('scope', ASCENDING), ('key', ASCENDING)], unique=True)
+        await self.collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+
+    async def begin(self, scope: str, key: str, fingerprint: str) -> Optional[Dict]:
+        """
+        Takes the key for a new request. Returns None if the caller owns the key and must run the request,
+        otherwise the stored document (completed, in progress or with another fingerprint).
+        """
+        actual_time = get_actual_time()
+        try:
+            await self.collection.insert_one({
+                'scope': scope,
+                'key': key,
+                'fingerprint': fingerprint,
+                'status': IN_PROGRESS,
+                'locked_at': actual_time,
+                'expires_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl),
+                'created_at': actual_time
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+
+        stored = await self.collection.find_one({'scope': scope, 'key': key}, {'_id': 0})
+        if not stored:
+            return await self.begin(scope, key, fingerprint)  # Expired meanwhile
+        if stored['status'] == IN_PROGRESS and stored['locked_at'] < get_timestamp_after_seconds(-LOCK_TIMEOUT):
+            # The owner died before completing the request, only one retry takes over
+            result = await self.collection.update_one(
+                {'scope': scope, 'key': key, 'status': IN_PROGRESS, 'locked_at': stored['locked_at']},
+                {'$set': {'fingerprint': fingerprint, 'locked_at': actual_time}})
+            if result.modified_count:
+                return None
+        return stored
+
+    async def complete(self, scope: str, key: str, status_code: int, response: Dict) -> None:
+        """
+        Stores the response of the request. Retried on errors (the update is idempotent), raises the last one.
+        """
+        for attempt in range(COMPLETE_RETRIES):
+            try:
+                await self.collection.update_one({'scope': scope, 'key': key}, {'$set': {
+                    'status': COMPLETED,
+                    'status_code': status_code,
+                    'response': response
+                }})
+                return
+            except PyMongoError as e:
+                if attempt == COMPLETE_RETRIES - 1:
+                    raise
+                logger.warning(f"Failed to complete the idempotency key {key}, retrying: {e}")
+                await asyncio.sleep(COMPLETE_RETRY_DELAY * 2 ** attempt)
+
+    async def release(self, scope: str, key: str) -> None:
+        """
+        Frees the key of a request that failed, so it can be retried.
+        """
+        await self.collection.delete_one({'scope': scope, 'key': key, 'status': IN_PROGRESS})
+
+
+class IdempotencyKeys(SyncManager):
+    """
+    Synchronous interface of AsyncIdempotencyKeys.
+    """
+    async_class = AsyncIdempotencyKeys
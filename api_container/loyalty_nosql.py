@@ -1,4 +1,4 @@
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Union
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from pymongo import ASCENDING
@@ -7,7 +7,9 @@ import logging as logger
 import os
 import sys
 import uuid
-from lib.utils import get_actual_time, get_mongo_client, get_timestamp_after_days
+from lib.utils import get_actual_time, get_async_mongo_client, get_timestamp_after_days
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
 
 HOUR = 60 * 60
 MINUTE = 60
@@ -17,48 +19,89 @@ EXPIRATION_TIME = 2 * 365 # 2 years
 
 EXPIRED_POINTS_MESSAGE = "Expired points"
 
+POINTS_UPDATE_RETRIES = 5  # Conditional updates that lost against a concurrent change of the points
+
+DAILY_STATS_COUNTERS = ('points_issued', 'points_redeemed', 'points_restored', 'points_expired', 'client_payments', 'client_cash', 'provider_cash', 'coupons_used')
+
+
+def daily_stats_counters(entry: Dict) -> Dict[str, Union[int, float]]:
+    """
+    Counters of the daily rollups that a history entry adds to.
+    """
+    if entry.get('points') is not None:
+        if entry.get('restored'):  # Given back by restore_points, not new points
+            return {'points_restored': entry['points']}
+        if entry['points'] > 0:
+            return {'points_issued': entry['points']}
+        if entry['description'] == EXPIRED_POINTS_MESSAGE:
+            return {'points_expired': -entry['points']}
+        return {'points_redeemed': -entry['points']}
+    if entry.get('cash') is not None:
+        if entry['cash'] < 0:  # Paid by a client
+            return {'client_payments': 1, 'client_cash': -entry['cash']}
+        return {'provider_cash': entry['cash']}
+    if entry.get('coupon_id') is not None:
+        return {'coupons_used': 1}
+    return {}
+
+
 # TODO: (General) -> Create tests for each method && add the required checks in each method
-class Loyalty:
+@instrument_manager('loyalty')
+class AsyncLoyalty:
     """
-    Loyalty class that stores data in a MongoDB collection.
+    AsyncLoyalty class that stores data in a MongoDB collection.
     Fields:
     - id: str (unique) (user id)
     - points: List[Tuple[str, str]] -> List of tuples with the following structure: (expiration timestamp, points)
     - created_at: datetime
     - updated_at: datetime
     - history: List[Dict[str, str]] -> List of transactions that the user made. It has the following keys: {'points' || 'cash' || 'coupon_id', 'timestamp', 'description'}
+    - version: int -> Incremented by every change of the document (ETags of the points and history endpoints)
+    Every new history entry is also added to the daily rollups (loyalty_daily_stats collection):
+    - day: str (unique) -> 'YYYY-MM-DD' of the entry timestamp (of the expiration for expired points)
+    - points_issued, points_redeemed, points_expired: int | float
+    - points_restored: int | float -> Redeemed points given back by restore_points (not counted as issued)
+    - client_payments: int, client_cash: int -> Payments registered with register_client_payment(s) and their total
+    - provider_cash: int -> Total paid to providers
+    - coupons_used: int
     """
 
-    def __init__(self, test_client=None, test_db=None):
-        self.client = test_client or get_mongo_client()
-        if not self._check_connection():
-            raise Exception("Failed to connect to MongoDB")
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
         if test_client:
             self.db = self.client[os.getenv('MONGO_TEST_DB')]
         else:
             self.db = self.client[test_db or os.getenv('MONGO_DB')]
         self.collection = self.db['loyalty']
-        self._create_collection()
+        self.daily_stats = self.db['loyalty_daily_stats']
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
     
-    def _check_connection(self):
+    async def _check_connection(self):
         try:
-            self.client.admin.command('ping')
+            await self.client.admin.command('ping')
         except Exception as e:
             logger.error(e)
             return False
         return True
 
-    def _create_collection(self):
-        self.collection.create_index([('uuid', ASCENDING)], unique=True)
+    async def _create_collection(self):
+        await self.collection.create_index([('uuid', ASCENDING)], unique=True)
+        await self.collection.create_index([('history.event_id', ASCENDING)], sparse=True)
+        await self.daily_stats.create_index([('day', ASCENDING)], unique=True)
     
-    def _create_user_doc(self, user_id: str) -> bool:
+    async def _create_user_doc(self, user_id: str) -> bool:
         try:
-            self.collection.insert_one({
+            await self.collection.insert_one({
                 'uuid': user_id,
                 'points': [],
                 'created_at': get_actual_time(),
                 'updated_at': get_actual_time(),
-                'history': []
+                'history': [],
+                'version': 0
             })
             return True
         except DuplicateKeyError as e:
@@ -68,113 +111,314 @@ class Loyalty:
             logger.error(f"OperationFailure: {e}")
             return False
     
-    def _update_doc(self, user_id: str, data: Dict) -> bool:
+    async def _push_history(self, user_id: str, entries: List[Dict], new_points: Optional[List] = None) -> bool:
+        """
+        Appends history entries (and new points) with $push, so concurrent changes of the same user are never overwritten.
+        """
+        update = {'$push': {'history': {'$each': entries}}, '$set': {'updated_at': get_actual_time()}, '$inc': {'version': 1}}
+        if new_points:
+            update['$push']['points'] = {'$each': [list(points) for points in new_points]}
         try:
-            self.collection.update_one({'uuid': user_id}, {'$set': data})
-            return True
+            result = await self.collection.update_one({'uuid': user_id}, update)
         except Exception as e:
             logger.error(f"Error updating user with uuid '{user_id}': {e}")
             return False
+        if not result.matched_count:
+            return False
+        await self.record_daily_stats(entries)
+        return True
 
-        
-    def _update_user_doc(self, user_id: str) -> bool:
-        user = self.collection.find_one({'uuid': user_id})
-        if not user:
-            return True
-        
-        expired_points = [(expiration_date, points) for expiration_date, points in user['points'] if expiration_date <= get_actual_time()]
-        for expiration_date, saved_points in expired_points:
-            user['history'].append({'points': -saved_points, 'timestamp': expiration_date, 'description': EXPIRED_POINTS_MESSAGE})
-        user['points'] = [(expiration_date, points) for expiration_date, points in user['points'] if expiration_date > get_actual_time()]
-        user['updated_at'] = get_actual_time()
+    async def _update_user_doc(self, user_id: str) -> bool:
+        """
+        Moves the expired points to the history, with an update conditional on the points that were read
+        (as use_points): when concurrent reads see the same expired points, only one of them records them.
+        """
+        for _ in range(POINTS_UPDATE_RETRIES):
+            user = await self.collection.find_one({'uuid': user_id}, {'_id': 0, 'points': 1})
+            if not user:
+                return True
 
-        return self._update_doc(user_id, user)
+            actual_time = get_actual_time()
+            expired_points = [(expiration_date, points) for expiration_date, points in user['points'] if expiration_date <= actual_time]
+            if not expired_points:
+                return True
+            history = [{'points': -saved_points, 'timestamp': expiration_date, 'description': EXPIRED_POINTS_MESSAGE}
+                       for expiration_date, saved_points in expired_points]
 
-    def add_transaction(self, user_id: str, points: int, description: str) -> bool:
+            try:
+                result = await self.collection.update_one({'uuid': user_id, 'points': user['points']}, {
+                    '$set': {'points': [points for points in user['points'] if points[0] > actual_time], 'updated_at': actual_time},
+                    '$push': {'history': {'$each': history}},
+                    '$inc': {'version': 1}
+                })
+            except Exception as e:
+                logger.error(f"Error updating user with uuid '{user_id}': {e}")
+                return False
+            if result.modified_count:
+                await self.record_daily_stats(history)
+                return True
+        logger.error(f"Could not expire the points of user '{user_id}': concurrent updates")
+        return False
+
+    async def record_daily_stats(self, entries: List[Dict]) -> None:
+        """
+        Adds new history entries to the daily rollups, with one upsert per day.
+        Never called inside a transaction: every change of a day hits the same document, a write conflict
+        there would abort the transaction. A failure is only logged, the rollups can be rebuilt from
+        the history (rebuild_daily_stats).
+        """
+        days = {}
+        for entry in entries:
+            counters = days.setdefault(entry['timestamp'][:10], {})
+            for counter, value in daily_stats_counters(entry).items():
+                counters[counter] = counters.get(counter, 0) + value
+        for day, counters in days.items():
+            if not counters:
+                continue
+            try:
+                await self.daily_stats.update_one({'day': day}, {'$inc': counters}, upsert=True)
+            except Exception as e:
+                logger.error(f"Error updating the loyalty stats of {day}: {e}")
+
+    async def add_transaction(self, user_id: str, points: int, description: str) -> bool:
         if points == 0:
             return False
-        if not self.collection.find_one({'uuid': user_id}) and not self._create_user_doc(user_id):
+        if points < 0:
+            # Same conditional update as use_points, a concurrent change is never overwritten
+            return bool(await self.use_points(user_id, -points, description))
+        if not await self.collection.find_one({'uuid': user_id}) and not await self._create_user_doc(user_id):
             return False
 
-        if not self._update_user_doc(user_id):
+        if not await self._update_user_doc(user_id):
             return False
-        user = self.collection.find_one({'uuid': user_id})
-        
-        success = True
-        if points > 0:
-            user['points'].append((get_timestamp_after_days(EXPIRATION_TIME), points))
-        elif sum([points for _, points in user['points']]) >= abs(points):
-            sorted_points = sorted(user['points'], key=lambda x: x[0])
-            to_delete = abs(points)
-            for i, (expiration_date, saved_points) in enumerate(sorted_points):
-                if saved_points >= to_delete:
-                    sorted_points[i] = (expiration_date, saved_points - to_delete)
+        return await self._push_history(user_id, [{'points': points, 'timestamp': get_actual_time(), 'description': description}],
+                                        new_points=[(get_timestamp_after_days(EXPIRATION_TIME), points)])
+
+    async def restore_points(self, user_id: str, used_points: List, description: str) -> bool:
+        """
+        Gives back the points returned by use_points, with their original expiration dates.
+        """
+        entry = {'points': sum(points for _, points in used_points), 'timestamp': get_actual_time(), 'description': description,
+                 'restored': True}
+        return await self._push_history(user_id, [entry], new_points=used_points)
+    
+    async def use_points(self, user_id: str, points: int, description: str, session=None,
+                         deferred_stats: Optional[List] = None) -> Union[List, bool, None]:
+        """
+        Deducts the points (the ones expiring first are used first) in a single conditional update:
+        it only applies if the points did not change since they were read, otherwise it is retried.
+        Expired points are moved to the history in the same update.
+        Returns the deducted points [(expiration date, points)] (see restore_points), False if the user
+        does not have enough points and None if the update kept losing against concurrent changes.
+        With a session the new history entries are appended to deferred_stats instead of the daily rollups,
+        the caller records them (record_daily_stats) once the transaction is committed.
+        """
+        for _ in range(POINTS_UPDATE_RETRIES):
+            user = await self.collection.find_one({'uuid': user_id}, {'_id': 0, 'points': 1}, session=session)
+            if not user:
+                return False
+
+            actual_time = get_actual_time()
+            history = [{'points': -saved_points, 'timestamp': expiration_date, 'description': EXPIRED_POINTS_MESSAGE}
+                       for expiration_date, saved_points in user['points'] if expiration_date <= actual_time]
+            remaining = sorted([(expiration_date, saved_points) for expiration_date, saved_points in user['points']
+                                if expiration_date > actual_time], key=lambda x: x[0])
+            if sum([saved_points for _, saved_points in remaining]) < points:
+                return False
+
+            to_delete, used_points = points, []
+            for i, (expiration_date, saved_points) in enumerate(remaining):
+                used = min(saved_points, to_delete)
+                remaining[i] = (expiration_date, saved_points - used)
+                used_points.append((expiration_date, used))
+                to_delete -= used
+                if to_delete <= 0:
                     break
-                to_delete -= saved_points
-                sorted_points[i] = (expiration_date, 0)
-            user['points'] = [(expiration_date, points) for expiration_date, points in sorted_points if points > 0]
-        else: # Not enough points
-            return False
+            history.append({'points': -points, 'timestamp': actual_time, 'description': description})
 
-        if success:
-            user['history'].append({'points': points, 'timestamp': get_actual_time(), 'description': description})
+            result = await self.collection.update_one({'uuid': user_id, 'points': user['points']}, {
+                '$set': {'points': [(expiration_date, saved_points) for expiration_date, saved_points in remaining if saved_points > 0],
+                         'updated_at': actual_time},
+                '$push': {'history': {'$each': history}},
+                '$inc': {'version': 1}
+            }, session=session)
+            if result.modified_count:
+                if session is None:
+                    await self.record_daily_stats(history)
+                elif deferred_stats is not None:
+                    deferred_stats.extend(history)
+                return used_points
+        logger.error(f"Could not deduct {points} points of user '{user_id}': concurrent updates")
+        return None
 
-        try:
-            self.collection.update_one({'uuid': user_id}, {'$set': user})
-            return success
-        except Exception as e:
-            logger.error(f"Error updating user with uuid '{user_id}': {e}")
-            return False
-    
-    def get_total_points(self, user_id: str) -> int:
-        user = self.collection.find_one({'uuid': user_id})
+    async def get_total_points(self, user_id: str) -> int:
+        user = await self.collection.find_one({'uuid': user_id})
         if not user:
             return None
-        self._update_user_doc(user_id)
+        await self._update_user_doc(user_id)
         return sum([points for expiration_date, points in user['points'] if expiration_date > get_actual_time()])
     
-    def get_history(self, user_id: str) -> List[Dict]:
-        user = self.collection.find_one({'uuid': user_id})
+    async def get_version(self, user_id: str) -> Optional[Dict]:
+        """
+        Cheap lookup of what identifies the current state of the user's points and history: {'created_at', 'version'}.
+        Points that expired since the last change are moved to the history first, so the version covers them.
+        """
+        user = await self.collection.find_one({'uuid': user_id}, {'_id': 0, 'created_at': 1, 'version': 1, 'points': 1})
+        if not user:
+            return None
+        if any(expiration_date <= get_actual_time() for expiration_date, _ in user['points']):
+            await self._update_user_doc(user_id)
+            user = await self.collection.find_one({'uuid': user_id}, {'_id': 0, 'created_at': 1, 'version': 1})
+            if not user:
+                return None
+        return {'created_at': user['created_at'], 'version': user.get('version', 0)}
+
+    async def get_history(self, user_id: str) -> List[Dict]:
+        user = await self.collection.find_one({'uuid': user_id})
         if not user:
             return None
-        self._update_user_doc(user_id)
+        await self._update_user_doc(user_id)
         return sorted(user['history'], key=lambda x: x['timestamp'], reverse=True)
     
-    def get_expiring_points(self, user_id: str) -> List[Dict]:
-        user = self.collection.find_one({'uuid': user_id})
+    async def get_history_size_stats(self) -> Dict:
+        """
+        Max and average number of history entries, over all the users.
+        """
+        stats = await (await self.collection.aggregate([
+            {'$project': {'size': {'$size': {'$ifNull': ['$history', []]}}}},
+            {'$group': {'_id': None, 'max': {'$max': '$size'}, 'avg': {'$avg': '$size'}}}
+        ])).to_list(None)
+        return {'max': stats[0]['max'], 'avg': stats[0]['avg']} if stats else {'max': 0, 'avg': 0}
+
+    async def get_daily_stats(self, from_day: Optional[str] = None, to_day: Optional[str] = None) -> List[Dict]:
+        """
+        Daily rollups between two days ('YYYY-MM-DD', both included), ordered by day.
+        """
+        days = {}
+        if from_day:
+            days['$gte'] = from_day
+        if to_day:
+            days['$lte'] = to_day
+        stats = await self.daily_stats.find({'day': days} if days else {}, {'_id': 0}).sort('day', ASCENDING).to_list(None)
+        return [{'day': day['day'], **{counter: day.get(counter, 0) for counter in DAILY_STATS_COUNTERS}} for day in stats]
+
+    async def rebuild_daily_stats(self) -> int:
+        """
+        Recomputes the daily rollups from the history of every user (full collection scan).
+        Meant to backfill the rollups or to fix them after a failed update, with the writes stopped.
+        Returns the number of days.
+        """
+        days = {}
+        async for user in self.collection.find({}, {'_id': 0, 'history': 1}):
+            for entry in user.get('history') or []:
+                counters = days.setdefault(entry['timestamp'][:10], dict.fromkeys(DAILY_STATS_COUNTERS, 0))
+                for counter, value in daily_stats_counters(entry).items():
+                    counters[counter] += value
+        await self.daily_stats.delete_many({})
+        if days:
+            await self.daily_stats.insert_many([{'day': day, **counters} for day, counters in days.items()])
+        return len(days)
+
+    async def get_expiring_points(self, user_id: str) -> List[Dict]:
+        user = await self.collection.find_one({'uuid': user_id})
         if not user:
             return None
-        self._update_user_doc(user_id)
+        await self._update_user_doc(user_id)
         return sorted([{'points': points, 'expiration_date': expiration_date} for expiration_date, points in user['points'] if expiration_date > get_actual_time()], key=lambda x: x['expiration_date'])
     
-    def _register_cash_transaction(self, user_id: str, cash: int, description: str) -> bool:
-        user = self.collection.find_one({'uuid': user_id})
-        if not user:
-            return False
-        user['history'].append({'cash': cash, 'timestamp': get_actual_time(), 'description': description})
-        return self._update_doc(user_id, user)
+    async def _register_cash_transaction(self, user_id: str, cash: int, description: str) -> bool:
+        return await self._push_history(user_id, [{'cash': cash, 'timestamp': get_actual_time(), 'description': description}])
     
-    def register_client_payment(self, user_id: str, cash: int, description: str) -> bool:
+    async def register_client_payment(self, user_id: str, cash: int, description: str) -> bool:
         if cash <= 0:
             return False
-        if not self.collection.find_one({'uuid': user_id}) and not self._create_user_doc(user_id):
+        if not await self.collection.find_one({'uuid': user_id}) and not await self._create_user_doc(user_id):
             return False
-        if not self._update_user_doc(user_id):
+        if not await self._update_user_doc(user_id):
             return False
         
-        return self._register_cash_transaction(user_id, -cash, description)
-        
-    def register_payment_to_provider(self, provider_id: str, cash: int, description: str) -> bool:
+        return await self._register_cash_transaction(user_id, -cash, description)
+
+    async def register_client_payments(self, payments: List[Dict]) -> int:
+        """
+        Registers a batch of client payments, each one a dict with the keys {'user_id', 'cash', 'description', 'event_id'}.
+        The event_id is saved in the history entry, so a payment is never registered twice.
+        Returns the number of registered payments. Raises if the batch could not be fully registered,
+        so the caller keeps it for a retry (the registered payments are skipped then).
+        """
+        payments = [payment for payment in payments if payment['cash'] > 0]
+        if not payments:
+            return 0
+        user_ids = list({payment['user_id'] for payment in payments})
+        event_ids = [payment['event_id'] for payment in payments]
+
+        existing = await self.collection.find(
+            {'uuid': {'$in': user_ids}}, {'_id': 0, 'uuid': 1}).to_list(None)
+        existing = {user['uuid'] for user in existing}
+        for user_id in user_ids:
+            if user_id not in existing and not await self._create_user_doc(user_id):
+                # Created by a concurrent request
+                if not await self.collection.find_one({'uuid': user_id}, {'_id': 1}):
+                    raise Exception(f"Failed to create the loyalty document of user '{user_id}'")
+
+        applied = await self.collection.find(
+            {'uuid': {'$in': user_ids}, 'history.event_id': {'$in': event_ids}},
+            {'_id': 0, 'history.event_id': 1}
+        ).to_list(None)
+        applied = {entry.get('event_id') for user in applied for entry in user['history']}
+
+        by_user = {}
+        for payment in payments:
+            if payment['event_id'] in applied:
+                continue
+            applied.add(payment['event_id'])
+            by_user.setdefault(payment['user_id'], []).append({
+                'cash': -payment['cash'],
+                'timestamp': get_actual_time(),
+                'description': payment['description'],
+                'event_id': payment['event_id']
+            })
+
+        registered = 0
+        for user_id, entries in by_user.items():
+            for _ in range(POINTS_UPDATE_RETRIES):
+                # The event ids in the filter guard against a concurrent batch with the same events
+                result = await self.collection.update_one(
+                    {'uuid': user_id, 'history.event_id': {'$nin': [entry['event_id'] for entry in entries]}},
+                    {'$push': {'history': {'$each': entries}}, '$set': {'updated_at': get_actual_time()}, '$inc': {'version': 1}}
+                )
+                if result.modified_count:
+                    registered += len(entries)
+                    await self.record_daily_stats(entries)
+                    break
+                # Some of the events were registered meanwhile, only the rest are pushed
+                user = await self.collection.find_one({'uuid': user_id}, {'_id': 0, 'history.event_id': 1})
+                if not user:
+                    raise Exception(f"Loyalty document of user '{user_id}' not found")
+                applied = {entry.get('event_id') for entry in user['history']}
+                entries = [entry for entry in entries if entry['event_id'] not in applied]
+                if not entries:
+                    break
+            else:
+                raise Exception(f"Could not register the payments of user '{user_id}': concurrent updates")
+        return registered
+
+    async def register_payment_to_provider(self, provider_id: str, cash: int, description: str) -> bool:
         if cash <= 0:
             return False
-        if not self.collection.find_one({'uuid': provider_id}) and not self._create_user_doc(provider_id):
+        if not await self.collection.find_one({'uuid': provider_id}) and not await self._create_user_doc(provider_id):
             return False
         
-        return self._register_cash_transaction(provider_id, cash, description)
+        return await self._register_cash_transaction(provider_id, cash, description)
         
-    def register_coupon_use(self, user_id: str, coupon_id: str, description: str) -> bool:
-        if not self.collection.find_one({'uuid': user_id}) and not self._create_user_doc(user_id):
+    async def register_coupon_use(self, user_id: str, coupon_id: str, description: str) -> bool:
+        if not await self.collection.find_one({'uuid': user_id}) and not await self._create_user_doc(user_id):
             return False
-        user = self.collection.find_one({'uuid': user_id})
-        user['history'].append({'coupon_id': coupon_id, 'timestamp': get_actual_time(), 'description': description})
-        return self._update_doc(user_id, user)
\ No newline at end of file
+        return await self._push_history(user_id, [{'coupon_id': coupon_id, 'timestamp': get_actual_time(), 'description': description}])
+
+
+class Loyalty(SyncManager):
+    """
+    Synchronous interface of AsyncLoyalty.
+    """
+    async_class = AsyncLoyalty
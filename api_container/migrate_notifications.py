@@ -0,0 +1,24 @@
+import asyncio
+import logging
+import os
+import sys
+
+# One-off migration of the notifications written before they were stored newest first
+# (see AsyncMobileToken.migrate_notifications). It can be run again, migrated documents are skipped.
+# Run with the following command (in the api container, with the same environment as the API):
+# python migrate_notifications.py
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mobile_token_nosql import AsyncMobileToken
+
+logging.getLogger().setLevel(logging.INFO)
+
+
+async def main():
+    manager = AsyncMobileToken()
+    migrated = await manager.migrate_notifications()
+    logging.info(f"Migrated the notifications of {migrated} users to newest first")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
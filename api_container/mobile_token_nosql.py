@@ -6,134 +6,238 @@ from pymongo.errors import DuplicateKeyError, OperationFailure
 import logging as logger
 import os
 import sys
+import time
 import uuid
-from firebase_admin import messaging
-from lib.utils import get_actual_time, get_mongo_client
+from lib.utils import get_actual_time, get_async_mongo_client, get_timestamp_after_seconds, LRUCache
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
 
 HOUR = 60 * 60
 MINUTE = 60
 MILLISECOND = 1_000
 
+DEFAULT_NOTIFICATIONS_RETENTION = 200
+
+TOKEN_CACHE_SIZE = 100_000
+TOKEN_CACHE_TTL = 10 * MINUTE
+TOKEN_CACHE_SYNC_INTERVAL = float(os.getenv('TOKEN_CACHE_SYNC_INTERVAL') or 1)  # Seconds
+CLOCK_SKEW_MARGIN = 5  # Seconds, writers (other workers and services) stamp updated_at with their own clock
+LOOKUP_CHUNK_SIZE = 10_000  # Max ids per $in query
+NOT_CACHED = object()  # Cached users without a token are cached as None
+
 # TODO: (General) -> Create tests for each method && add the required checks in each method
 
-class MobileToken:
+@instrument_manager('mobile_token')
+class AsyncMobileToken:
     """
-    MobileToken class that stores data in a MongoDB collection.
+    AsyncMobileToken class that stores data in a MongoDB collection.
     Fields:
     - user_id: str (unique) [pk]
     - mobile_token: str: The mobile token of the user
     - created_at: int: The timestamp of the creation of the mobile token
     - updated_at: int: The timestamp of the last update of the mobile token
+    Notifications are stored in a separate collection, one document per user:
+    - user_id: str (unique) [pk]
+    - notifications: List[Dict] -> Newest first, capped at NOTIFICATIONS_RETENTION entries. Keys: {'title', 'message', 'created_at'}
+    - unread_count: int
+    - total_count: int -> Number of notifications ever received
+    - last_read_at: datetime (optional)
+    - newest_first: bool -> Set on the documents created (or migrated) since the array is stored newest first
     """
 
-    def __init__(self, test_client=None, test_db=None):
-        self.client = test_client or get_mongo_client()
-        if not self._check_connection():
-            raise Exception("Failed to connect to MongoDB")
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
         if test_client:
             self.db = self.client[os.getenv('MONGO_TEST_DB')]
         else:
             self.db = self.client[test_db or os.getenv('MONGO_DB')]
         self.collection = self.db['chats']
         self.notifications = self.db['notifications']
-        self._create_collection()
+        self.notifications_retention = int(os.getenv('NOTIFICATIONS_RETENTION') or DEFAULT_NOTIFICATIONS_RETENTION)
+        # user_id -> mobile token (None if the user has no token)
+        self.tokens_cache = LRUCache(TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+        # The cache is kept coherent with the writes of other processes through the updated_at stamps
+        self.tokens_synced_at = time.time()
+        self.tokens_checked_at = time.monotonic()
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
     
-    def _check_connection(self):
+    async def _check_connection(self):
         try:
-            self.client.admin.command('ping')
+            await self.client.admin.command('ping')
         except Exception as e:
             logger.error(e)
             return False
         return True
 
-    def _create_collection(self):
+    async def _create_collection(self):
         try:
-            self.collection.create_index([('user_id', ASCENDING)], unique=True)
-            self.notifications.create_index([('user_id', ASCENDING)], unique=True)
+            await self.collection.create_index([('user_id', ASCENDING)], unique=True)
+            await self.collection.create_index([('mobile_token', ASCENDING)])
+            await self.collection.create_index([('updated_at', ASCENDING)])
+            await self.notifications.create_index([('user_id', ASCENDING)], unique=True)
         except DuplicateKeyError:
             logger.warning("Index on 'user_id' already exists.")
+
+    async def migrate_notifications(self) -> int:
+        """
+        Documents written before the notifications were stored newest first are oldest first and have no total_count
+        (or only counts the notifications pushed since). Sorts them newest first and backfills total_count.
+        The update is conditional on total_count, a notification saved meanwhile leaves the document for the next run.
+        Scans the whole collection, it is run once by migrate_notifications.py (not on startup).
+        Returns the number of migrated documents.
+        """
+        migrated = 0
+        async for doc in self.notifications.find({'newest_first': {'$exists': False}}, {'_id': 1, 'notifications': 1, 'total_count': 1}):
+            notifications = doc.get('notifications') or []
+            result = await self.notifications.update_one({'_id': doc['_id'], 'total_count': doc.get('total_count')}, {'$set': {
+                'notifications': sorted(notifications, key=lambda n: n['created_at'], reverse=True)[:self.notifications_retention],
+                'total_count': max(doc.get('total_count') or 0, len(notifications)),
+                'newest_first': True
+            }})
+            migrated += result.modified_count
+        return migrated
             
-    def _get_user_notifications(self, user_id: str) -> Optional[Dict]:
-        notifications = self.notifications.find_one({'user_id': user_id})
+    async def _get_user_notifications(self, user_id: str) -> Optional[Dict]:
+        notifications = await self.notifications.find_one({'user_id': user_id})
         return notifications or None
-    
-    def _add_user_to_notifications(self, user_id: str):
+
+    async def _save_notification(self, user_id: str, title: str, message: str):
+        # Newest notifications first, only the last 'notifications_retention' are kept
         actual_time = get_actual_time()
-        try:
-            self.notifications.insert_one({
-                'user_id': user_id,
-                'notifications': [],
-                'created_at': actual_time,
-                'updated_at': actual_time
-            })
-        except DuplicateKeyError:
-            logger.warning(f"User {user_id} already exists in notifications.")
-            
-    def _save_notification(self, user_id: str, title: str, message: str):
-        notifications = self._get_user_notifications(user_id)
-        if not notifications:
-            self._add_user_to_notifications(user_id)
-            notifications = self._get_user_notifications(user_id)
+        await self.notifications.update_one({'user_id': user_id}, {
+            '$push': {
+                'notifications': {
+                    '$each': [{
+                        'title': title,
+                        'message': message,
+                        'created_at': actual_time
+                    }],
+                    '$position': 0,
+                    '$slice': self.notifications_retention
+                }
+            },
+            '$inc': {'unread_count': 1, 'total_count': 1},
+            '$set': {'updated_at': actual_time},
+            '$setOnInsert': {'created_at': actual_time, 'newest_first': True}
+        }, upsert=True)
+
+    async def get_notifications(self, user_id: str, page: int = 0, page_size: int = 20) -> Dict:
+        """
+        Returns a page of the user notifications (newest first) and the unread count.
+        Only the requested page is loaded from the database.
+        """
+        notifications = await self.notifications.find_one({'user_id': user_id}, {
+            '_id': 0,
+            'notifications': {'$slice': [page * page_size, page_size]},
+            'unread_count': 1,
+            'total_count': 1
+        }) or {}
+        total = min(notifications.get('total_count', 0), self.notifications_retention)
+        return {
+            'notifications': notifications.get('notifications', []),
+            'unread_count': min(notifications.get('unread_count', 0), total),
+            'total': total
+        }
+
+    async def mark_notifications_as_read(self, user_id: str) -> bool:
         actual_time = get_actual_time()
-        notifications['notifications'].append({
-            'title': title,
-            'message': message,
-            'created_at': actual_time
-        })
-        self.notifications.update_one({'user_id': user_id}, {
+        result = await self.notifications.update_one({'user_id': user_id}, {
             '$set': {
-                'notifications': notifications['notifications'],
+                'unread_count': 0,
+                'last_read_at': actual_time,
                 'updated_at': actual_time
             }
         })
-        
-    # def get_notifications(self, user_id: str, delete: bool = False) -> List[Dict]:
-    #     notifications = self._get_user_notifications(user_id)
-    #     if not notifications:
-    #         return []
-    #     if delete:
-    #         self.notifications.update_one({'user_id': user_id}, {
-    #             '$set': {
-    #                 'notifications': [],
-    #                 'updated_at': get_actual_time()
-    #             }
-    #         })
-    #     return notifications['notifications']
-
-    def update_mobile_token(self, user_id: str, mobile_token: str):
+        return result.matched_count > 0
+
+    async def update_mobile_token(self, user_id: str, mobile_token: str):
         actual_time = get_actual_time()
-        if not self.collection.find_one({'user_id': user_id}):
-            self.collection.insert_one({
-                'user_id': user_id,
-                'mobile_token': mobile_token,
-                'created_at': actual_time,
-                'updated_at': actual_time
-            })
-            return
-        self.collection.update_one({'user_id': user_id}, {
+        await self.collection.update_one({'user_id': user_id}, {
             '$set': {
                 'mobile_token': mobile_token,
                 'updated_at': actual_time
-            }
-        })
+            },
+            '$setOnInsert': {'created_at': actual_time}
+        }, upsert=True)
+        self.tokens_cache.set(user_id, mobile_token)
 
-    def get_mobile_token(self, user_id: str) -> Optional[str]:
-        mobile_token = self.collection.find_one({'user_id': user_id}) or {}
-        return mobile_token.get('mobile_token')
-    
-def send_notification(mobile_token_manager: MobileToken, user_id: str, title: str, message: str):
-    mobile_token_manager._save_notification(user_id, title, message)
-    
-    ## Uncomment the following lines to send notifications using Firebase
-    # token = mobile_token_manager.get_mobile_token(user_id)
-    # if not token:
-    #     logger.error(f"Failed to send notification to user {user_id}: No mobile token found")
-    #     return
-    # message = messaging.Message(
-    #                 notification=messaging.Notification(
-    #                     title=title,
-    #                     body=message,
-    #                 ),
-    #                 token=token
-    #             )
-    # messaging.send(message)
\ No newline at end of file
+    async def sync_tokens_cache(self) -> int:
+        """
+        Evicts the cached users whose token changed since the last sync, in this or any other process.
+        Runs at most once per TOKEN_CACHE_SYNC_INTERVAL. Returns the number of changed users.
+        """
+        if time.monotonic() - self.tokens_checked_at < TOKEN_CACHE_SYNC_INTERVAL:
+            return 0
+        self.tokens_checked_at = time.monotonic()
+        synced_at, self.tokens_synced_at = self.tokens_synced_at, time.time()
+        if not len(self.tokens_cache):
+            return 0
+
+        # updated_at has a resolution of one second and comes from the clock of the writer
+        since = get_timestamp_after_seconds(synced_at - time.time() - CLOCK_SKEW_MARGIN)
+        changed = await self.collection.find(
+            {'updated_at': {'$gte': since}}, {'_id': 0, 'user_id': 1}).limit(TOKEN_CACHE_SIZE + 1).to_list(None)
+        if len(changed) > TOKEN_CACHE_SIZE:
+            self.tokens_cache.clear()
+        else:
+            for doc in changed:
+                self.tokens_cache.delete(doc['user_id'])
+        return len(changed)
+
+    async def get_mobile_token(self, user_id: str) -> Optional[str]:
+        return (await self.get_mobile_tokens([user_id])).get(user_id)
+
+    async def get_mobile_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        """
+        Returns the mobile token of each user that has one ({'user_id': 'mobile_token'}).
+        Cached users are not queried, the rest are looked up with one $in query per chunk.
+        """
+        await self.sync_tokens_cache()
+        tokens, missing = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            # A single get: the entry could expire between a membership check and the read
+            token = self.tokens_cache.get(user_id, NOT_CACHED)
+            if token is NOT_CACHED:
+                missing.append(user_id)
+            else:
+                tokens[user_id] = token
+
+        for i in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+            chunk = missing[i:i + LOOKUP_CHUNK_SIZE]
+            docs = await self.collection.find(
+                {'user_id': {'$in': chunk}}, {'_id': 0, 'user_id': 1, 'mobile_token': 1}).to_list(None)
+            found = {doc['user_id']: doc.get('mobile_token') for doc in docs}
+            for user_id in chunk:
+                tokens[user_id] = found.get(user_id)
+                self.tokens_cache.set(user_id, found.get(user_id))
+
+        return {user_id: token for user_id, token in tokens.items() if token}
+
+    async def prune_mobile_tokens(self, mobile_tokens: List[str]) -> int:
+        """
+        Removes tokens reported as invalid by FCM. Returns the number of removed tokens.
+        """
+        mobile_tokens = list(set(mobile_tokens))
+        removed = 0
+        for i in range(0, len(mobile_tokens), LOOKUP_CHUNK_SIZE):
+            result = await self.collection.update_many(
+                {'mobile_token': {'$in': mobile_tokens[i:i + LOOKUP_CHUNK_SIZE]}},
+                {'$unset': {'mobile_token': ''}, '$set': {'updated_at': get_actual_time()}})
+            removed += result.modified_count
+
+        pruned = set(mobile_tokens)
+        for user_id, token in self.tokens_cache.items():
+            if token in pruned:
+                self.tokens_cache.delete(user_id)
+        return removed
+
+
+class MobileToken(SyncManager):
+    """
+    Synchronous interface of AsyncMobileToken.
+    """
+    async_class = AsyncMobileToken
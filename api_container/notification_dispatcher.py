@@ -0,0 +1,204 @@
+from typing import Optional, List, Dict, Tuple
+import asyncio
+import logging as logger
+import time
+from notification_outbox_nosql import AsyncNotificationOutbox
+from mobile_token_nosql import AsyncMobileToken
+from lib.utils import get_timestamp_after_seconds
+from lib.metrics import run_in_thread
+
+MAX_MULTICAST_TOKENS = 500  # FCM limit per multicast call
+STALE_CLAIM_SECONDS = 5 * 60
+
+
+class InvalidTokenError(Exception):
+    """
+    The mobile token is no longer valid (app uninstalled, token rotated...), retrying is useless.
+    """
+
+
+class FirebaseSender:
+    """
+    Sends push notifications using Firebase Cloud Messaging multicast messages.
+    """
+
+    def __init__(self):
+        import firebase_admin
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app()
+
+    def send_multicast(self, tokens: List[str], title: str, message: str) -> List[Tuple[bool, Optional[Exception]]]:
+        from firebase_admin import messaging
+        response = messaging.send_each_for_multicast(messaging.MulticastMessage(
+            notification=messaging.Notification(
+                title=title,
+                body=message,
+            ),
+            tokens=tokens
+        ))
+        invalid_token_errors = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+        return [(result.success, InvalidTokenError(str(result.exception)) if isinstance(result.exception, invalid_token_errors) else result.exception)
+                for result in response.responses]
+
+
+class FakeSender:
+    """
+    Local sender used by tests and benchmarks. Records every multicast call.
+    Tokens in 'failing_tokens' are reported as failed deliveries and tokens in
+    'invalid_tokens' as no longer valid.
+    """
+
+    def __init__(self, failing_tokens: Optional[set] = None, invalid_tokens: Optional[set] = None):
+        self.failing_tokens = failing_tokens or set()
+        self.invalid_tokens = invalid_tokens or set()
+        self.calls = []
+
+    def send_multicast(self, tokens: List[str], title: str, message: str) -> List[Tuple[bool, Optional[Exception]]]:
+        if len(tokens) > MAX_MULTICAST_TOKENS:
+            raise ValueError(f"Multicast messages support up to {MAX_MULTICAST_TOKENS} tokens")
+        self.calls.append({'tokens': list(tokens), 'title': title, 'message': message})
+        results = []
+        for token in tokens:
+            if token in self.invalid_tokens:
+                results.append((False, InvalidTokenError("Token not registered")))
+            elif token in self.failing_tokens:
+                results.append((False, Exception("Delivery failed")))
+            else:
+                results.append((True, None))
+        return results
+
+
+class NotificationDispatcher:
+    """
+    Drains the notifications outbox in batches: saves each notification in the user
+    notifications and, if a sender is configured, pushes it to the user mobile token.
+    """
+
+    def __init__(self,
+                 outbox: AsyncNotificationOutbox,
+                 mobile_token_manager: AsyncMobileToken,
+                 sender=None,
+                 batch_size: int = 100,
+                 max_attempts: int = 5):
+        self.outbox = outbox
+        self.mobile_token_manager = mobile_token_manager
+        self.sender = sender
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.metrics = {
+            'batches': 0,
+            'dispatched': 0,
+            'retried': 0,
+            'failed': 0,
+            'multicast_calls': 0,
+            'pruned_tokens': 0,
+            'last_batch_size': 0,
+            'last_batch_duration': 0.0,
+            'last_dispatch_rate': 0.0  # Notifications per second in the last batch
+        }
+        self._started_at = time.time()
+
+    async def dispatch_once(self) -> int:
+        """
+        Dispatches one batch of the outbox. Returns the number of claimed entries.
+        """
+        start = time.time()
+        entries = await self.outbox.claim_batch(self.batch_size)
+        if not entries:
+            return 0
+
+        stored_ids, store_failed, store_error = [], [], None
+        for entry in entries:
+            if entry.get('stored'):
+                continue
+            try:
+                await self.mobile_token_manager._save_notification(entry['user_id'], entry['title'], entry['message'])
+                stored_ids.append(entry['_id'])
+            except Exception as e:
+                logger.error(f"Failed to store notification for user {entry['user_id']}: {e}")
+                store_failed.append(entry)
+                store_error = str(e)
+        # The saved ones are marked even if others failed, a retry does not store them twice
+        await self.outbox.mark_stored(stored_ids)
+
+        store_failed_ids = {entry['_id'] for entry in store_failed}
+        to_push = [entry for entry in entries if entry['_id'] not in store_failed_ids]
+        failed_entries, error = await self._push(to_push) if self.sender else ([], None)
+        failed_entries += store_failed
+        error = error or store_error
+        failed_ids = {entry['_id'] for entry in failed_entries}
+        sent_ids = [entry['_id'] for entry in entries if entry['_id'] not in failed_ids]
+        await self.outbox.mark_sent(sent_ids)
+        if failed_entries:
+            failed = await self.outbox.schedule_retry(failed_entries, error, self.max_attempts)
+            self.metrics['failed'] += failed
+            self.metrics['retried'] += len(failed_entries) - failed
+
+        duration = time.time() - start
+        self.metrics['batches'] += 1
+        self.metrics['dispatched'] += len(sent_ids)
+        self.metrics['last_batch_size'] = len(entries)
+        self.metrics['last_batch_duration'] = duration
+        self.metrics['last_dispatch_rate'] = len(sent_ids) / duration if duration > 0 else 0.0
+        return len(entries)
+
+    async def _push(self, entries: List[Dict]) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Sends the entries grouped by content, up to MAX_MULTICAST_TOKENS tokens per call.
+        Returns the entries that could not be delivered and the last error.
+        """
+        tokens = await self.mobile_token_manager.get_mobile_tokens([entry['user_id'] for entry in entries])
+        groups = {}
+        for entry in entries:
+            token = tokens.get(entry['user_id'])
+            if not token:
+                logger.debug(f"No mobile token found for user {entry['user_id']}, notification only stored")
+                continue
+            groups.setdefault((entry['title'], entry['message']), []).append((token, entry))
+
+        failed_entries, invalid_tokens, last_error = [], [], None
+        for (title, message), recipients in groups.items():
+            for i in range(0, len(recipients), MAX_MULTICAST_TOKENS):
+                chunk = recipients[i:i + MAX_MULTICAST_TOKENS]
+                self.metrics['multicast_calls'] += 1
+                try:
+                    # Senders use blocking HTTP clients, keep them off the event loop
+                    results = await run_in_thread(self.sender.send_multicast, [token for token, _ in chunk], title, message)
+                except Exception as e:
+                    logger.error(f"Failed to send multicast notification: {e}")
+                    failed_entries.extend(entry for _, entry in chunk)
+                    last_error = str(e)
+                    continue
+                for (token, entry), (success, error) in zip(chunk, results):
+                    if isinstance(error, InvalidTokenError):
+                        invalid_tokens.append(token)
+                    elif not success:
+                        failed_entries.append(entry)
+                        last_error = str(error)
+
+        if invalid_tokens:
+            self.metrics['pruned_tokens'] += await self.mobile_token_manager.prune_mobile_tokens(invalid_tokens)
+        return failed_entries, last_error
+
+    async def get_metrics(self) -> Dict:
+        uptime = time.time() - self._started_at
+        return {
+            **self.metrics,
+            'dispatch_rate': self.metrics['dispatched'] / uptime if uptime > 0 else 0.0,
+            'pending': await self.outbox.count('pending')
+        }
+
+    async def run(self, interval: float):
+        """
+        Drains the outbox forever. Full batches are followed immediately by the next one,
+        otherwise the dispatcher waits 'interval' seconds.
+        """
+        while True:
+            try:
+                await self.outbox.requeue_stale(get_timestamp_after_seconds(-STALE_CLAIM_SECONDS))
+                claimed = await self.dispatch_once()
+            except Exception as e:
+                logger.error(f"Notification dispatcher error: {e}")
+                claimed = 0
+            if claimed < self.batch_size:
+                await asyncio.sleep(interval)
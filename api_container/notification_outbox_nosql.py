@@ -0,0 +1,161 @@
+from typing import Optional, List, Dict
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+import datetime
+import logging as logger
+import os
+import uuid
+from lib.utils import get_actual_time, get_async_mongo_client, get_timestamp_after_seconds
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+SENT = 'sent'
+FAILED = 'failed'
+
+RETRY_BASE_DELAY = 5  # Seconds, doubled on each attempt
+DEFAULT_SENT_RETENTION = 7 * 24 * 60 * 60  # Seconds a sent entry is kept before the TTL index removes it
+
+
+@instrument_manager('notification_outbox')
+class AsyncNotificationOutbox:
+    """
+    AsyncNotificationOutbox class that stores pending notifications in a MongoDB collection.
+    Requests only append to the outbox, a background dispatcher drains it in batches.
+    Fields:
+    - user_id: str
+    - title: str
+    - message: str
+    - status: str -> 'pending' | 'processing' | 'sent' | 'failed'
+    - stored: bool -> True once the notification was saved in the user notifications
+    - attempts: int -> Number of failed delivery attempts
+    - next_attempt_at: datetime -> The entry is not claimed before this time
+    - claim_id: str (optional) -> Id of the dispatcher batch that claimed the entry
+    - claimed_at: datetime (optional)
+    - last_error: str (optional)
+    - expires_at: Date (optional) -> Set once sent, removed by a TTL index after NOTIFICATIONS_OUTBOX_RETENTION seconds
+    - created_at: datetime
+    - updated_at: datetime
+    """
+
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
+        if test_client:
+            self.db = self.client[os.getenv('MONGO_TEST_DB')]
+        else:
+            self.db = self.client[test_db or os.getenv('MONGO_DB')]
+        self.collection = self.db['notifications_outbox']
+        self.sent_retention = int(os.getenv('NOTIFICATIONS_OUTBOX_RETENTION') or DEFAULT_SENT_RETENTION)
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
+
+    async def _check_connection(self):
+        try:
+            await self.client.admin.command('ping')
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    async def _create_collection(self):
+        await self.collection.create_index([('status', ASCENDING), ('next_attempt_at', ASCENDING)])
+        await self.collection.create_index([('claim_id', ASCENDING)])
+        await self.collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+
+    async def enqueue(self, user_id: str, title: str, message: str) -> bool:
+        actual_time = get_actual_time()
+        try:
+            await self.collection.insert_one({
+                'user_id': user_id,
+                'title': title,
+                'message': message,
+                'status': PENDING,
+                'stored': False,
+                'attempts': 0,
+                'next_attempt_at': actual_time,
+                'created_at': actual_time,
+                'updated_at': actual_time
+            })
+            return True
+        except PyMongoError as e:
+            logger.error(f"Error enqueuing a notification for user '{user_id}': {e}")
+            return False
+
+    async def claim_batch(self, limit: int) -> List[Dict]:
+        actual_time = get_actual_time()
+        pending = await self.collection.find(
+            {'status': PENDING, 'next_attempt_at': {'$lte': actual_time}},
+            {'_id': 1}
+        ).sort('next_attempt_at', ASCENDING).limit(limit).to_list(None)
+        ids = [entry['_id'] for entry in pending]
+        if not ids:
+            return []
+
+        # The status filter makes the claim safe when several dispatchers run
+        claim_id = str(uuid.uuid4())
+        await self.collection.update_many(
+            {'_id': {'$in': ids}, 'status': PENDING},
+            {'$set': {'status': PROCESSING, 'claim_id': claim_id, 'claimed_at': actual_time, 'updated_at': actual_time}}
+        )
+        return await self.collection.find({'claim_id': claim_id}).to_list(None)
+
+    async def mark_stored(self, ids: List) -> None:
+        if ids:
+            await self.collection.update_many({'_id': {'$in': ids}}, {'$set': {'stored': True}})
+
+    async def mark_sent(self, ids: List) -> None:
+        if ids:
+            await self.collection.update_many(
+                {'_id': {'$in': ids}},
+                {'$set': {'status': SENT, 'updated_at': get_actual_time(),
+                          'expires_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.sent_retention)},
+                 '$unset': {'claim_id': ''}}
+            )
+
+    async def schedule_retry(self, entries: List[Dict], error: str, max_attempts: int) -> int:
+        """
+        Puts the entries back in the outbox with an exponential backoff.
+        Entries that reached max_attempts are marked as failed.
+        Returns the number of entries marked as failed.
+        """
+        actual_time = get_actual_time()
+        failed = 0
+        for entry in entries:
+            attempts = entry.get('attempts', 0) + 1
+            status = FAILED if attempts >= max_attempts else PENDING
+            failed += status == FAILED
+            await self.collection.update_one({'_id': entry['_id']}, {
+                '$set': {
+                    'status': status,
+                    'attempts': attempts,
+                    'last_error': error,
+                    'next_attempt_at': get_timestamp_after_seconds(RETRY_BASE_DELAY * 2 ** (attempts - 1)),
+                    'updated_at': actual_time
+                },
+                '$unset': {'claim_id': ''}
+            })
+        return failed
+
+    async def requeue_stale(self, claimed_before: str) -> int:
+        """
+        Releases entries claimed by a dispatcher that died before finishing its batch.
+        """
+        result = await self.collection.update_many(
+            {'status': PROCESSING, 'claimed_at': {'$lt': claimed_before}},
+            {'$set': {'status': PENDING, 'updated_at': get_actual_time()}, '$unset': {'claim_id': ''}}
+        )
+        return result.modified_count
+
+    async def count(self, status: Optional[str] = None) -> int:
+        return await self.collection.count_documents({'status': status} if status else {})
+
+
+class NotificationOutbox(SyncManager):
+    """
+    Synchronous interface of AsyncNotificationOutbox.
+    """
+    async_class = AsyncNotificationOutbox
@@ -1,21 +1,44 @@
+import time
+time_start = time.time()
+
+import asyncio
+import hashlib
+import math
+from contextlib import asynccontextmanager
 import operator
 import re
-from typing import Optional, Tuple
-from mobile_token_nosql import MobileToken, send_notification
-from coupons_nosql import Coupons
-from loyalty_nosql import Loyalty
-import mongomock
+from typing import Annotated, Optional, Tuple
+from mobile_token_nosql import MobileToken, AsyncMobileToken
+from notification_outbox_nosql import NotificationOutbox, AsyncNotificationOutbox
+from notification_dispatcher import NotificationDispatcher, FirebaseSender
+from coupons_nosql import Coupons, AsyncCoupons, COUPON_KINDS, REGULAR_COUPON_KIND, SEARCHABLE_FIELDS
+from loyalty_nosql import Loyalty, AsyncLoyalty, DAILY_STATS_COUNTERS
+from stripe_prices_nosql import StripePrices, AsyncStripePrices
+from stripe_events_nosql import StripeEvents, AsyncStripeEvents
+from idempotency_keys_nosql import IdempotencyKeys, AsyncIdempotencyKeys, COMPLETED
+from rate_limits_nosql import RateLimits, AsyncRateLimits
+from stripe_event_processor import StripeEventProcessor, HANDLED_EVENT_TYPES, checkout_session_data
 import logging as logger
-import time
-from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException, Query
+from pymongo.errors import PyMongoError
+from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException, Query, Header, Request, Response, Depends
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import sys
 import os
-from lib.utils import sentry_init, time_to_string, validate_fields, validate_location, verify_coupon_rules, get_timestamp_after_days
-import stripe
-
-time_start = time.time()
+from lib.utils import StartupProfiler, sentry_init, time_to_string, verify_coupon_rules, get_timestamp_after_days, get_mongo_pool_metrics, get_async_mongo_client, parse_rate_limit, InProcessRateLimits, make_etag, etag_matches
+from lib.async_mongo import supports_transactions, run_in_transaction
+from stripe_gateway import StripeGateway
+from response_models import CouponsResponse, CouponSearchResponse, RefundCouponsResponse, HistoryResponse, PointsResponse, LoyaltyStatsResponse, CouponStatsResponse
+from request_models import (PaymentRequest, CreateCouponRequest, RefundCouponRequest, TransactionRequest, CashCouponRequest,
+                            DiscountCouponRequest, ActivateCouponRequest, UserCouponsQuery, AvailableCouponsQuery, request_validation_detail)
+from lib.metrics import observe_request, observe_rate_limited, set_document_entries, update_threadpool_metrics, render_metrics
+
+# Heavy dependencies (stripe, mongomock, firebase_admin, geopy, sentry_sdk) are imported on first use
+startup_profiler = StartupProfiler(time_start)
+startup_profiler.mark('imports')
 
 logger.basicConfig(format='%(levelname)s: %(asctime)s - %(message)s',
                    stream=sys.stdout, level=logger.INFO)
@@ -30,15 +53,53 @@ logger.info("DEBUG_MODE: " + str(DEBUG_MODE))
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET")
 if not os.getenv("STRIPE_SECRET") and not os.getenv("TESTING"):
     raise Exception("Stripe secret key not found")
-stripe.api_key = os.getenv("STRIPE_SECRET")
+stripe_gateway = StripeGateway(api_key=STRIPE_SECRET_KEY)
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 
 sentry_init()
+startup_profiler.mark('sentry_init')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not os.getenv('TESTING'):
+        with startup_profiler.phase('mongo_connect'):
+            # The managers share this client
+            await get_async_mongo_client().admin.command('ping')
+        global mongo_transactions
+        mongo_transactions = MONGO_TRANSACTIONS == 'true' or (
+            MONGO_TRANSACTIONS == 'auto' and await supports_transactions(get_async_mongo_client()))
+        logger.info(f"MongoDB transactions {'enabled' if mongo_transactions else 'disabled'}")
+        with startup_profiler.phase('indexes'):
+            for manager in [async_coupons_manager, async_loyalty_manager, async_mobile_token_manager, async_notification_outbox,
+                            async_stripe_prices, async_stripe_events, async_idempotency_keys]:
+                await manager.initialize()
+            if RATE_LIMIT_BACKEND == 'mongo':
+                await async_rate_limits.initialize()
+        with startup_profiler.phase('cache_warmup'):
+            prices = await async_stripe_prices.warm_cache()
+        logger.info(f"Loaded {prices} Stripe prices in cache")
+        logger.info(f"Payments API ready in {time_to_string(startup_profiler.total())} ({startup_profiler.summary()})")
+        app.state.notification_dispatcher_task = asyncio.create_task(
+            notification_dispatcher.run(NOTIFICATIONS_DISPATCH_INTERVAL))
+        app.state.stripe_event_processor_task = asyncio.create_task(
+            stripe_event_processor.run(STRIPE_EVENTS_PROCESS_INTERVAL))
+        app.state.document_sizes_task = asyncio.create_task(refresh_document_sizes(DOCUMENT_SIZES_REFRESH_INTERVAL))
+    yield
+    if not os.getenv('TESTING'):
+        # Graceful worker shutdown: claimed events and notifications are released by requeue_stale
+        tasks = [app.state.notification_dispatcher_task, app.state.stripe_event_processor_task, app.state.document_sizes_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 
 app = FastAPI(
     title="Payments API",
     description="API for payments management",
     version="1.0.0",
-    root_path=os.getenv("ROOT_PATH")
+    root_path=os.getenv("ROOT_PATH"),
+    lifespan=lifespan
 )
 
 origins = [
@@ -50,30 +111,78 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # The route template (not the path) is used as label, so ids do not create new series
+        route = request.scope.get('route')
+        observe_request(request.method, getattr(route, 'path', None), status_code, time.perf_counter() - start)
+
+@app.exception_handler(RequestValidationError)
+async def request_validation_error(request: Request, exc: RequestValidationError):
+    # Invalid bodies and locations keep answering 400 with the messages of validate_fields and validate_location
+    detail = request_validation_detail(exc.errors())
+    if detail is None:
+        return await request_validation_exception_handler(request, exc)
+    return JSONResponse(status_code=400, content={"detail": detail})
+
+# Endpoints use the async managers, so requests are not bound to the threadpool size
 if os.getenv('TESTING'):
+    import mongomock
+    # Synchronous managers over the same mongomock client, used by the tests
     client = mongomock.MongoClient()
     coupons_manager = Coupons(test_client=client)
     loyalty_manager = Loyalty(test_client=client)
     mobile_token_manager = MobileToken(test_client=client)
+    notification_outbox = NotificationOutbox(test_client=client)
+    stripe_prices = StripePrices(test_client=client)
+    stripe_events = StripeEvents(test_client=client)
+    idempotency_keys = IdempotencyKeys(test_client=client)
+    rate_limits = RateLimits(test_client=client)
+    async_coupons_manager = coupons_manager.async_manager
+    async_loyalty_manager = loyalty_manager.async_manager
+    async_mobile_token_manager = mobile_token_manager.async_manager
+    async_notification_outbox = notification_outbox.async_manager
+    async_stripe_prices = stripe_prices.async_manager
+    async_stripe_events = stripe_events.async_manager
+    async_idempotency_keys = idempotency_keys.async_manager
+    async_rate_limits = rate_limits.async_manager
 else:
-    coupons_manager = Coupons()
-    loyalty_manager = Loyalty()
-    mobile_token_manager = MobileToken()
-
-REQUIRED_LOCATION_FIELDS = {"longitude", "latitude"}
-
-REQUIRED_COUPON_CREATE_FIELDS = {
-    'coupon_code', 'discount_percent', 'expiration_date'}
-VALID_COUPON_RULES = {'category_rules', 'service_rules',
-                      'provider_rules', 'location_rule', 'max_distance', 'users_rules'}
-VALID_COUPON_CREATE_FIELDS = {
-    'max_discount'} | VALID_COUPON_RULES | REQUIRED_COUPON_CREATE_FIELDS
-REQUIRED_REFUND_FIELDS = {'user_id', 'amount'}
-
-REQUIRED_TRANSACTION_FIELDS = {'points', 'description'}
+    async_coupons_manager = AsyncCoupons()
+    async_loyalty_manager = AsyncLoyalty()
+    async_mobile_token_manager = AsyncMobileToken()
+    async_notification_outbox = AsyncNotificationOutbox()
+    async_stripe_prices = AsyncStripePrices()
+    async_stripe_events = AsyncStripeEvents()
+    async_idempotency_keys = AsyncIdempotencyKeys()
+    async_rate_limits = AsyncRateLimits()
+
+FIREBASE_ENABLED = (os.getenv("FIREBASE_ENABLED") or "False").title() == "True"
+NOTIFICATIONS_DISPATCH_INTERVAL = float(os.getenv("NOTIFICATIONS_DISPATCH_INTERVAL") or 1)  # Seconds
+notification_dispatcher = NotificationDispatcher(
+    async_notification_outbox,
+    async_mobile_token_manager,
+    sender=FirebaseSender() if FIREBASE_ENABLED else None,
+    batch_size=int(os.getenv("NOTIFICATIONS_BATCH_SIZE") or 100),
+    max_attempts=int(os.getenv("NOTIFICATIONS_MAX_ATTEMPTS") or 5)
+)
 
+STRIPE_EVENTS_PROCESS_INTERVAL = float(os.getenv("STRIPE_EVENTS_PROCESS_INTERVAL") or 1)  # Seconds
+stripe_event_processor = StripeEventProcessor(
+    async_stripe_events,
+    async_loyalty_manager,
+    batch_size=int(os.getenv("STRIPE_EVENTS_BATCH_SIZE") or 100),
+    max_attempts=int(os.getenv("STRIPE_EVENTS_MAX_ATTEMPTS") or 5)
+)
 
 def POINTS_PER_CASH(cash): return cash / 10
 def CASH_COUPON_POINTS_NEEDED(cash_discount): return cash_discount * 10
@@ -82,97 +191,238 @@ def DISCOUNT_COUPON_POINTS_NEEDED(discount): return discount * 100
 
 YEAR = 365  # Days
 
-starting_duration = time_to_string(time.time() - time_start)
-logger.info(f"Payments API started in {starting_duration}")
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+# Token buckets of the mutation endpoints, "rate,burst" (requests per second, burst), "0" disables them:
+# one per user and route, and one per route shared by all the users
+USER_RATE_LIMIT = parse_rate_limit(os.getenv("RATE_LIMIT_PER_USER") or "5,20")
+ROUTE_RATE_LIMIT = parse_rate_limit(os.getenv("RATE_LIMIT_PER_ROUTE") or "500,1000")
+# 'memory' keeps the buckets in each worker, 'mongo' shares them between workers and replicas
+RATE_LIMIT_BACKEND = (os.getenv("RATE_LIMIT_BACKEND") or 'memory').lower()
+rate_limit_store = async_rate_limits if RATE_LIMIT_BACKEND == 'mongo' else InProcessRateLimits()
+
+# 'auto' uses transactions when the deployment supports them (replica set or sharded cluster)
+MONGO_TRANSACTIONS = (os.getenv("MONGO_TRANSACTIONS") or 'auto').lower()
+mongo_transactions = False
+
+MAX_SEARCH_LIMIT = 500
+MAX_NOTIFICATIONS_PAGE_SIZE = 100
+DAY_PATTERN = r'^\d{4}-\d{2}-\d{2}$'  # 'YYYY-MM-DD'
+
+DOCUMENT_SIZES_REFRESH_INTERVAL = float(os.getenv("DOCUMENT_SIZES_REFRESH_INTERVAL") or 60)  # Seconds
+
+startup_profiler.mark('managers')
+starting_duration = time_to_string(startup_profiler.total())
+logger.info(f"Payments API started in {starting_duration} ({startup_profiler.summary()})")
 
 # TODO: (General) -> Create tests for each endpoint && add the required checks in each endpoint
 
 
+async def get_stripe_price_id(service_id: str, amount: int, currency: str) -> str:
+    price_id = await async_stripe_prices.get_price_id(service_id, amount, currency)
+    if price_id:
+        return price_id
+    # Concurrent creations share the Stripe idempotency key, so they get the same Price
+    price = await stripe_gateway.create_price(service_id, amount, currency.lower())
+    await async_stripe_prices.save(service_id, amount, currency, price.id, price.product)
+    return price.id
+
+
 @app.get("/pay/{service_id}/paymentlink")
 async def create_payment_link(
     service_id: str,
     amount: int = Query(..., description="Amount in cents"),
     currency: str = Query(..., description="Currency code (e.g., 'usd')"),
-    description: str = Query(..., description="Description of the product")
+    description: str = Query(..., description="Description of the product"),
+    user_id: Optional[str] = Query(None, description="User that pays, credited when Stripe confirms the payment"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     try:
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[
-                {
-                    "price_data": {
-                        "currency": currency,
-                        "product_data": {
-                            "name": "Test Product",
-                            "description": description,
-                        },
-                        "unit_amount": amount,
-                    },
-                    "quantity": 1,
-                },
-            ],
-            mode="payment",
+        price_id = await get_stripe_price_id(service_id, amount, currency)
+        checkout_session = await stripe_gateway.create_checkout_session(
+            line_items=[{"price": price_id, "quantity": 1}],
             success_url="https://example.com/success",  # Dummy URL, required by Stripe
             cancel_url="https://example.com/cancel",  # Dummy URL
+            idempotency_key=idempotency_key,
+            payment_intent_data={"description": description},
+            metadata={"service_id": service_id, "description": description},
+            **({"client_reference_id": user_id} if user_id else {})
         )
         return {"url": checkout_session.url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/pay/{user_id}/paymentdone")
-def payment_done(user_id: str, body: dict):
-    validate_fields(body, {"amount", "description"}, {"amount", "description"})
-    if not loyalty_manager.register_client_payment(user_id, body['amount'], body['description']):
-        raise HTTPException(
-            status_code=500, detail="Failed to register the payment")
+@app.post("/stripe/webhook")
+async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Header(None, alias="Stripe-Signature")):
+    if not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=500, detail="Stripe webhook secret not configured")
+    import stripe
+    payload = await request.body()
+    try:
+        event = stripe.Webhook.construct_event(payload, stripe_signature or '', STRIPE_WEBHOOK_SECRET)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    except stripe.SignatureVerificationError:
+        raise HTTPException(status_code=400, detail="Invalid signature")
+
+    # Only the inbox insert is done here, so Stripe gets its acknowledgement right away
+    if event.type not in HANDLED_EVENT_TYPES:
+        return {"status": "ok"}
+    recorded = await async_stripe_events.record(event.id, event.type, checkout_session_data(event.data.object.to_dict()))
+    if recorded is None:
+        raise HTTPException(status_code=500, detail="Failed to record the event")
     return {"status": "ok"}
 
 
+async def update_document_sizes():
+    set_document_entries('loyalty', 'history', await async_loyalty_manager.get_history_size_stats())
+    set_document_entries('coupons', 'used_by', await async_coupons_manager.get_used_by_size_stats())
+
+
+async def refresh_document_sizes(interval: float):
+    # The document sizes scan whole collections, they are kept off the /metrics requests
+    while True:
+        try:
+            await update_document_sizes()
+        except Exception as e:
+            logger.error(f"Document sizes refresh error: {e}")
+        await asyncio.sleep(interval)
+
+
+@app.get("/metrics")
+async def metrics():
+    update_threadpool_metrics()
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+@app.get("/mongo/pool/metrics")
+async def mongo_pool_metrics():
+    return {"status": "ok", "metrics": get_mongo_pool_metrics()}
+
+
+@app.get("/stripe/events/metrics")
+async def stripe_events_metrics():
+    return {"status": "ok", "metrics": await stripe_event_processor.get_metrics()}
+
+
+async def rate_limit(request: Request):
+    # Dependency of the mutation endpoints, the route template keeps ids out of the bucket keys
+    route = request.scope['route'].path
+    user_id = request.path_params.get('user_id')
+    limits = [('user', f"{route}:{user_id}", USER_RATE_LIMIT if user_id else None), ('route', route, ROUTE_RATE_LIMIT)]
+    acquired = []
+    for scope, key, limit in limits:
+        if limit is None:
+            continue
+        retry_after = await rate_limit_store.acquire(key, *limit)
+        if retry_after:
+            # The request is not served, the tokens taken from the previous buckets are given back
+            for acquired_key, acquired_limit in acquired:
+                await rate_limit_store.release(acquired_key, acquired_limit[0])
+            observe_rate_limited(route, scope)
+            raise HTTPException(status_code=429, detail="Too many requests",
+                                headers={"Retry-After": str(math.ceil(retry_after))})
+        acquired.append((key, limit))
+
+
+async def run_idempotent(scope: str, idempotency_key: Optional[str], body, handler):
+    """
+    Runs the handler once per Idempotency-Key: repeated requests get the stored response
+    (with the Idempotent-Replayed header) instead of writing again. Failed requests release the key.
+    """
+    if idempotency_key is None:
+        return await handler()
+    if not idempotency_key or len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+
+    fingerprint = hashlib.sha256(body.model_dump_json().encode()).hexdigest()
+    stored = await async_idempotency_keys.begin(scope, idempotency_key, fingerprint)
+    if stored is not None:
+        if stored['fingerprint'] != fingerprint:
+            raise HTTPException(
+                status_code=422, detail="Idempotency-Key already used with a different request")
+        if stored['status'] != COMPLETED:
+            raise HTTPException(
+                status_code=409, detail="A request with this Idempotency-Key is in progress")
+        return JSONResponse(stored['response'], status_code=stored['status_code'], headers={"Idempotent-Replayed": "true"})
+
+    try:
+        response = await handler()
+    except BaseException:
+        await async_idempotency_keys.release(scope, idempotency_key)
+        raise
+    try:
+        await async_idempotency_keys.complete(scope, idempotency_key, 200, response)
+    except PyMongoError as e:
+        # The request succeeded, it is not reported as failed (the client would retry it)
+        logger.error(f"Failed to store the response of the Idempotency-Key {idempotency_key}: {e}")
+    return response
+
+
+def conditional_get(etag: Optional[str], if_none_match: Optional[str], response: Response) -> Optional[Response]:
+    """
+    Returns a 304 response if the client already has the current representation,
+    otherwise adds the ETag to the response and returns None.
+    """
+    if etag is None:
+        return None
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
+
+@app.post("/pay/{user_id}/paymentdone")
+async def payment_done(user_id: str, body: PaymentRequest,
+                       idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    async def register():
+        if not await async_loyalty_manager.register_client_payment(user_id, body.amount, body.description):
+            raise HTTPException(
+                status_code=500, detail="Failed to register the payment")
+        return {"status": "ok"}
+    return await run_idempotent(f"paymentdone:{user_id}", idempotency_key, body, register)
+
+
 @app.post("/pay/{provider_id}/paymentreceived")
-def payment_received(provider_id: str, body: dict):
+async def payment_received(provider_id: str, body: PaymentRequest):
     # Add a third party app to pay to the provider
 
-    validate_fields(body, {"amount", "description"}, {"amount", "description"})
-    if not loyalty_manager.register_provider_payment(provider_id, body['amount'], body['description']):
+    if not await async_loyalty_manager.register_provider_payment(provider_id, body.amount, body.description):
         raise HTTPException(
             status_code=500, detail="Failed to register the payment")
     return {"status": "ok"}
 
 
-@app.post("/coupons/create")
-def create_coupon(body: dict):
-    validate_fields(body, REQUIRED_COUPON_CREATE_FIELDS,
-                    VALID_COUPON_CREATE_FIELDS)
-
+@app.post("/coupons/create", dependencies=[Depends(rate_limit)])
+async def create_coupon(body: CreateCouponRequest):
     # At least one ruled is needed
-    if not any([field in body for field in VALID_COUPON_RULES]):
+    if not body.has_rules():
         raise HTTPException(
             status_code=400, detail="At least one rule is needed")
-    if bool('location_rule' in body) != bool('max_distance' in body):
+    if (body.location_rule is None) != (body.max_distance is None):
         raise HTTPException(
             status_code=400, detail="Both location_rule and max_distance are needed, or none of them")
-    if 'location_rule' in body:
-        location = validate_location(
-            body['location_rule'], REQUIRED_LOCATION_FIELDS)
-    if body['discount_percent'] <= 0 or body['discount_percent'] > 100:
+    if body.discount_percent <= 0 or body.discount_percent > 100:
         raise HTTPException(status_code=400, detail="Invalid discount percent")
 
-    if coupons_manager.get(body['coupon_code']):
+    if await async_coupons_manager.get(body.coupon_code):
         raise HTTPException(
             status_code=400, detail="Coupon code already exists")
 
-    if not coupons_manager.insert(
-        coupon_code=body.get('coupon_code'),
-        discount_percent=body.get('discount_percent'),
-        max_discount=body.get('max_discount'),
-        expiration_date=body.get('expiration_date'),
-        category_rules=body.get('category_rules'),
-        service_rules=body.get('service_rules'),
-        provider_rules=body.get('provider_rules'),
-        location_rule=location if 'location_rule' in body else None,
-        max_distance=body.get('max_distance'),
-        users_rules=body.get('users_rules')
+    if not await async_coupons_manager.insert(
+        coupon_code=body.coupon_code,
+        discount_percent=body.discount_percent,
+        max_discount=body.max_discount,
+        expiration_date=body.expiration_date,
+        category_rules=body.category_rules,
+        service_rules=body.service_rules,
+        provider_rules=body.provider_rules,
+        location_rule=body.location_rule,
+        max_distance=body.max_distance,
+        users_rules=body.users_rules,
+        max_redemptions=body.max_redemptions
     ):
         raise HTTPException(
             status_code=500, detail="Failed to create the coupon")
@@ -180,88 +430,167 @@ def create_coupon(body: dict):
     return {"status": "ok"}
 
 
-@app.post("/coupons/new_refund")
-def create_refund_coupon(body: dict):
-    validate_fields(body, REQUIRED_REFUND_FIELDS, REQUIRED_REFUND_FIELDS)
-    if body['amount'] <= 0:
+@app.post("/coupons/new_refund", dependencies=[Depends(rate_limit)])
+async def create_refund_coupon(body: RefundCouponRequest,
+                               idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    if body.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
 
-    code = f"REFUND_{body['user_id']}_{time.time()}"
-    if not coupons_manager.insert(
-        coupon_code=code,
-        discount_percent=100,
-        max_discount=body['amount'],
-        expiration_date=get_timestamp_after_days(100*YEAR),
-        users_rules=[body['user_id']]
-    ):
+    async def create():
+        code = f"REFUND_{body.user_id}_{time.time()}"
+        if not await async_coupons_manager.insert(
+            coupon_code=code,
+            discount_percent=100,
+            max_discount=body.amount,
+            expiration_date=get_timestamp_after_days(100*YEAR),
+            users_rules=[body.user_id]
+        ):
+            raise HTTPException(
+                status_code=500, detail="Failed to create the coupon")
+
+        if not await async_notification_outbox.enqueue(
+                body.user_id, "Refund coupon", f"Refund coupon of {body.amount} created"):
+            # The coupon exists, the request succeeds without the notification
+            logger.error(f"Refund coupon {code} created without its notification for user '{body.user_id}'")
+        return {"status": "ok", "coupon_code": code}
+    return await run_idempotent(f"new_refund:{body.user_id}", idempotency_key, body, create)
+
+
+@app.delete("/coupons/delete/{coupon_code}", dependencies=[Depends(rate_limit)])
+async def delete_coupon(coupon_code: str):
+    if not await async_coupons_manager.get(coupon_code):
+        raise HTTPException(status_code=404, detail="Coupon not found")
+
+    if not await async_coupons_manager.delete(coupon_code):
         raise HTTPException(
-            status_code=500, detail="Failed to create the coupon")
+            status_code=500, detail="Failed to delete the coupon")
 
-    send_notification(mobile_token_manager,
-                      body['user_id'], "Refund coupon", f"Refund coupon of {body['amount']} created")
-    return {"status": "ok", "coupon_code": code}
+    return {"status": "ok"}
 
 
-@app.delete("/coupons/delete/{coupon_code}")
-def delete_coupon(coupon_code: str):
-    if not coupons_manager.get(coupon_code):
-        raise HTTPException(status_code=404, detail="Coupon not found")
+@app.get("/notifications/outbox/metrics")
+async def get_notifications_outbox_metrics():
+    return {"status": "ok", "metrics": await notification_dispatcher.get_metrics()}
 
-    if not coupons_manager.delete(coupon_code):
-        raise HTTPException(
-            status_code=500, detail="Failed to delete the coupon")
 
+@app.get("/notifications/{user_id}")
+async def get_notifications(
+    user_id: str,
+    page: int = Query(0, ge=0),
+    page_size: int = Query(20, ge=1, le=MAX_NOTIFICATIONS_PAGE_SIZE)
+):
+    notifications = await async_mobile_token_manager.get_notifications(user_id, page, page_size)
+    return {"status": "ok", **notifications}
+
+
+@app.put("/notifications/{user_id}/read")
+async def mark_notifications_as_read(user_id: str):
+    if not await async_mobile_token_manager.mark_notifications_as_read(user_id):
+        raise HTTPException(
+            status_code=404, detail="User does not have notifications yet")
     return {"status": "ok"}
 
 
-@app.get("/coupons/all_coupons")
-def get_all_coupons():
-    all_coupons = coupons_manager.get_all_coupons()
+@app.get("/coupons/all_coupons", response_model=CouponsResponse, response_model_exclude_unset=True)
+async def get_all_coupons():
+    all_coupons = await async_coupons_manager.get_all_coupons()
     return {"status": "ok", "coupons": all_coupons}
 
 
-@app.get("/coupons")
-def obtain_available_coupons(
-    user_id: str = Query(...),
-    client_location: str = Query(...),
-    category: str = Query(...),
-    service_id: str = Query(...),
-    provider_id: str = Query(...)
+@app.get("/coupons/search", response_model=CouponSearchResponse, response_model_exclude_unset=True)
+async def search_coupons(
+    code_prefix: Optional[str] = Query(None),
+    kind: Optional[str] = Query(None, description="One of 'regular', 'refund', 'cash' or 'discount'"),
+    category: Optional[str] = Query(None),
+    service_id: Optional[str] = Query(None),
+    provider_id: Optional[str] = Query(None),
+    expires_after: Optional[str] = Query(None, description="Format: 'YYYY-MM-DD HH:MM:SS'"),
+    expires_before: Optional[str] = Query(None, description="Format: 'YYYY-MM-DD HH:MM:SS'"),
+    has_location_rule: Optional[bool] = Query(None),
+    after: Optional[str] = Query(None, description="Last coupon code of the previous page"),
+    limit: int = Query(50, ge=1, le=MAX_SEARCH_LIMIT),
+    fields: Optional[str] = Query(None, description="Comma separated list of fields to return")
 ):
-    location = validate_location(client_location, REQUIRED_LOCATION_FIELDS)
-    available_coupons = coupons_manager.obtain_available_coupons(
-        user_id=user_id,
-        client_location=location,
+    if kind and kind != REGULAR_COUPON_KIND and kind not in COUPON_KINDS:
+        raise HTTPException(status_code=400, detail=f"Invalid kind: {kind}")
+    projected_fields = None
+    if fields:
+        projected_fields = [field.strip() for field in fields.split(",") if field.strip()]
+        invalid_fields = set(projected_fields) - SEARCHABLE_FIELDS
+        if invalid_fields:
+            raise HTTPException(
+                status_code=400, detail=f"Invalid fields: {invalid_fields}")
+
+    coupons = await async_coupons_manager.search(
+        code_prefix=code_prefix,
+        kind=kind,
         category=category,
         service_id=service_id,
-        provider_id=provider_id
+        provider_id=provider_id,
+        expires_after=expires_after,
+        expires_before=expires_before,
+        has_location_rule=has_location_rule,
+        after=after,
+        limit=limit,
+        fields=projected_fields
+    )
+    next_cursor = coupons[-1]['uuid'] if len(coupons) == limit else None
+    return {"status": "ok", "coupons": coupons, "next_cursor": next_cursor}
+
+
+@app.get("/coupons", response_model=CouponsResponse, response_model_exclude_unset=True)
+async def obtain_available_coupons(query: Annotated[AvailableCouponsQuery, Query()]):
+    available_coupons = await async_coupons_manager.obtain_available_coupons(
+        user_id=query.user_id,
+        client_location=query.client_location,
+        category=query.category,
+        service_id=query.service_id,
+        provider_id=query.provider_id
     )
 
     return {"status": "ok", "coupons": available_coupons}
 
 
-@app.get("/coupons/all")
-def obtain_user_coupons(
-    user_id: str = Query(...),
-    client_location: str = Query(...)
-):
-    location = validate_location(client_location, REQUIRED_LOCATION_FIELDS)
-    all_coupons = coupons_manager.obtain_user_coupons(
-        user_id=user_id,
-        client_location=location
+@app.get("/coupons/all", response_model=CouponsResponse, response_model_exclude_unset=True)
+async def obtain_user_coupons(query: Annotated[UserCouponsQuery, Query()]):
+    all_coupons = await async_coupons_manager.obtain_user_coupons(
+        user_id=query.user_id,
+        client_location=query.client_location
     )
     return {"status": "ok", "coupons": all_coupons}
 
 
-@app.get("/coupons/refund")
-def get_refund_coupons(user_id: str):
-    refund_coupons = coupons_manager.get_refund_coupons(user_id)
+@app.get("/coupons/refund", response_model=RefundCouponsResponse, response_model_exclude_unset=True)
+async def get_refund_coupons(user_id: str, response: Response,
+                             if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    versions = await async_coupons_manager.get_refund_coupons_versions(user_id)
+    etag = make_etag('refund_coupons', user_id, [(coupon['uuid'], coupon.get('version', 0)) for coupon in versions])
+    not_modified = conditional_get(etag, if_none_match, response)
+    if not_modified is not None:
+        return not_modified
+    refund_coupons = await async_coupons_manager.get_refund_coupons(user_id)
     return {"status": "ok", "refund_coupons": refund_coupons}
 
 
-@app.put("/coupons/use_refund/{coupon_code}/{user_id}")
-def use_refund_coupon(coupon_code: str, user_id: str):
-    coupon = coupons_manager.get(coupon_code)
+@app.get("/coupons/{coupon_code}/stats", response_model=CouponStatsResponse)
+async def get_coupon_stats(
+    coupon_code: str,
+    from_day: Optional[str] = Query(None, pattern=DAY_PATTERN, description="Format: 'YYYY-MM-DD'"),
+    to_day: Optional[str] = Query(None, pattern=DAY_PATTERN, description="Format: 'YYYY-MM-DD'")
+):
+    # Read from the redemption counters, the coupon documents are not read
+    days = await async_coupons_manager.get_redemption_stats(coupon_code, from_day, to_day)
+    categories = {}
+    for day in days:
+        for category, redemptions in day['categories'].items():
+            categories[category] = categories.get(category, 0) + redemptions
+    return {"status": "ok", "coupon_code": coupon_code, "redemptions": sum(day['redemptions'] for day in days),
+            "categories": categories, "days": days}
+
+
+@app.put("/coupons/use_refund/{coupon_code}/{user_id}", dependencies=[Depends(rate_limit)])
+async def use_refund_coupon(coupon_code: str, user_id: str):
+    coupon = await async_coupons_manager.get(coupon_code)
 
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
@@ -273,135 +602,173 @@ def use_refund_coupon(coupon_code: str, user_id: str):
     if 'used_by' in coupon and user_id in coupon['used_by']:
         raise HTTPException(status_code=400, detail="Coupon already used")
 
-    success = coupons_manager.mark_coupon_as_used(coupon_code, user_id)
+    success = await async_coupons_manager.mark_coupon_as_used(coupon_code, user_id)
 
     if not success:
         raise HTTPException(
             status_code=500, detail="Failed to mark coupon as used")
 
-    if not loyalty_manager.register_coupon_use(user_id, coupon_code, f"Used refund coupon {coupon_code}"):
+    if not await async_loyalty_manager.register_coupon_use(user_id, coupon_code, f"Used refund coupon {coupon_code}"):
         raise HTTPException(
             status_code=500, detail="Failed to register usage in loyalty system")
 
     return {"status": "ok", "message": f"Coupon {coupon_code} used"}
 
 
-@app.put("/coupons/activate/{coupon_code}/{user_id}")
-def activate_coupon(coupon_code: str, user_id: str, body: dict):
-    needed = {'client_location', 'category', 'service_id', 'provider_id'}
-    if not all([field in body for field in needed]):
-        missing_fields = needed - set(body.keys())
-        raise HTTPException(
-            status_code=400, detail=f"Missing fields: {', '.join(missing_fields)}")
-
-    coupon = coupons_manager.get(coupon_code)
+@app.put("/coupons/activate/{coupon_code}/{user_id}", dependencies=[Depends(rate_limit)])
+async def activate_coupon(coupon_code: str, user_id: str, body: ActivateCouponRequest):
+    coupon = await async_coupons_manager.get(coupon_code)
     if not coupon:
         raise HTTPException(status_code=404, detail="Coupon not found")
 
     success, message = verify_coupon_rules(
-        coupon, user_id, body['category'], body['service_id'], body['provider_id'], body['client_location'])
+        coupon, user_id, body.category, body.service_id, body.provider_id, body.client_location)
     if not success:
         raise HTTPException(status_code=400, detail=message)
 
-    if not coupons_manager.add_user_to_coupon(coupon_code, user_id):
+    if not await async_coupons_manager.add_user_to_coupon(coupon_code, user_id, body.category):
+        # The guarded update lost a race (quota exhausted or already used meanwhile)
+        success, message = verify_coupon_rules(
+            await async_coupons_manager.get(coupon_code) or coupon, user_id, body.category, body.service_id, body.provider_id, body.client_location)
+        if not success:
+            raise HTTPException(status_code=400, detail=message)
         raise HTTPException(
             status_code=500, detail="Failed to activate the coupon")
 
-    if not loyalty_manager.register_coupon_use(user_id, coupon_code, f"Used coupon {coupon_code}"):
-        coupons_manager.remove_user_from_coupon(coupon_code, user_id)
+    if not await async_loyalty_manager.register_coupon_use(user_id, coupon_code, f"Used coupon {coupon_code}"):
+        await async_coupons_manager.remove_user_from_coupon(coupon_code, user_id, body.category)
         raise HTTPException(
             status_code=500, detail="Failed to register the coupon")
 
     return {"status": "ok", "discount_percent": coupon['discount_percent'], "max_discount": coupon['max_discount']}
 
 
-@app.put("/loyalty/sum_points/{user_id}")
-def add_loyalty_transaction(user_id: str, body: dict):
-    validate_fields(body, REQUIRED_TRANSACTION_FIELDS,
-                    REQUIRED_TRANSACTION_FIELDS)
-    if body['points'] <= 0:
+@app.put("/loyalty/sum_points/{user_id}", dependencies=[Depends(rate_limit)])
+async def add_loyalty_transaction(user_id: str, body: TransactionRequest,
+                                  idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    if body.points <= 0:
         raise HTTPException(status_code=400, detail="Points must be positive")
 
-    if not loyalty_manager.add_transaction(user_id, body['points'], body['description']):
+    async def add():
+        if not await async_loyalty_manager.add_transaction(user_id, body.points, body.description):
+            raise HTTPException(
+                status_code=500, detail="Failed to add the transaction")
+        return {"status": "ok"}
+    return await run_idempotent(f"sum_points:{user_id}", idempotency_key, body, add)
+
+
+async def buy_coupon_with_points(user_id: str, points_needed, description: str, **coupon):
+    """
+    Deducts the points and creates the coupon. With transactions both writes commit together.
+    Without them the points are deducted first, with a conditional update, and given back (with their
+    expiration dates) if the coupon insert fails.
+    """
+    async def use_points(session=None, deferred_stats=None):
+        used = await async_loyalty_manager.use_points(user_id, points_needed, description, session=session,
+                                                      deferred_stats=deferred_stats)
+        if used is False:
+            raise HTTPException(status_code=400, detail="Not enough points")
+        if used is None:
+            raise HTTPException(status_code=500, detail="Failed to use the points")
+        return used
+
+    if mongo_transactions:
+        # The loyalty rollups are written after the commit, outside the transaction
+        deferred_stats = []
+
+        async def purchase_in_transaction(session):
+            # Write errors are raised, so with_transaction retries the transient ones (write conflicts)
+            deferred_stats.clear()
+            await use_points(session, deferred_stats)
+            await async_coupons_manager.insert(**coupon, session=session)
+        try:
+            await run_in_transaction(get_async_mongo_client(), purchase_in_transaction)
+        except PyMongoError as e:
+            logger.error(f"Failed to buy a coupon with the points of user '{user_id}': {e}")
+            raise HTTPException(status_code=500, detail="Failed to create the coupon")
+        await async_loyalty_manager.record_daily_stats(deferred_stats)
+        return
+
+    used = await use_points()
+    if not await async_coupons_manager.insert(**coupon):
+        if not await async_loyalty_manager.restore_points(user_id, used, f"Refund of: {description}"):
+            logger.error(f"Failed to give back {points_needed} points to user '{user_id}'")
         raise HTTPException(
-            status_code=500, detail="Failed to add the transaction")
-
-    return {"status": "ok"}
+            status_code=500, detail="Failed to create the coupon")
 
 
-@app.put("/loyalty/use_points/cash_coupon/{user_id}")
-def buy_cash_coupon(user_id: str, body: dict):
-    validate_fields(body, {"CASH_DISCOUNT"}, {"CASH_DISCOUNT"})
-    if body['CASH_DISCOUNT'] <= 0:
+@app.put("/loyalty/use_points/cash_coupon/{user_id}", dependencies=[Depends(rate_limit)])
+async def buy_cash_coupon(user_id: str, body: CashCouponRequest):
+    if body.cash_discount <= 0:
         raise HTTPException(
             status_code=400, detail="Discount must be positive")
 
-    points_needed = CASH_COUPON_POINTS_NEEDED(body['CASH_DISCOUNT'])
-    total_points = loyalty_manager.get_total_points(user_id)
-    if not total_points or total_points < points_needed:
-        raise HTTPException(status_code=400, detail="Not enough points")
-
     # Unique coupon code
-    coupon_code = f"CASH_{user_id}_{body['CASH_DISCOUNT']}_{time.time()}"
-    if not coupons_manager.insert(
+    coupon_code = f"CASH_{user_id}_{body.cash_discount}_{time.time()}"
+    await buy_coupon_with_points(
+        user_id, CASH_COUPON_POINTS_NEEDED(body.cash_discount), f"Bought cash coupon of {body.cash_discount} ({coupon_code})",
         coupon_code=coupon_code,
         discount_percent=100,
-        max_discount=body['CASH_DISCOUNT'],
+        max_discount=body.cash_discount,
         expiration_date=get_timestamp_after_days(YEAR),
         users_rules=[user_id]
-    ):
-        raise HTTPException(
-            status_code=500, detail="Failed to create the coupon")
-
-    if not loyalty_manager.add_transaction(user_id, -points_needed, f"Bought cash coupon of {body['CASH_DISCOUNT']} ({coupon_code})"):
-        coupons_manager.delete(coupon_code)
-        raise HTTPException(status_code=500, detail="Failed to use the points")
-
+    )
     return {"status": "ok", "coupon_code": coupon_code}
 
 
-@app.put("/loyalty/use_points/discount_coupon/{user_id}")
-def buy_discount_coupon(user_id: str, body: dict):
-    validate_fields(body, {"DISCOUNT"}, {"DISCOUNT"})
-    if body['DISCOUNT'] <= 0 or body['DISCOUNT'] > 100:
+@app.put("/loyalty/use_points/discount_coupon/{user_id}", dependencies=[Depends(rate_limit)])
+async def buy_discount_coupon(user_id: str, body: DiscountCouponRequest):
+    if body.discount <= 0 or body.discount > 100:
         raise HTTPException(status_code=400, detail="Invalid discount")
 
-    points_needed = DISCOUNT_COUPON_POINTS_NEEDED(body['DISCOUNT'])
-    total_points = loyalty_manager.get_total_points(user_id)
-    if not total_points or total_points < points_needed:
-        raise HTTPException(status_code=400, detail="Not enough points")
-
     # Unique coupon code
-    coupon_code = f"DISCOUNT_{user_id}_{body['DISCOUNT']}perc_{time.time()}"
-    if not coupons_manager.insert(
+    coupon_code = f"DISCOUNT_{user_id}_{body.discount}perc_{time.time()}"
+    await buy_coupon_with_points(
+        user_id, DISCOUNT_COUPON_POINTS_NEEDED(body.discount), f"Bought discount coupon of {body.discount}% ({coupon_code})",
         coupon_code=coupon_code,
-        discount_percent=body['DISCOUNT'],
+        discount_percent=body.discount,
         expiration_date=get_timestamp_after_days(YEAR),
         users_rules=[user_id]
-    ):
-        raise HTTPException(
-            status_code=500, detail="Failed to create the coupon")
-
-    if not loyalty_manager.add_transaction(user_id, -points_needed, f"Bought discount coupon of {body['DISCOUNT']}% ({coupon_code})"):
-        coupons_manager.delete(coupon_code)
-        raise HTTPException(status_code=500, detail="Failed to use the points")
-
+    )
     return {"status": "ok", "coupon_code": coupon_code}
 
 
-@app.get("/loyalty/points/{user_id}")
-def obtain_user_points(user_id: str):
-    total_points = loyalty_manager.get_total_points(user_id)
+@app.get("/loyalty/points/{user_id}", response_model=PointsResponse, response_model_exclude_unset=True)
+async def obtain_user_points(user_id: str, response: Response,
+                             if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    version = await async_loyalty_manager.get_version(user_id)
+    etag = make_etag('points', user_id, version['created_at'], version['version']) if version else None
+    not_modified = conditional_get(etag, if_none_match, response)
+    if not_modified is not None:
+        return not_modified
+    total_points = await async_loyalty_manager.get_total_points(user_id)
     if total_points == None:
         raise HTTPException(
             status_code=404, detail="User does not have loyalty points yet")
-    expiring_dates = loyalty_manager.get_expiring_points(user_id)
+    expiring_dates = await async_loyalty_manager.get_expiring_points(user_id)
     return {"status": "ok", "total_points": total_points, "expiring_dates": expiring_dates}
 
 
-@app.get("/loyalty/history/{user_id}")
-def obtain_user_history(user_id: str):
-    history = loyalty_manager.get_history(user_id)
+@app.get("/loyalty/stats", response_model=LoyaltyStatsResponse)
+async def get_loyalty_stats(
+    from_day: Optional[str] = Query(None, pattern=DAY_PATTERN, description="Format: 'YYYY-MM-DD'"),
+    to_day: Optional[str] = Query(None, pattern=DAY_PATTERN, description="Format: 'YYYY-MM-DD'")
+):
+    # Read from the daily rollups, the loyalty documents are not scanned
+    days = await async_loyalty_manager.get_daily_stats(from_day, to_day)
+    totals = {counter: sum(day[counter] for day in days) for counter in DAILY_STATS_COUNTERS}
+    return {"status": "ok", "days": days, "totals": totals}
+
+
+@app.get("/loyalty/history/{user_id}", response_model=HistoryResponse, response_model_exclude_unset=True)
+async def obtain_user_history(user_id: str, response: Response,
+                              if_none_match: Optional[str] = Header(None, alias="If-None-Match")):
+    version = await async_loyalty_manager.get_version(user_id)
+    etag = make_etag('history', user_id, version['created_at'], version['version']) if version else None
+    not_modified = conditional_get(etag, if_none_match, response)
+    if not_modified is not None:
+        return not_modified
+    history = await async_loyalty_manager.get_history(user_id)
     if history == None:
         raise HTTPException(
             status_code=404, detail="User does not have loyalty points yet")
@@ -0,0 +1,81 @@
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import datetime
+import logging as logger
+import os
+import time
+from lib.utils import get_async_mongo_client, gcra
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
+
+@instrument_manager('rate_limits')
+class AsyncRateLimits:
+    """
+    AsyncRateLimits class that stores token buckets in a MongoDB collection, shared by every worker and replica.
+    Same interface as InProcessRateLimits, at the cost of an update per request.
+    Fields:
+    - key: str (unique) -> Bucket key (route and user)
+    - tat: float -> Theoretical arrival time of the bucket (see gcra)
+    - expires_at: Date -> Removed by a TTL index once the bucket is full again (a full burst after the last request)
+    """
+
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
+        if test_client:
+            self.db = self.client[os.getenv('MONGO_TEST_DB')]
+        else:
+            self.db = self.client[test_db or os.getenv('MONGO_DB')]
+        self.collection = self.db['rate_limits']
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
+
+    async def _check_connection(self):
+        try:
+            await self.client.admin.command('ping')
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    async def _create_collection(self):
+        await self.collection.create_index([('key', ASCENDING)], unique=True)
+        await self.collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        """
+        Returns 0 if the request is allowed, otherwise the seconds to wait.
+        The gcra step runs on the server in a single update (pipeline update), so concurrent requests
+        on the same bucket never conflict. The bucket before the update gives the same result as gcra.
+        """
+        now = time.time()
+        interval = 1 / rate
+        new_tat = {'$add': [{'$max': [{'$ifNull': ['$tat', now]}, now]}, interval]}
+        allowed = {'$lte': [{'$subtract': [{'$subtract': [new_tat, now]}, burst * interval]}, 0]}
+        # The tat is never later than a full burst from now, the bucket is full again by then
+        expires_at = datetime.datetime.fromtimestamp(now + burst * interval, datetime.timezone.utc)
+        update = [{'$set': {'tat': {'$cond': [allowed, new_tat, '$tat']}, 'expires_at': expires_at}}]
+        try:
+            bucket = await self.collection.find_one_and_update(
+                {'key': key}, update, projection={'_id': 0, 'tat': 1}, upsert=True, return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            # Concurrent upserts of a new bucket, the other one created it
+            bucket = await self.collection.find_one_and_update(
+                {'key': key}, update, projection={'_id': 0, 'tat': 1}, return_document=ReturnDocument.BEFORE)
+        _, retry_after = gcra(bucket['tat'] if bucket else None, now, rate, burst)
+        return retry_after
+
+    async def release(self, key: str, rate: float) -> None:
+        """
+        Gives back a token taken by acquire (the request was rejected by another bucket).
+        """
+        await self.collection.update_one({'key': key}, {'$inc': {'tat': -1 / rate}})
+
+
+class RateLimits(SyncManager):
+    """
+    Synchronous interface of AsyncRateLimits.
+    """
+    async_class = AsyncRateLimits
@@ -0,0 +1,153 @@
+from typing import Annotated, ClassVar, Dict, FrozenSet, List, Optional, Union
+from fastapi import HTTPException
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, field_validator, model_validator
+from pydantic_core import PydanticCustomError
+from lib.utils import REQUIRED_LOCATION_FIELDS, validate_location
+
+# Request models of the endpoints. The body (or query) is parsed and validated once by FastAPI,
+# the handlers receive typed values and a location already converted to {'longitude': float, 'latitude': float}.
+# The errors raised here keep the messages of validate_fields and validate_location,
+# request_validation_detail turns them into the 400 responses the clients already handle.
+
+Number = Union[int, float]
+
+EXTRA_FIELDS_ERROR = 'extra_fields'
+MISSING_FIELDS_ERROR = 'missing_fields'
+INVALID_VALUE_ERROR = 'invalid_value'
+REQUEST_ERROR_TYPES = {EXTRA_FIELDS_ERROR, MISSING_FIELDS_ERROR, INVALID_VALUE_ERROR}
+
+
+def parse_location(value):
+    if isinstance(value, dict) and value.keys() == REQUIRED_LOCATION_FIELDS and all(type(v) == float for v in value.values()):
+        return value  # Already parsed
+    try:
+        return validate_location(value, REQUIRED_LOCATION_FIELDS)
+    except HTTPException as e:
+        raise PydanticCustomError(INVALID_VALUE_ERROR, e.detail)
+
+
+Location = Annotated[Dict[str, float], BeforeValidator(parse_location)]
+
+
+class RequestBody(BaseModel):
+    """
+    Base of the request bodies. Unknown and missing fields are rejected with the messages of validate_fields.
+    """
+    model_config = ConfigDict(extra='forbid')
+
+    # Field names as sent by the clients (aliases included), computed once per model
+    valid_fields: ClassVar[FrozenSet[str]] = frozenset()
+    required_fields: ClassVar[FrozenSet[str]] = frozenset()
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        cls.valid_fields = frozenset(field.alias or name for name, field in cls.model_fields.items())
+        cls.required_fields = frozenset(
+            field.alias or name for name, field in cls.model_fields.items() if field.is_required())
+
+    @model_validator(mode='before')
+    @classmethod
+    def check_fields(cls, data):
+        if isinstance(data, dict):
+            extra_fields = set(data.keys()) - cls.valid_fields
+            missing_fields = set(cls.required_fields - data.keys())
+            if extra_fields:
+                raise PydanticCustomError(EXTRA_FIELDS_ERROR, f"Extra fields: {extra_fields}")
+            if missing_fields:
+                raise PydanticCustomError(MISSING_FIELDS_ERROR, f"Missing fields: {missing_fields}")
+        return data
+
+
+class PaymentRequest(RequestBody):
+    amount: Number
+    description: str
+
+
+class CreateCouponRequest(RequestBody):
+    coupon_code: str
+    discount_percent: Number
+    expiration_date: str
+    max_discount: Optional[Number] = None
+    max_redemptions: Optional[int] = None
+    category_rules: Optional[List[str]] = None
+    service_rules: Optional[List[str]] = None
+    provider_rules: Optional[List[str]] = None
+    location_rule: Optional[Location] = None
+    max_distance: Optional[Number] = None
+    users_rules: Optional[List[str]] = None
+
+    RULES: ClassVar[tuple] = ('category_rules', 'service_rules', 'provider_rules',
+                              'location_rule', 'max_distance', 'users_rules')
+
+    @field_validator('max_redemptions', mode='before')
+    @classmethod
+    def check_max_redemptions(cls, value):
+        if value is not None and (type(value) != int or value <= 0):
+            raise PydanticCustomError(INVALID_VALUE_ERROR, "Max redemptions must be a positive integer")
+        return value
+
+    def has_rules(self) -> bool:
+        return any(getattr(self, rule) is not None for rule in self.RULES)
+
+
+class RefundCouponRequest(RequestBody):
+    user_id: str
+    amount: Number
+
+
+class TransactionRequest(RequestBody):
+    points: Number
+    description: str
+
+
+class CashCouponRequest(RequestBody):
+    cash_discount: Number = Field(alias='CASH_DISCOUNT')
+
+
+class DiscountCouponRequest(RequestBody):
+    discount: Number = Field(alias='DISCOUNT')
+
+
+class ActivateCouponRequest(RequestBody):
+    # Clients send more fields than these (ignored), missing ones are listed comma separated
+    model_config = ConfigDict(extra='ignore')
+
+    client_location: Location
+    category: str
+    service_id: str
+    provider_id: str
+
+    @model_validator(mode='before')
+    @classmethod
+    def check_fields(cls, data):
+        if isinstance(data, dict) and not cls.required_fields <= data.keys():
+            missing_fields = cls.required_fields - data.keys()
+            raise PydanticCustomError(MISSING_FIELDS_ERROR, f"Missing fields: {', '.join(missing_fields)}")
+        return data
+
+
+class UserCouponsQuery(BaseModel):
+    user_id: str
+    client_location: Location
+
+
+class AvailableCouponsQuery(UserCouponsQuery):
+    category: str
+    service_id: str
+    provider_id: str
+
+
+def request_validation_detail(errors: list) -> Optional[str]:
+    """
+    Returns the detail of the 400 response for the given validation errors,
+    or None if FastAPI should answer as usual (422), e.g. for a missing query parameter.
+    """
+    for error in errors:
+        if error['type'] in REQUEST_ERROR_TYPES:
+            return error['msg']
+    for error in errors:
+        if error['loc'] and error['loc'][0] == 'body':
+            field = '.'.join(str(item) for item in error['loc'][1:])
+            return f"Invalid {field}: {error['msg']}" if field else error['msg']
+    return None
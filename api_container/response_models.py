@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional, Union
+from pydantic import BaseModel, ConfigDict
+
+# Response models of the endpoints with big payloads (coupon lists and loyalty history).
+# With a response model FastAPI serializes the response straight to JSON bytes with pydantic-core,
+# instead of going through jsonable_encoder and the stdlib json module.
+# The routes use response_model_exclude_unset, so the payload keeps the keys of the stored documents.
+
+Number = Union[int, float]
+
+
+class Coupon(BaseModel):
+    # Old documents may have fields that are no longer written, they are returned as they are
+    model_config = ConfigDict(extra='allow')
+
+    uuid: str
+    discount_percent: Optional[Number] = None
+    max_discount: Optional[Number] = None
+    expiration_date: Optional[str] = None
+    used_by: Optional[Dict[str, str]] = None
+    category_rules: Optional[List[str]] = None
+    service_rules: Optional[List[str]] = None
+    provider_rules: Optional[List[str]] = None
+    location_rule: Optional[Dict[str, Any]] = None
+    max_distance: Optional[Number] = None
+    users_rules: Optional[List[str]] = None
+    max_redemptions: Optional[int] = None
+    redemption_count: Optional[int] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+
+
+class CouponsResponse(BaseModel):
+    status: str
+    coupons: List[Coupon]
+
+
+class CouponSearchResponse(CouponsResponse):
+    next_cursor: Optional[str] = None
+
+
+class RefundCouponsResponse(BaseModel):
+    status: str
+    refund_coupons: List[Coupon]
+
+
+class HistoryEntry(BaseModel):
+    model_config = ConfigDict(extra='allow')
+
+    points: Optional[Number] = None
+    cash: Optional[Number] = None
+    coupon_id: Optional[str] = None
+    timestamp: str
+    description: str
+    event_id: Optional[str] = None
+    restored: Optional[bool] = None
+
+
+class HistoryResponse(BaseModel):
+    status: str
+    history: List[HistoryEntry]
+
+
+class ExpiringPoints(BaseModel):
+    points: Number
+    expiration_date: str
+
+
+class PointsResponse(BaseModel):
+    status: str
+    total_points: Number
+    expiring_dates: List[ExpiringPoints]
+
+
+class LoyaltyCounters(BaseModel):
+    points_issued: Number
+    points_redeemed: Number
+    points_restored: Number
+    points_expired: Number
+    client_payments: int
+    client_cash: Number
+    provider_cash: Number
+    coupons_used: int
+
+
+class DailyLoyaltyStats(LoyaltyCounters):
+    day: str
+
+
+class LoyaltyStatsResponse(BaseModel):
+    status: str
+    days: List[DailyLoyaltyStats]
+    totals: LoyaltyCounters
+
+
+class CouponDailyStats(BaseModel):
+    day: str
+    redemptions: int
+    categories: Dict[str, int]
+
+
+class CouponStatsResponse(BaseModel):
+    status: str
+    coupon_code: str
+    redemptions: int
+    categories: Dict[str, int]
+    days: List[CouponDailyStats]
@@ -0,0 +1,122 @@
+from typing import List, Dict
+import asyncio
+import logging as logger
+import time
+from stripe_events_nosql import AsyncStripeEvents
+from loyalty_nosql import AsyncLoyalty
+from lib.utils import get_timestamp_after_seconds
+
+CHECKOUT_SESSION_COMPLETED = 'checkout.session.completed'
+# Delayed payment methods complete the session unpaid, the payment is confirmed later by this event
+CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED = 'checkout.session.async_payment_succeeded'
+HANDLED_EVENT_TYPES = {CHECKOUT_SESSION_COMPLETED, CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED}
+STALE_CLAIM_SECONDS = 5 * 60
+CENTS = 100
+
+
+def checkout_session_data(session: Dict) -> Dict:
+    """
+    Fields of a checkout session that are kept in the events inbox.
+    """
+    metadata = session.get('metadata') or {}
+    return {
+        'session_id': session.get('id'),
+        'user_id': session.get('client_reference_id'),
+        'amount_total': session.get('amount_total'),
+        'currency': session.get('currency'),
+        'payment_status': session.get('payment_status'),
+        'service_id': metadata.get('service_id'),
+        'description': metadata.get('description')
+    }
+
+
+class StripeEventProcessor:
+    """
+    Applies the events received by the Stripe webhook in batches.
+    Paid checkout sessions (completed, or completed unpaid and then paid asynchronously)
+    are registered as client payments in the loyalty history.
+    """
+
+    def __init__(self,
+                 events: AsyncStripeEvents,
+                 loyalty_manager: AsyncLoyalty,
+                 batch_size: int = 100,
+                 max_attempts: int = 5):
+        self.events = events
+        self.loyalty_manager = loyalty_manager
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.metrics = {
+            'batches': 0,
+            'processed': 0,
+            'payments_registered': 0,
+            'skipped': 0,
+            'retried': 0,
+            'failed': 0,
+            'last_batch_size': 0,
+            'last_batch_duration': 0.0
+        }
+
+    async def process_once(self) -> int:
+        """
+        Processes one batch of the inbox. Returns the number of claimed events.
+        """
+        start = time.time()
+        events = await self.events.claim_batch(self.batch_size)
+        if not events:
+            return 0
+
+        payments = self._client_payments(events)
+        try:
+            registered = await self.loyalty_manager.register_client_payments(payments)
+        except Exception as e:
+            logger.error(f"Failed to register the Stripe payments: {e}")
+            failed = await self.events.schedule_retry(events, str(e), self.max_attempts)
+            self.metrics['failed'] += failed
+            self.metrics['retried'] += len(events) - failed
+            return len(events)
+        await self.events.mark_processed([event['_id'] for event in events])
+
+        duration = time.time() - start
+        self.metrics['batches'] += 1
+        self.metrics['processed'] += len(events)
+        self.metrics['payments_registered'] += registered
+        self.metrics['skipped'] += len(events) - len(payments)
+        self.metrics['last_batch_size'] = len(events)
+        self.metrics['last_batch_duration'] = duration
+        return len(events)
+
+    def _client_payments(self, events: List[Dict]) -> List[Dict]:
+        payments = []
+        for event in events:
+            data = event['data']
+            if event['type'] not in HANDLED_EVENT_TYPES or data.get('payment_status') != 'paid':
+                continue
+            if not data.get('user_id') or not data.get('amount_total'):
+                logger.debug(f"Stripe event {event['event_id']} has no user or amount, skipped")
+                continue
+            payments.append({
+                'user_id': data['user_id'],
+                'cash': data['amount_total'] / CENTS,
+                'description': data.get('description') or f"Payment for service {data.get('service_id')}",
+                'event_id': event['event_id']
+            })
+        return payments
+
+    async def get_metrics(self) -> Dict:
+        return {**self.metrics, 'pending': await self.events.count('pending')}
+
+    async def run(self, interval: float):
+        """
+        Processes the inbox forever. Full batches are followed immediately by the next one,
+        otherwise the processor waits 'interval' seconds.
+        """
+        while True:
+            try:
+                await self.events.requeue_stale(get_timestamp_after_seconds(-STALE_CLAIM_SECONDS))
+                claimed = await self.process_once()
+            except Exception as e:
+                logger.error(f"Stripe event processor error: {e}")
+                claimed = 0
+            if claimed < self.batch_size:
+                await asyncio.sleep(interval)
@@ -0,0 +1,164 @@
+from typing import Optional, List, Dict
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import datetime
+import logging as logger
+import os
+import uuid
+from lib.utils import get_actual_time, get_async_mongo_client, get_timestamp_after_seconds
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+PROCESSED = 'processed'
+FAILED = 'failed'
+
+RETRY_BASE_DELAY = 5  # Seconds, doubled on each attempt
+# Seconds a processed event is kept before the TTL index removes it, longer than the 3 days Stripe redelivers events.
+# An event redelivered after that is recorded again, register_client_payments does not credit it twice.
+DEFAULT_PROCESSED_RETENTION = 30 * 24 * 60 * 60
+
+
+@instrument_manager('stripe_events')
+class AsyncStripeEvents:
+    """
+    AsyncStripeEvents class that stores the received Stripe webhook events in a MongoDB collection.
+    The webhook only inserts the event, a background processor applies them in batches.
+    Stripe delivers events at least once, the unique event_id makes redeliveries a no-op.
+    Fields:
+    - event_id: str (unique) -> Stripe event id
+    - type: str -> Stripe event type
+    - data: Dict -> Relevant fields of the event object
+    - status: str -> 'pending' | 'processing' | 'processed' | 'failed'
+    - attempts: int -> Number of failed processing attempts
+    - next_attempt_at: datetime -> The event is not claimed before this time
+    - claim_id: str (optional) -> Id of the processor batch that claimed the event
+    - claimed_at: datetime (optional)
+    - last_error: str (optional)
+    - created_at: datetime
+    - updated_at: datetime
+    - expires_at: Date (optional) -> Set once processed, removed by a TTL index after STRIPE_EVENTS_RETENTION seconds
+    """
+
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
+        if test_client:
+            self.db = self.client[os.getenv('MONGO_TEST_DB')]
+        else:
+            self.db = self.client[test_db or os.getenv('MONGO_DB')]
+        self.collection = self.db['stripe_events']
+        self.processed_retention = int(os.getenv('STRIPE_EVENTS_RETENTION') or DEFAULT_PROCESSED_RETENTION)
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
+
+    async def _check_connection(self):
+        try:
+            await self.client.admin.command('ping')
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    async def _create_collection(self):
+        await self.collection.create_index([('event_id', ASCENDING)], unique=True)
+        await self.collection.create_index([('status', ASCENDING), ('next_attempt_at', ASCENDING)])
+        await self.collection.create_index([('claim_id', ASCENDING)])
+        await self.collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+
+    async def record(self, event_id: str, event_type: str, data: Dict) -> Optional[bool]:
+        """
+        Returns True if the event was recorded, False if it was already received and None on error.
+        """
+        actual_time = get_actual_time()
+        try:
+            await self.collection.insert_one({
+                'event_id': event_id,
+                'type': event_type,
+                'data': data,
+                'status': PENDING,
+                'attempts': 0,
+                'next_attempt_at': actual_time,
+                'created_at': actual_time,
+                'updated_at': actual_time
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+        except OperationFailure as e:
+            logger.error(f"OperationFailure: {e}")
+            return None
+
+    async def claim_batch(self, limit: int) -> List[Dict]:
+        actual_time = get_actual_time()
+        pending = await self.collection.find(
+            {'status': PENDING, 'next_attempt_at': {'$lte': actual_time}},
+            {'_id': 1}
+        ).sort('next_attempt_at', ASCENDING).limit(limit).to_list(None)
+        ids = [event['_id'] for event in pending]
+        if not ids:
+            return []
+
+        # The status filter makes the claim safe when several processors run
+        claim_id = str(uuid.uuid4())
+        await self.collection.update_many(
+            {'_id': {'$in': ids}, 'status': PENDING},
+            {'$set': {'status': PROCESSING, 'claim_id': claim_id, 'claimed_at': actual_time, 'updated_at': actual_time}}
+        )
+        return await self.collection.find({'claim_id': claim_id}).to_list(None)
+
+    async def mark_processed(self, ids: List) -> None:
+        if ids:
+            await self.collection.update_many(
+                {'_id': {'$in': ids}},
+                {'$set': {'status': PROCESSED, 'updated_at': get_actual_time(),
+                          'expires_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.processed_retention)},
+                 '$unset': {'claim_id': ''}}
+            )
+
+    async def schedule_retry(self, events: List[Dict], error: str, max_attempts: int) -> int:
+        """
+        Puts the events back in the inbox with an exponential backoff.
+        Events that reached max_attempts are marked as failed.
+        Returns the number of events marked as failed.
+        """
+        actual_time = get_actual_time()
+        failed = 0
+        for event in events:
+            attempts = event.get('attempts', 0) + 1
+            status = FAILED if attempts >= max_attempts else PENDING
+            failed += status == FAILED
+            await self.collection.update_one({'_id': event['_id']}, {
+                '$set': {
+                    'status': status,
+                    'attempts': attempts,
+                    'last_error': error,
+                    'next_attempt_at': get_timestamp_after_seconds(RETRY_BASE_DELAY * 2 ** (attempts - 1)),
+                    'updated_at': actual_time
+                },
+                '$unset': {'claim_id': ''}
+            })
+        return failed
+
+    async def requeue_stale(self, claimed_before: str) -> int:
+        """
+        Releases events claimed by a processor that died before finishing its batch.
+        """
+        result = await self.collection.update_many(
+            {'status': PROCESSING, 'claimed_at': {'$lt': claimed_before}},
+            {'$set': {'status': PENDING, 'updated_at': get_actual_time()}, '$unset': {'claim_id': ''}}
+        )
+        return result.modified_count
+
+    async def count(self, status: Optional[str] = None) -> int:
+        return await self.collection.count_documents({'status': status} if status else {})
+
+
+class StripeEvents(SyncManager):
+    """
+    Synchronous interface of AsyncStripeEvents.
+    """
+    async_class = AsyncStripeEvents
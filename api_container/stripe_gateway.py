@@ -0,0 +1,82 @@
+from typing import Optional, List, Dict
+import asyncio
+import os
+import uuid
+
+DEFAULT_TIMEOUT = 10  # Seconds
+DEFAULT_MAX_NETWORK_RETRIES = 2
+DEFAULT_MAX_CONCURRENCY = 50
+
+
+class StripeGateway:
+    """
+    Non blocking access to the Stripe API.
+    Requests go through Stripe's async HTTPX client (one pooled HTTP session per gateway),
+    with timeouts, network retries and a bound on the number of in-flight calls.
+    The Stripe SDK is loaded on the first call, it is not needed to start the API.
+    """
+
+    def __init__(self,
+                 api_key: Optional[str] = None,
+                 api_base: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 max_network_retries: Optional[int] = None,
+                 max_concurrency: Optional[int] = None):
+        self.api_key = api_key or os.getenv('STRIPE_SECRET') or ''
+        self.api_base = api_base or os.getenv('STRIPE_API_BASE')  # Allows a local stub server
+        self.timeout = timeout or float(os.getenv('STRIPE_TIMEOUT') or DEFAULT_TIMEOUT)
+        self.max_network_retries = max_network_retries if max_network_retries is not None else int(
+            os.getenv('STRIPE_MAX_NETWORK_RETRIES') or DEFAULT_MAX_NETWORK_RETRIES)
+        self._client = None
+        self._semaphore = asyncio.Semaphore(
+            max_concurrency or int(os.getenv('STRIPE_MAX_CONCURRENCY') or DEFAULT_MAX_CONCURRENCY))
+
+    @property
+    def client(self):
+        if self._client is None:
+            import stripe
+            self._client = stripe.StripeClient(
+                self.api_key,
+                http_client=stripe.HTTPXClient(timeout=self.timeout),
+                max_network_retries=self.max_network_retries,
+                base_addresses={'api': self.api_base} if self.api_base else None
+            )
+        return self._client
+
+    async def create_price(self, service_id: str, amount: int, currency: str):
+        """
+        Creates a Price (and its Product) for a service, to be reused by its checkout sessions.
+        """
+        async with self._semaphore:
+            return await self.client.v1.prices.create_async(
+                params={
+                    'currency': currency,
+                    'unit_amount': amount,
+                    'product_data': {'name': f"Service {service_id}", 'metadata': {'service_id': service_id}},
+                    'metadata': {'service_id': service_id}
+                },
+                options={'idempotency_key': f"price_{service_id}_{amount}_{currency}"}
+            )
+
+    async def create_checkout_session(self,
+                                      line_items: List[Dict],
+                                      success_url: str,
+                                      cancel_url: str,
+                                      idempotency_key: Optional[str] = None,
+                                      **params):
+        """
+        Creates a checkout session. Retries of the same request must reuse the idempotency key,
+        so Stripe returns the session created by the first attempt.
+        """
+        async with self._semaphore:
+            return await self.client.v1.checkout.sessions.create_async(
+                params={
+                    'payment_method_types': ['card'],
+                    'line_items': line_items,
+                    'mode': 'payment',
+                    'success_url': success_url,
+                    'cancel_url': cancel_url,
+                    **params
+                },
+                options={'idempotency_key': idempotency_key or str(uuid.uuid4())}
+            )
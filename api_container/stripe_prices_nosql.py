@@ -0,0 +1,106 @@
+from typing import Optional
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import logging as logger
+import os
+from lib.utils import get_actual_time, get_async_mongo_client, LRUCache
+from lib.async_mongo import SyncManager, as_async_client
+from lib.metrics import instrument_manager
+
+PRICE_CACHE_SIZE = 10_000
+
+
+@instrument_manager('stripe_prices')
+class AsyncStripePrices:
+    """
+    AsyncStripePrices class that stores the Stripe Prices created for each service in a MongoDB collection.
+    Lookups are served from an in-process LRU cache in front of the collection.
+    Fields:
+    - service_id: str
+    - amount: int (cents)
+    - currency: str
+    - price_id: str -> Stripe Price id
+    - product_id: str -> Stripe Product id
+    - created_at: datetime
+    (service_id, amount, currency) is unique
+    """
+
+    def __init__(self, test_client=None, test_db=None, client=None):
+        self.client = as_async_client(client or test_client) if (client or test_client) else get_async_mongo_client()
+        if test_client:
+            self.db = self.client[os.getenv('MONGO_TEST_DB')]
+        else:
+            self.db = self.client[test_db or os.getenv('MONGO_DB')]
+        self.collection = self.db['stripe_prices']
+        # (service_id, amount, currency) -> price_id
+        self.prices_cache = LRUCache(PRICE_CACHE_SIZE)
+
+    async def initialize(self):
+        if not await self._check_connection():
+            raise Exception("Failed to connect to MongoDB")
+        await self._create_collection()
+
+    async def _check_connection(self):
+        try:
+            await self.client.admin.command('ping')
+        except Exception as e:
+            logger.error(e)
+            return False
+        return True
+
+    async def _create_collection(self):
+        await self.collection.create_index(
+            [('service_id', ASCENDING), ('amount', ASCENDING), ('currency', ASCENDING)], unique=True)
+        await self.collection.create_index([('created_at', DESCENDING)])
+
+    async def get_price_id(self, service_id: str, amount: int, currency: str) -> Optional[str]:
+        key = (service_id, amount, currency.lower())
+        price_id = self.prices_cache.get(key)
+        if price_id:
+            return price_id
+        price = await self.collection.find_one(
+            {'service_id': service_id, 'amount': amount, 'currency': currency.lower()},
+            {'_id': 0, 'price_id': 1})
+        if not price:
+            return None
+        self.prices_cache.set(key, price['price_id'])
+        return price['price_id']
+
+    async def save(self, service_id: str, amount: int, currency: str, price_id: str, product_id: Optional[str] = None) -> bool:
+        """
+        Returns False if another request already saved a price for the same key.
+        """
+        try:
+            await self.collection.insert_one({
+                'service_id': service_id,
+                'amount': amount,
+                'currency': currency.lower(),
+                'price_id': price_id,
+                'product_id': product_id,
+                'created_at': get_actual_time()
+            })
+        except DuplicateKeyError:
+            return False
+        except OperationFailure as e:
+            logger.error(f"OperationFailure: {e}")
+            return False
+        self.prices_cache.set((service_id, amount, currency.lower()), price_id)
+        return True
+
+    async def warm_cache(self, limit: int = PRICE_CACHE_SIZE) -> int:
+        """
+        Loads the most recent prices in the cache. Returns the number of loaded prices.
+        """
+        prices = await self.collection.find(
+            {}, {'_id': 0, 'service_id': 1, 'amount': 1, 'currency': 1, 'price_id': 1}
+        ).sort('created_at', DESCENDING).limit(limit).to_list(None)
+        for price in reversed(prices):
+            self.prices_cache.set((price['service_id'], price['amount'], price['currency']), price['price_id'])
+        return len(prices)
+
+
+class StripePrices(SyncManager):
+    """
+    Synchronous interface of AsyncStripePrices.
+    """
+    async_class = AsyncStripePrices
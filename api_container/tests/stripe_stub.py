@@ -0,0 +1,80 @@
+import asyncio
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl
+from typing import Optional
+from fastapi import FastAPI, Request
+import uvicorn
+
+# Local stand-in for the Stripe API, used by the tests and the benchmarks.
+# Run it with StripeStubServer().start() and point STRIPE_API_BASE to its 'url'.
+
+
+class StripeStubServer:
+
+    def __init__(self, latency: float = 0.0, port: Optional[int] = None):
+        self.latency = latency
+        self.port = port or _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.requests = []
+        self._sessions = {}  # idempotency key -> session
+        self._prices = {}  # idempotency key -> price
+        self._server = uvicorn.Server(uvicorn.Config(self._create_app(), host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/v1/checkout/sessions")
+        async def create_checkout_session(request: Request):
+            form = dict(parse_qsl((await request.body()).decode()))
+            idempotency_key = request.headers.get("idempotency-key")
+            self.requests.append({'path': request.url.path, 'form': form, 'idempotency_key': idempotency_key})
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if idempotency_key not in self._sessions:
+                session_id = f"cs_test_{uuid.uuid4().hex}"
+                self._sessions[idempotency_key] = {
+                    "id": session_id,
+                    "object": "checkout.session",
+                    "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+                    "mode": "payment",
+                }
+            return self._sessions[idempotency_key]
+
+        @app.post("/v1/prices")
+        async def create_price(request: Request):
+            form = dict(parse_qsl((await request.body()).decode()))
+            idempotency_key = request.headers.get("idempotency-key")
+            self.requests.append({'path': request.url.path, 'form': form, 'idempotency_key': idempotency_key})
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if idempotency_key not in self._prices:
+                self._prices[idempotency_key] = {
+                    "id": f"price_{uuid.uuid4().hex}",
+                    "object": "price",
+                    "product": f"prod_{uuid.uuid4().hex}",
+                    "currency": form.get("currency"),
+                    "unit_amount": int(form.get("unit_amount", 0)),
+                }
+            return self._prices[idempotency_key]
+
+        return app
+
+    def start(self) -> "StripeStubServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import mongomock
 from unittest.mock import patch
@@ -342,4 +343,168 @@ def test_obtain_available_coupons_mixed_rules(coupons, mocker):
     assert len(new_coupons_list) == 2
     assert all([coupon['uuid'] in ['TEST_COUPON_2', 'TEST_COUPON_4'] for coupon in new_coupons_list])
 
-    
\ No newline at end of file
+    
+def test_add_user_to_coupon_twice(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    success = coupons.insert(
+        coupon_code= 'TEST_COUPON',
+        discount_percent= 10,
+        expiration_date= '2023-01-02 00:00:00'
+    )
+    assert success == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER') == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER') == False
+    coupon = coupons.get('TEST_COUPON')
+    assert coupon['redemption_count'] == 1
+
+def test_add_user_to_coupon_max_redemptions(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    success = coupons.insert(
+        coupon_code= 'TEST_COUPON',
+        discount_percent= 10,
+        expiration_date= '2023-01-02 00:00:00',
+        max_redemptions= 2
+    )
+    assert success == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_1') == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_2') == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_3') == False
+    coupon = coupons.get('TEST_COUPON')
+    assert coupon['redemption_count'] == 2
+    assert 'TEST_USER_3' not in coupon['used_by']
+
+def test_remove_user_from_coupon_frees_redemption(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    success = coupons.insert(
+        coupon_code= 'TEST_COUPON',
+        discount_percent= 10,
+        expiration_date= '2023-01-02 00:00:00',
+        max_redemptions= 1
+    )
+    assert success == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_1') == True
+    assert coupons.remove_user_from_coupon('TEST_COUPON', 'TEST_USER_1') == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_2') == True
+    coupon = coupons.get('TEST_COUPON')
+    assert coupon['redemption_count'] == 1
+    assert list(coupon['used_by'].keys()) == ['TEST_USER_2']
+
+def test_search_coupons_filters(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    success = coupons.insert(
+        coupon_code= 'SUMMER_1',
+        discount_percent= 10,
+        expiration_date= '2050-01-02 00:00:00',
+        category_rules= ['TEST_CATEGORY_ALPHA', 'TEST_CATEGORY_BETA']
+    )
+    success &= coupons.insert(
+        coupon_code= 'SUMMER_2',
+        discount_percent= 10,
+        expiration_date= '2030-01-02 00:00:00',
+        location_rule= {'longitude': 0, 'latitude': 0},
+        max_distance= 10
+    )
+    success &= coupons.insert(
+        coupon_code= 'REFUND_TEST_USER_1',
+        discount_percent= 100,
+        expiration_date= '2050-01-02 00:00:00',
+        users_rules= ['TEST_USER']
+    )
+    assert success == True
+
+    assert [c['uuid'] for c in coupons.search(code_prefix='SUMMER')] == ['SUMMER_1', 'SUMMER_2']
+    assert [c['uuid'] for c in coupons.search(kind='refund')] == ['REFUND_TEST_USER_1']
+    assert [c['uuid'] for c in coupons.search(kind='regular')] == ['SUMMER_1', 'SUMMER_2']
+    assert [c['uuid'] for c in coupons.search(category='TEST_CATEGORY_BETA')] == ['SUMMER_1']
+    assert [c['uuid'] for c in coupons.search(expires_before='2040-01-01 00:00:00')] == ['SUMMER_2']
+    assert [c['uuid'] for c in coupons.search(has_location_rule=True)] == ['SUMMER_2']
+    assert [c['uuid'] for c in coupons.search(has_location_rule=False)] == ['REFUND_TEST_USER_1', 'SUMMER_1']
+
+def test_search_coupons_keyset_pagination(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    for i in range(5):
+        assert coupons.insert(
+            coupon_code= f'TEST_COUPON_{i}',
+            discount_percent= 10,
+            expiration_date= '2050-01-02 00:00:00'
+        ) == True
+
+    first_page = coupons.search(limit=2, fields=['discount_percent'])
+    assert first_page == [{'uuid': 'TEST_COUPON_0', 'discount_percent': 10}, {'uuid': 'TEST_COUPON_1', 'discount_percent': 10}]
+    second_page = coupons.search(limit=2, after=first_page[-1]['uuid'])
+    assert [c['uuid'] for c in second_page] == ['TEST_COUPON_2', 'TEST_COUPON_3']
+    last_page = coupons.search(limit=2, after=second_page[-1]['uuid'])
+    assert [c['uuid'] for c in last_page] == ['TEST_COUPON_4']
+
+def test_obtain_available_coupons_location_rule(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    success = coupons.insert(
+        coupon_code= 'TEST_COUPON_NEAR',
+        discount_percent= 10,
+        expiration_date= '2050-01-02 00:00:00',
+        location_rule= {'longitude': -58.3816, 'latitude': -34.6037}, # Obelisco
+        max_distance= 10
+    )
+    success &= coupons.insert(
+        coupon_code= 'TEST_COUPON_FAR',
+        discount_percent= 10,
+        expiration_date= '2050-01-02 00:00:00',
+        location_rule= {'longitude': -64.1888, 'latitude': -31.4201}, # Cordoba
+        max_distance= 10
+    )
+    assert success == True
+
+    coupons_list = coupons.obtain_available_coupons(
+        user_id='TEST_USER',
+        client_location={'longitude': -58.370389080417, 'latitude': -34.61647029094048}, # TF
+        category='TEST_CATEGORY',
+        service_id='TEST_SERVICE',
+        provider_id='TEST_PROVIDER'
+    )
+    assert [coupon['uuid'] for coupon in coupons_list] == ['TEST_COUPON_NEAR']
+
+def test_obtain_available_coupons_shares_concurrent_queries(coupons, mocker):
+    mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    coupons.insert(coupon_code='TEST_COUPON', discount_percent=10, expiration_date='2050-01-02 00:00:00')
+    coupons.insert(coupon_code='TEST_COUPON_2', discount_percent=10, expiration_date='2050-01-02 00:00:00', users_rules=['TEST_USER_2'])
+    coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_3')
+    manager = coupons.async_manager
+    queries = mocker.spy(manager, '_available_coupon_candidates')
+    location = {'longitude': -58.370389080417, 'latitude': -34.61647029094048}
+
+    async def obtain_concurrently():
+        return await asyncio.gather(*[
+            manager.obtain_available_coupons(user_id, location, 'TEST_CATEGORY', 'TEST_SERVICE', 'TEST_PROVIDER')
+            for user_id in ['TEST_USER', 'TEST_USER_2', 'TEST_USER_3']])
+
+    users_coupons = asyncio.run(obtain_concurrently())
+    assert queries.call_count == 1
+    assert [sorted(coupon['uuid'] for coupon in user_coupons) for user_coupons in users_coupons] == [
+        ['TEST_COUPON'], ['TEST_COUPON', 'TEST_COUPON_2'], []]
+
+    # A new coupon is visible right away
+    coupons.insert(coupon_code='TEST_COUPON_3', discount_percent=10, expiration_date='2050-01-02 00:00:00')
+    users_coupons = asyncio.run(obtain_concurrently())
+    assert queries.call_count == 2
+    assert [coupon['uuid'] for coupon in users_coupons[2]] == ['TEST_COUPON_3']
+
+def test_redemption_stats(coupons, mocker):
+    actual_time = mocker.patch('coupons_nosql.get_actual_time', return_value='2023-01-01 10:00:00')
+    coupons.insert(coupon_code='TEST_COUPON', discount_percent=10, expiration_date='2050-01-02 00:00:00')
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_1', 'TEST_CATEGORY_ALPHA') == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_2', 'TEST_CATEGORY_BETA') == True
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_2', 'TEST_CATEGORY_BETA') == False  # Not counted
+
+    actual_time.return_value = '2023-01-02 10:00:00'
+    assert coupons.add_user_to_coupon('TEST_COUPON', 'TEST_USER_3', 'TEST_CATEGORY_ALPHA') == True
+    assert coupons.mark_coupon_as_used('TEST_COUPON', 'TEST_USER_4') == True
+    assert coupons.mark_coupon_as_used('TEST_COUPON', 'TEST_USER_4') == False  # Already used, not counted
+    # A rollback discounts the redemption from the day it was counted
+    assert coupons.remove_user_from_coupon('TEST_COUPON', 'TEST_USER_2', 'TEST_CATEGORY_BETA') == True
+
+    assert coupons.get_redemption_stats('TEST_COUPON') == [
+        {'day': '2023-01-01', 'redemptions': 1, 'categories': {'TEST_CATEGORY_ALPHA': 1, 'TEST_CATEGORY_BETA': 0}},
+        {'day': '2023-01-02', 'redemptions': 2, 'categories': {'TEST_CATEGORY_ALPHA': 1}},
+    ]
+    assert [day['day'] for day in coupons.get_redemption_stats('TEST_COUPON', from_day='2023-01-02')] == ['2023-01-02']
+    assert coupons.get_redemption_stats('TEST_COUPON_2') == []
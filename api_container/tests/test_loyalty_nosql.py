@@ -157,4 +157,125 @@ def test_get_expiring_points(loyalty, mocker):
 
     expiring_points = loyalty.get_expiring_points('user_id')
     assert len(expiring_points) == 1
-    assert {'points': 100, 'expiration_date': '2027-01-01'} in expiring_points
\ No newline at end of file
+    assert {'points': 100, 'expiration_date': '2027-01-01'} in expiring_points
+
+def test_register_client_payments(loyalty, mocker):
+    assert loyalty._create_user_doc('user_1') == True
+    payments = [
+        {'user_id': 'user_1', 'cash': 10, 'description': 'Payment 1', 'event_id': 'evt_1'},
+        {'user_id': 'user_1', 'cash': 20, 'description': 'Payment 2', 'event_id': 'evt_2'},
+        {'user_id': 'user_2', 'cash': 30, 'description': 'Payment 3', 'event_id': 'evt_3'},
+        {'user_id': 'user_2', 'cash': 30, 'description': 'Payment 3', 'event_id': 'evt_3'},
+    ]
+    assert loyalty.register_client_payments(payments) == 3
+    assert [entry['cash'] for entry in loyalty.get_history('user_1')] == [-10, -20]
+    assert [entry['cash'] for entry in loyalty.get_history('user_2')] == [-30]
+
+    # Already registered events are skipped
+    assert loyalty.register_client_payments(payments[1:]) == 0
+    assert len(loyalty.get_history('user_1')) == 2
+
+def test_register_client_payments_concurrent_batch(loyalty, mocker):
+    loyalty.register_client_payments([{'user_id': 'user_1', 'cash': 10, 'description': 'Payment 1', 'event_id': 'evt_1'}])
+    find = loyalty.async_manager.collection.find
+
+    def find_before_concurrent_batch(query, *args, **kwargs):
+        # The concurrent batch registers evt_1 after the applied events were read
+        if 'history.event_id' in query:
+            query = {'uuid': None}
+        return find(query, *args, **kwargs)
+    mocker.patch.object(loyalty.async_manager.collection, 'find', side_effect=find_before_concurrent_batch)
+
+    payments = [
+        {'user_id': 'user_1', 'cash': 10, 'description': 'Payment 1', 'event_id': 'evt_1'},
+        {'user_id': 'user_1', 'cash': 20, 'description': 'Payment 2', 'event_id': 'evt_2'},
+    ]
+    assert loyalty.register_client_payments(payments) == 1
+    assert [entry['event_id'] for entry in loyalty.get_history('user_1')] == ['evt_1', 'evt_2']
+
+def test_register_client_payments_user_creation_fails(loyalty, mocker):
+    mocker.patch.object(loyalty.async_manager, '_create_user_doc', return_value=False)
+    with pytest.raises(Exception):
+        loyalty.register_client_payments([{'user_id': 'user_1', 'cash': 10, 'description': 'Payment 1', 'event_id': 'evt_1'}])
+
+def test_use_points(loyalty, mocker):
+    loyalty._create_user_doc('user_id')
+    loyalty.collection.update_one({'uuid': 'user_id'}, {'$set': {
+        'points': [('2030-01-01', 30), ('2020-01-01', 40), ('2028-01-01', 50)]}})
+
+    assert loyalty.use_points('user_id', 90, 'Test use points') == False  # 40 points expired
+    assert loyalty.use_points('user_id', 60, 'Test use points') == [('2028-01-01', 50), ('2030-01-01', 10)]
+    assert loyalty.collection.find_one({'uuid': 'user_id'})['points'] == [['2030-01-01', 20]]
+    history = loyalty.collection.find_one({'uuid': 'user_id'})['history']
+    assert [entry['points'] for entry in history] == [-40, -60]
+    assert loyalty.use_points('unknown_user', 10, 'Test use points') == False
+
+def test_use_points_concurrent_update(loyalty, mocker):
+    loyalty.add_transaction('user_id', 100, 'Test positive transaction')
+    find_one = loyalty.async_manager.collection.find_one
+
+    async def concurrent_find_one(*args, **kwargs):
+        # Another request spends points between the read and the conditional update
+        user = await find_one(*args, **kwargs)
+        if concurrent_find_one.calls == 0:
+            loyalty.collection.update_one({'uuid': 'user_id'}, {'$set': {'points': [('2099-01-01', 20)]}})
+        concurrent_find_one.calls += 1
+        return user
+    concurrent_find_one.calls = 0
+    mocker.patch.object(loyalty.async_manager.collection, 'find_one', concurrent_find_one)
+
+    assert loyalty.use_points('user_id', 50, 'Test use points') == False
+    assert concurrent_find_one.calls == 2
+    assert loyalty.get_total_points('user_id') == 20
+
+def test_daily_stats(loyalty, mocker):
+    actual_time = mocker.patch('loyalty_nosql.get_actual_time', return_value='2025-01-01 10:00:00')
+    mocker.patch('loyalty_nosql.get_timestamp_after_days', return_value='2025-01-03 00:00:00')
+    loyalty.add_transaction('user_1', 100, 'Test positive transaction')
+    loyalty.add_transaction('user_2', 50, 'Test positive transaction')
+    loyalty.register_client_payment('user_1', 30, 'Test payment')
+    loyalty.register_coupon_use('user_1', 'TEST_COUPON', 'Test coupon use')
+
+    actual_time.return_value = '2025-01-02 10:00:00'
+    assert loyalty.use_points('user_1', 40, 'Test use points') == [('2025-01-03 00:00:00', 40)]
+    assert loyalty.restore_points('user_1', [('2025-01-03 00:00:00', 10.5)], 'Refund of: Test use points') == True
+    loyalty.register_client_payments([{'user_id': 'user_2', 'cash': 20, 'description': 'Test payment', 'event_id': 'evt_1'}])
+    loyalty.register_payment_to_provider('provider_1', 45, 'Test provider payment')
+
+    actual_time.return_value = '2025-01-04 10:00:00'
+    loyalty.get_total_points('user_2')  # Expires its 50 points
+
+    empty = {'points_issued': 0, 'points_redeemed': 0, 'points_restored': 0, 'points_expired': 0, 'client_payments': 0, 'client_cash': 0, 'provider_cash': 0, 'coupons_used': 0}
+    expected = [
+        {**empty, 'day': '2025-01-01', 'points_issued': 150, 'client_payments': 1, 'client_cash': 30, 'coupons_used': 1},
+        {**empty, 'day': '2025-01-02', 'points_redeemed': 40, 'points_restored': 10.5, 'client_payments': 1, 'client_cash': 20, 'provider_cash': 45},
+        {**empty, 'day': '2025-01-03', 'points_expired': 50},
+    ]
+    assert loyalty.get_daily_stats() == expected
+    assert loyalty.get_daily_stats(from_day='2025-01-02', to_day='2025-01-02') == expected[1:2]
+
+    # The rollups match the ones recomputed from the history
+    assert loyalty.rebuild_daily_stats() == 3
+    assert loyalty.get_daily_stats() == expected
+
+def test_concurrent_expiration_recorded_once(loyalty, mocker):
+    mocker.patch('loyalty_nosql.get_actual_time', return_value='2025-01-04 10:00:00')
+    loyalty._create_user_doc('user_id')
+    loyalty.collection.update_one({'uuid': 'user_id'}, {'$set': {'points': [('2025-01-03 00:00:00', 50), ('2099-01-01', 10)]}})
+    find_one = loyalty.async_manager.collection.find_one
+
+    async def concurrent_find_one(*args, **kwargs):
+        # Another request expires the same points between the read and the conditional update
+        user = await find_one(*args, **kwargs)
+        if concurrent_find_one.calls == 0:
+            concurrent_find_one.calls += 1
+            await loyalty.async_manager._update_user_doc('user_id')
+        return user
+    concurrent_find_one.calls = 0
+    mocker.patch.object(loyalty.async_manager.collection, 'find_one', concurrent_find_one)
+
+    assert loyalty._update_user_doc('user_id') == True
+    user = loyalty.collection.find_one({'uuid': 'user_id'})
+    assert user['points'] == [['2099-01-01', 10]]
+    assert [entry['points'] for entry in user['history']] == [-50]
+    assert [day['points_expired'] for day in loyalty.get_daily_stats()] == [50]
@@ -0,0 +1,138 @@
+import pytest
+import mongomock
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from mobile_token_nosql import MobileToken
+
+# Run with the following command:
+# pytest PaymentsService/api_container/tests/test_mobile_token_nosql.py
+
+# Set the TESTING environment variable
+os.environ['TESTING'] = '1'
+os.environ['MONGOMOCK'] = '1'
+
+# Set a default MONGO_TEST_DB for testing
+os.environ['MONGO_TEST_DB'] = 'test_db'
+
+@pytest.fixture(scope='function')
+def mongo_client():
+    client = mongomock.MongoClient()
+    yield client
+    client.drop_database(os.getenv('MONGO_TEST_DB'))
+    client.close()
+
+@pytest.fixture(scope='function')
+def mobile_tokens(mongo_client):
+    return MobileToken(test_client=mongo_client)
+
+def test_save_notification(mobile_tokens, mocker):
+    mocker.patch('mobile_token_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    mobile_tokens._save_notification('user_id', 'Title', 'Message')
+
+    notifications = mobile_tokens.get_notifications('user_id')
+    assert notifications['notifications'] == [{'title': 'Title', 'message': 'Message', 'created_at': '2023-01-01 00:00:00'}]
+    assert notifications['unread_count'] == 1
+    assert notifications['total'] == 1
+
+def test_get_notifications_new_user(mobile_tokens):
+    notifications = mobile_tokens.get_notifications('user_id')
+    assert notifications == {'notifications': [], 'unread_count': 0, 'total': 0}
+
+def test_notifications_retention(mobile_tokens):
+    mobile_tokens.notifications_retention = 3
+    for i in range(5):
+        mobile_tokens._save_notification('user_id', f'Title {i}', 'Message')
+
+    notifications = mobile_tokens.get_notifications('user_id')
+    assert [n['title'] for n in notifications['notifications']] == ['Title 4', 'Title 3', 'Title 2']
+    assert notifications['unread_count'] == 3
+    assert notifications['total'] == 3
+
+def test_notifications_pagination(mobile_tokens):
+    for i in range(5):
+        mobile_tokens._save_notification('user_id', f'Title {i}', 'Message')
+
+    first_page = mobile_tokens.get_notifications('user_id', page=0, page_size=2)
+    assert [n['title'] for n in first_page['notifications']] == ['Title 4', 'Title 3']
+    last_page = mobile_tokens.get_notifications('user_id', page=2, page_size=2)
+    assert [n['title'] for n in last_page['notifications']] == ['Title 0']
+    assert last_page['total'] == 5
+
+def test_migrate_legacy_notifications(mobile_tokens, mocker):
+    # Written before the notifications were stored newest first, then one more pushed by the new code
+    legacy = [{'title': f'Title {i}', 'message': 'Message', 'created_at': f'2023-01-0{i} 00:00:00'} for i in range(1, 4)]
+    mobile_tokens.notifications.insert_one({'user_id': 'user_id', 'notifications': legacy})
+    mocker.patch('mobile_token_nosql.get_actual_time', return_value='2023-01-04 00:00:00')
+    mobile_tokens._save_notification('user_id', 'Title 4', 'Message')
+
+    assert mobile_tokens.migrate_notifications() == 1
+    notifications = mobile_tokens.get_notifications('user_id', page_size=2)
+    assert [n['title'] for n in notifications['notifications']] == ['Title 4', 'Title 3']
+    assert notifications['total'] == 4
+    assert mobile_tokens.migrate_notifications() == 0
+
+def test_mark_notifications_as_read(mobile_tokens):
+    assert mobile_tokens.mark_notifications_as_read('user_id') == False
+    mobile_tokens._save_notification('user_id', 'Title', 'Message')
+    assert mobile_tokens.mark_notifications_as_read('user_id') == True
+
+    notifications = mobile_tokens.get_notifications('user_id')
+    assert notifications['unread_count'] == 0
+    assert len(notifications['notifications']) == 1
+
+def test_update_mobile_token(mobile_tokens, mocker):
+    mocker.patch('mobile_token_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    mobile_tokens.update_mobile_token('user_id', 'token_1')
+    mocker.patch('mobile_token_nosql.get_actual_time', return_value='2023-01-02 00:00:00')
+    mobile_tokens.update_mobile_token('user_id', 'token_2')
+
+    doc = mobile_tokens.collection.find_one({'user_id': 'user_id'})
+    assert doc['mobile_token'] == 'token_2'
+    assert doc['created_at'] == '2023-01-01 00:00:00'
+    assert doc['updated_at'] == '2023-01-02 00:00:00'
+    assert mobile_tokens.get_mobile_token('user_id') == 'token_2'
+
+def test_get_mobile_tokens(mobile_tokens):
+    for i in range(3):
+        mobile_tokens.update_mobile_token(f'user_{i}', f'token_{i}')
+    mobile_tokens.tokens_cache.clear()
+
+    tokens = mobile_tokens.get_mobile_tokens(['user_0', 'user_2', 'user_without_token'])
+    assert tokens == {'user_0': 'token_0', 'user_2': 'token_2'}
+
+    # Second lookup is served from the cache
+    mobile_tokens.collection.drop()
+    assert mobile_tokens.get_mobile_tokens(['user_0', 'user_without_token']) == {'user_0': 'token_0'}
+
+def test_get_mobile_tokens_expired_entry(mobile_tokens, mocker):
+    mobile_tokens.update_mobile_token('user_0', 'token_0')
+    mobile_tokens.tokens_cache.ttl = 0
+    # The entry expires between a membership check and the read
+    mocker.patch.object(type(mobile_tokens.tokens_cache), '__contains__', return_value=True)
+    assert mobile_tokens.get_mobile_tokens(['user_0']) == {'user_0': 'token_0'}
+
+def test_prune_mobile_tokens(mobile_tokens):
+    mobile_tokens.update_mobile_token('user_1', 'token_1')
+    mobile_tokens.update_mobile_token('user_2', 'token_2')
+
+    assert mobile_tokens.prune_mobile_tokens(['token_2', 'unknown_token']) == 1
+    assert mobile_tokens.get_mobile_tokens(['user_1', 'user_2']) == {'user_1': 'token_1'}
+    mobile_tokens.tokens_cache.clear()
+    assert mobile_tokens.get_mobile_tokens(['user_1', 'user_2']) == {'user_1': 'token_1'}
+
+def test_tokens_cache_sees_other_workers_updates(mongo_client, mocker):
+    # Two workers, each one with its own cache over the same database
+    worker_1, worker_2 = MobileToken(test_client=mongo_client), MobileToken(test_client=mongo_client)
+    worker_1.update_mobile_token('user_1', 'token_1')
+    assert worker_2.get_mobile_tokens(['user_1']) == {'user_1': 'token_1'}
+
+    worker_1.update_mobile_token('user_1', 'new_token_1')
+    assert worker_2.get_mobile_tokens(['user_1']) == {'user_1': 'token_1'}  # Until the next sync
+
+    mocker.patch('mobile_token_nosql.TOKEN_CACHE_SYNC_INTERVAL', 0)
+    assert worker_2.get_mobile_tokens(['user_1']) == {'user_1': 'new_token_1'}
+    worker_1.prune_mobile_tokens(['new_token_1'])
+    assert worker_2.get_mobile_tokens(['user_1']) == {}
@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+import mongomock
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from notification_outbox_nosql import NotificationOutbox
+from notification_dispatcher import NotificationDispatcher, FakeSender, MAX_MULTICAST_TOKENS
+from mobile_token_nosql import MobileToken
+
+# Run with the following command:
+# pytest PaymentsService/api_container/tests/test_notification_dispatcher.py
+
+# Set the TESTING environment variable
+os.environ['TESTING'] = '1'
+os.environ['MONGOMOCK'] = '1'
+
+# Set a default MONGO_TEST_DB for testing
+os.environ['MONGO_TEST_DB'] = 'test_db'
+
+@pytest.fixture(scope='function')
+def mongo_client():
+    client = mongomock.MongoClient()
+    yield client
+    client.drop_database(os.getenv('MONGO_TEST_DB'))
+    client.close()
+
+@pytest.fixture(scope='function')
+def outbox(mongo_client):
+    return NotificationOutbox(test_client=mongo_client)
+
+@pytest.fixture(scope='function')
+def mobile_tokens(mongo_client):
+    return MobileToken(test_client=mongo_client)
+
+def test_enqueue_and_dispatch_stores_notifications(outbox, mobile_tokens):
+    assert outbox.enqueue('user_1', 'Title', 'Message') == True
+    assert outbox.enqueue('user_2', 'Title', 'Message') == True
+
+    dispatcher = NotificationDispatcher(outbox.async_manager, mobile_tokens.async_manager)
+    assert asyncio.run(dispatcher.dispatch_once()) == 2
+    assert asyncio.run(dispatcher.dispatch_once()) == 0
+
+    assert outbox.count('sent') == 2
+    # Sent entries are removed by the TTL index
+    assert all(entry.get('expires_at') for entry in outbox.collection.find({'status': 'sent'}))
+    notifications = mobile_tokens._get_user_notifications('user_1')
+    assert [n['title'] for n in notifications['notifications']] == ['Title']
+
+def test_dispatch_multicast_chunks(outbox, mobile_tokens):
+    users = MAX_MULTICAST_TOKENS + 10
+    for i in range(users):
+        mobile_tokens.update_mobile_token(f'user_{i}', f'token_{i}')
+        outbox.enqueue(f'user_{i}', 'Promo', 'New coupons available')
+
+    sender = FakeSender()
+    dispatcher = NotificationDispatcher(outbox.async_manager, mobile_tokens.async_manager, sender=sender, batch_size=users)
+    assert asyncio.run(dispatcher.dispatch_once()) == users
+
+    assert [len(call['tokens']) for call in sender.calls] == [MAX_MULTICAST_TOKENS, 10]
+    assert asyncio.run(dispatcher.get_metrics())['dispatched'] == users
+    assert asyncio.run(dispatcher.get_metrics())['multicast_calls'] == 2
+
+def test_dispatch_retries_failed_deliveries(outbox, mobile_tokens, mocker):
+    mobile_tokens.update_mobile_token('user_1', 'token_1')
+    mobile_tokens.update_mobile_token('user_2', 'bad_token')
+    outbox.enqueue('user_1', 'Title', 'Message')
+    outbox.enqueue('user_2', 'Title', 'Message')
+
+    sender = FakeSender(failing_tokens={'bad_token'})
+    dispatcher = NotificationDispatcher(outbox.async_manager, mobile_tokens.async_manager, sender=sender, max_attempts=2)
+    asyncio.run(dispatcher.dispatch_once())
+    assert outbox.count('sent') == 1
+    assert outbox.count('pending') == 1
+    assert asyncio.run(dispatcher.get_metrics())['retried'] == 1
+
+    # Make the retry due now
+    outbox.collection.update_many({}, {'$set': {'next_attempt_at': '2000-01-01 00:00:00'}})
+    asyncio.run(dispatcher.dispatch_once())
+    assert outbox.count('failed') == 1
+    assert asyncio.run(dispatcher.get_metrics())['failed'] == 1
+
+    # The notification is stored only once even if the push is retried
+    notifications = mobile_tokens._get_user_notifications('user_2')
+    assert len(notifications['notifications']) == 1
+
+def test_dispatch_keeps_stored_entries_after_store_failure(outbox, mobile_tokens, mocker):
+    outbox.enqueue('user_1', 'Title', 'Message')
+    outbox.enqueue('user_2', 'Title', 'Message')
+    save_notification = mobile_tokens.async_manager._save_notification
+
+    async def failing_save(user_id, title, message):
+        if user_id == 'user_2':
+            raise Exception('Connection reset')
+        await save_notification(user_id, title, message)
+    mocker.patch.object(mobile_tokens.async_manager, '_save_notification', failing_save)
+
+    dispatcher = NotificationDispatcher(outbox.async_manager, mobile_tokens.async_manager)
+    assert asyncio.run(dispatcher.dispatch_once()) == 2
+    assert outbox.count('sent') == 1
+    assert outbox.count('pending') == 1
+
+    # The retry only stores the notification that failed
+    mocker.stopall()
+    outbox.collection.update_many({}, {'$set': {'next_attempt_at': '2000-01-01 00:00:00'}})
+    asyncio.run(dispatcher.dispatch_once())
+    assert outbox.count('sent') == 2
+    assert len(mobile_tokens._get_user_notifications('user_1')['notifications']) == 1
+    assert len(mobile_tokens._get_user_notifications('user_2')['notifications']) == 1
+
+def test_dispatch_prunes_invalid_tokens(outbox, mobile_tokens):
+    mobile_tokens.update_mobile_token('user_1', 'token_1')
+    mobile_tokens.update_mobile_token('user_2', 'stale_token')
+    outbox.enqueue('user_1', 'Title', 'Message')
+    outbox.enqueue('user_2', 'Title', 'Message')
+
+    sender = FakeSender(invalid_tokens={'stale_token'})
+    dispatcher = NotificationDispatcher(outbox.async_manager, mobile_tokens.async_manager, sender=sender)
+    asyncio.run(dispatcher.dispatch_once())
+
+    # Invalid tokens are not retried
+    assert outbox.count('sent') == 2
+    assert asyncio.run(dispatcher.get_metrics())['pruned_tokens'] == 1
+    assert mobile_tokens.get_mobile_tokens(['user_1', 'user_2']) == {'user_1': 'token_1'}
@@ -1,4 +1,12 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+from typing import Optional
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from fastapi.testclient import TestClient
 import os
 import sys
@@ -14,10 +22,19 @@ os.environ['MONGOMOCK'] = '1'
 # Set a default MONGO_TEST_DB for testing
 os.environ['MONGO_TEST_DB'] = 'test_db'
 
+STRIPE_WEBHOOK_SECRET = 'whsec_test'
+os.environ['STRIPE_WEBHOOK_SECRET'] = STRIPE_WEBHOOK_SECRET
+
 # Add the necessary paths to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
-from payments_api import app, coupons_manager, loyalty_manager
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from stripe_stub import StripeStubServer
+from stripe_gateway import StripeGateway
+from prometheus_client import REGISTRY
+from pymongo.errors import AutoReconnect
+from lib.metrics import run_in_thread
+from payments_api import app, coupons_manager, loyalty_manager, mobile_token_manager, notification_outbox, notification_dispatcher, stripe_prices, stripe_events, stripe_event_processor, idempotency_keys, rate_limits, rate_limit_store, update_document_sizes
 
 @pytest.fixture(scope='function')
 def test_app():
@@ -25,7 +42,41 @@ def test_app():
     yield client
     # Teardown: clear the database after each test
     coupons_manager.collection.drop()
+    coupons_manager.async_manager.available_coupons_flights.clear()
+    coupons_manager.daily_stats.drop()
     loyalty_manager.collection.drop()
+    loyalty_manager.daily_stats.drop()
+    mobile_token_manager.notifications.drop()
+    notification_outbox.collection.drop()
+    stripe_prices.collection.drop()
+    stripe_prices.prices_cache.clear()
+    stripe_events.collection.delete_many({})  # Keeps the unique event_id index
+    idempotency_keys.collection.delete_many({})
+    rate_limits.collection.delete_many({})
+    rate_limit_store.reset()
+
+def sign_stripe_event(event: dict, secret: str = STRIPE_WEBHOOK_SECRET) -> tuple:
+    payload = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return payload, {'Stripe-Signature': f"t={timestamp},v1={signature}", 'Content-Type': 'application/json'}
+
+def checkout_completed_event(event_id: str, user_id: str, amount_total: int, event_type: str = 'checkout.session.completed',
+                             payment_status: str = 'paid', session_id: Optional[str] = None) -> dict:
+    return {
+        'id': event_id,
+        'object': 'event',
+        'type': event_type,
+        'data': {'object': {
+            'id': session_id or f"cs_{event_id}",
+            'object': 'checkout.session',
+            'client_reference_id': user_id,
+            'amount_total': amount_total,
+            'currency': 'usd',
+            'payment_status': payment_status,
+            'metadata': {'service_id': 'service1', 'description': 'Test service'}
+        }}
+    }
 
 def test_create_coupon(test_app, mocker):
     mocker.patch('lib.utils.get_actual_time', return_value='2023-01-01 00:00:00')
@@ -193,3 +244,506 @@ def test_get_history_new_user(test_app):
     assert response.status_code == 404
     assert response.json()['detail'] == 'User does not have loyalty points yet'
 
+def test_loyalty_conditional_get(test_app, mocker):
+    actual_time = mocker.patch('loyalty_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    mocker.patch('loyalty_nosql.get_timestamp_after_days', return_value='2025-01-01 00:00:00')
+    test_app.put('/loyalty/sum_points/test_user', json={'points': 60, 'description': 'Test sum points'})
+
+    for path in ['/loyalty/points/test_user', '/loyalty/history/test_user']:
+        response = test_app.get(path)
+        etag = response.headers['ETag']
+        response = test_app.get(path, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert response.content == b''
+
+    etag = test_app.get('/loyalty/history/test_user').headers['ETag']
+    test_app.put('/loyalty/sum_points/test_user', json={'points': 10, 'description': 'Test sum points'})
+    response = test_app.get('/loyalty/history/test_user', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    # Expired points change the representation without any write
+    etag = response.headers['ETag']
+    actual_time.return_value = '2025-01-02 00:00:00'
+    response = test_app.get('/loyalty/points/test_user', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['total_points'] == 0
+
+def test_get_loyalty_stats(test_app, mocker):
+    mocker.patch('loyalty_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    test_app.put('/loyalty/sum_points/test_user', json={'points': 60, 'description': 'Test sum points'})
+    test_app.put('/loyalty/sum_points/test_user_2', json={'points': 40, 'description': 'Test sum points'})
+
+    response = test_app.get('/loyalty/stats', params={'from_day': '2023-01-01'})
+    assert response.status_code == 200
+    assert [day['day'] for day in response.json()['days']] == ['2023-01-01']
+    assert response.json()['totals']['points_issued'] == 100
+
+    response = test_app.get('/loyalty/stats', params={'from_day': '2023-01-02'})
+    assert response.json()['days'] == []
+    assert response.json()['totals']['points_issued'] == 0
+
+    response = test_app.get('/loyalty/stats', params={'from_day': '01/01/2023'})
+    assert response.status_code == 422
+
+def test_get_loyalty_stats_fractional_points(test_app, mocker):
+    mocker.patch('loyalty_nosql.get_actual_time', return_value='2023-01-01 00:00:00')
+    response = test_app.put('/loyalty/sum_points/test_user', json={'points': 10.5, 'description': 'Test sum points'})
+    assert response.status_code == 200
+    response = test_app.put('/loyalty/use_points/cash_coupon/test_user', json={'CASH_DISCOUNT': 0.55})
+    assert response.status_code == 200
+
+    response = test_app.get('/loyalty/stats')
+    assert response.status_code == 200
+    assert response.json()['totals']['points_issued'] == 10.5
+    assert response.json()['totals']['points_redeemed'] == 5.5
+
+def test_refund_coupons_conditional_get(test_app):
+    test_app.post('/coupons/new_refund', json={'user_id': 'test_user', 'amount': 100})
+    response = test_app.get('/coupons/refund', params={'user_id': 'test_user'})
+    etag = response.headers['ETag']
+    response = test_app.get('/coupons/refund', params={'user_id': 'test_user'}, headers={'If-None-Match': f'"other", W/{etag}'})
+    assert response.status_code == 304
+
+    coupon_code = test_app.get('/coupons/refund', params={'user_id': 'test_user'}).json()['refund_coupons'][0]['uuid']
+    test_app.put(f'/coupons/use_refund/{coupon_code}/test_user')
+    response = test_app.get('/coupons/refund', params={'user_id': 'test_user'}, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['refund_coupons'] == []
+
+def test_get_coupon_stats(test_app):
+    body = {
+        'coupon_code': 'TEST_COUPON',
+        'discount_percent': 10.0,
+        'expiration_date': "2050-01-31 23:59:59",
+        'category_rules': ['category1', 'category2'],
+    }
+    test_app.post('/coupons/create', json=body)
+    for user_id, category in [('test_user', 'category1'), ('test_user_2', 'category1'), ('test_user_3', 'category2')]:
+        body = {'client_location': '10.0,20.0', 'category': category, 'service_id': 'service1', 'provider_id': 'provider1'}
+        assert test_app.put(f'/coupons/activate/TEST_COUPON/{user_id}', json=body).status_code == 200
+
+    response = test_app.get('/coupons/TEST_COUPON/stats')
+    assert response.status_code == 200
+    assert response.json()['redemptions'] == 3
+    assert response.json()['categories'] == {'category1': 2, 'category2': 1}
+    assert len(response.json()['days']) == 1
+
+    response = test_app.get('/coupons/TEST_COUPON/stats', params={'to_day': '2000-01-01'})
+    assert response.json()['redemptions'] == 0
+    assert response.json()['days'] == []
+
+
+def test_activate_coupon_max_redemptions(test_app, mocker):
+    body = {
+        'coupon_code': 'TEST_COUPON',
+        'discount_percent': 10.0,
+        'expiration_date': "2050-01-31 23:59:59",
+        'category_rules': ['category1', 'category2'],
+        'max_redemptions': 1
+    }
+    response = test_app.post('/coupons/create', json=body)
+    assert response.status_code == 200
+
+    body = {
+        'client_location': '10.0,20.0',
+        'category': 'category1',
+        'service_id': 'service1',
+        'provider_id': 'provider1'
+    }
+    response = test_app.put('/coupons/activate/TEST_COUPON/test_user', json=body)
+    assert response.status_code == 200
+
+    response = test_app.put('/coupons/activate/TEST_COUPON/test_user_2', json=body)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Coupon redemption limit reached'
+
+def test_create_coupon_invalid_max_redemptions(test_app):
+    body = {
+        'coupon_code': 'TEST_COUPON',
+        'discount_percent': 10.0,
+        'expiration_date': "2050-01-31 23:59:59",
+        'category_rules': ['category1'],
+        'max_redemptions': 0
+    }
+    response = test_app.post('/coupons/create', json=body)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Max redemptions must be a positive integer'
+
+def test_search_coupons(test_app):
+    for i in range(3):
+        body = {
+            'coupon_code': f'TEST_COUPON_{i}',
+            'discount_percent': 10.0,
+            'expiration_date': "2050-01-31 23:59:59",
+            'category_rules': ['category1'],
+        }
+        test_app.post('/coupons/create', json=body)
+
+    response = test_app.get('/coupons/search', params={'category': 'category1', 'limit': 2, 'fields': 'discount_percent'})
+    assert response.status_code == 200
+    assert response.json()['coupons'] == [{'uuid': 'TEST_COUPON_0', 'discount_percent': 10.0}, {'uuid': 'TEST_COUPON_1', 'discount_percent': 10.0}]
+    assert response.json()['next_cursor'] == 'TEST_COUPON_1'
+
+    response = test_app.get('/coupons/search', params={'category': 'category1', 'limit': 2, 'after': 'TEST_COUPON_1'})
+    assert response.status_code == 200
+    assert [c['uuid'] for c in response.json()['coupons']] == ['TEST_COUPON_2']
+    assert response.json()['next_cursor'] is None
+
+def test_search_coupons_invalid_fields(test_app):
+    response = test_app.get('/coupons/search', params={'fields': 'password'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Invalid fields: {'password'}"
+
+def test_create_refund_coupon_enqueues_notification(test_app):
+    response = test_app.post('/coupons/new_refund', json={'user_id': 'test_user', 'amount': 100})
+    assert response.status_code == 200
+    assert notification_outbox.count('pending') == 1
+
+    asyncio.run(notification_dispatcher.dispatch_once())
+    assert notification_outbox.count('pending') == 0
+    notifications = mobile_token_manager._get_user_notifications('test_user')
+    assert notifications['notifications'][-1]['title'] == 'Refund coupon'
+
+def test_create_refund_coupon_enqueue_failure(test_app, mocker):
+    mocker.patch.object(notification_outbox.async_manager, 'enqueue', return_value=False)
+    error = mocker.patch('payments_api.logger.error')
+    response = test_app.post('/coupons/new_refund', json={'user_id': 'test_user', 'amount': 100})
+    assert response.status_code == 200
+    assert error.call_count == 1
+
+def test_get_notifications(test_app):
+    test_app.post('/coupons/new_refund', json={'user_id': 'test_user', 'amount': 100})
+    asyncio.run(notification_dispatcher.dispatch_once())
+
+    response = test_app.get('/notifications/test_user', params={'page_size': 10})
+    assert response.status_code == 200
+    assert response.json()['unread_count'] == 1
+    assert response.json()['notifications'][0]['title'] == 'Refund coupon'
+
+    response = test_app.put('/notifications/test_user/read')
+    assert response.status_code == 200
+    response = test_app.get('/notifications/test_user')
+    assert response.json()['unread_count'] == 0
+
+def test_create_payment_link(mocker):
+    stub = StripeStubServer().start()
+    try:
+        mocker.patch('payments_api.stripe_gateway', StripeGateway(api_key='sk_test', api_base=stub.url))
+        params = {'amount': 1000, 'currency': 'usd', 'description': 'Test service'}
+        # Single event loop for all the requests, as in production (the Stripe HTTP session is pooled)
+        with TestClient(app) as client:
+            response = client.get('/pay/service1/paymentlink', params=params, headers={'Idempotency-Key': 'key_1'})
+            assert response.status_code == 200
+            url = response.json()['url']
+
+            # A retry with the same key gets the same session
+            response = client.get('/pay/service1/paymentlink', params=params, headers={'Idempotency-Key': 'key_1'})
+            assert response.json()['url'] == url
+        sessions = [request for request in stub.requests if request['path'] == '/v1/checkout/sessions']
+        assert [request['idempotency_key'] for request in sessions] == ['key_1', 'key_1']
+        assert sessions[0]['form']['line_items[0][price]'].startswith('price_')
+    finally:
+        stub.stop()
+        stripe_prices.collection.drop()
+        stripe_prices.prices_cache.clear()
+
+def test_create_payment_link_reuses_price(mocker):
+    stub = StripeStubServer().start()
+    try:
+        mocker.patch('payments_api.stripe_gateway', StripeGateway(api_key='sk_test', api_base=stub.url))
+        params = {'amount': 1000, 'currency': 'usd', 'description': 'Test service'}
+        with TestClient(app) as client:
+            for _ in range(3):
+                response = client.get('/pay/service1/paymentlink', params=params)
+                assert response.status_code == 200
+            response = client.get('/pay/service1/paymentlink', params={**params, 'amount': 2000})
+            assert response.status_code == 200
+        prices = [request for request in stub.requests if request['path'] == '/v1/prices']
+        assert len(prices) == 2
+        assert prices[0]['form']['unit_amount'] == '1000'
+        assert prices[1]['form']['unit_amount'] == '2000'
+
+        price_ids = {request['form']['line_items[0][price]'] for request in stub.requests
+                     if request['path'] == '/v1/checkout/sessions'}
+        assert len(price_ids) == 2
+        # The prices are persisted, a new process finds them after warming its cache
+        stripe_prices.prices_cache.clear()
+        assert stripe_prices.warm_cache() == 2
+        assert stripe_prices.prices_cache.get(('service1', 1000, 'usd')) in price_ids
+    finally:
+        stub.stop()
+        stripe_prices.collection.drop()
+        stripe_prices.prices_cache.clear()
+
+def test_stripe_webhook_credits_payment_once(test_app):
+    event = checkout_completed_event('evt_1', 'test_user', 1500)
+    payload, headers = sign_stripe_event(event)
+    # Stripe redelivers events, all of them are acknowledged
+    for _ in range(3):
+        response = test_app.post('/stripe/webhook', content=payload, headers=headers)
+        assert response.status_code == 200
+    assert stripe_events.count() == 1
+
+    assert asyncio.run(stripe_event_processor.process_once()) == 1
+    # Processed events are removed by the TTL index
+    assert stripe_events.collection.find_one({'event_id': 'evt_1'})['expires_at']
+    history = loyalty_manager.get_history('test_user')
+    assert len(history) == 1
+    assert history[0]['cash'] == -15
+    assert history[0]['description'] == 'Test service'
+
+    # A redelivery after processing is not credited again
+    response = test_app.post('/stripe/webhook', content=payload, headers=headers)
+    assert response.status_code == 200
+    assert asyncio.run(stripe_event_processor.process_once()) == 0
+    assert len(loyalty_manager.get_history('test_user')) == 1
+
+def test_stripe_webhook_credits_delayed_payment(test_app):
+    # The session completes unpaid (e.g. bank debit) and is paid later
+    for event in [checkout_completed_event('evt_1', 'test_user', 1500, payment_status='unpaid', session_id='cs_1'),
+                  checkout_completed_event('evt_2', 'test_user', 1500, event_type='checkout.session.async_payment_succeeded', session_id='cs_1')]:
+        payload, headers = sign_stripe_event(event)
+        assert test_app.post('/stripe/webhook', content=payload, headers=headers).status_code == 200
+    assert stripe_events.count() == 2
+
+    assert asyncio.run(stripe_event_processor.process_once()) == 2
+    history = loyalty_manager.get_history('test_user')
+    assert [(entry['cash'], entry['event_id']) for entry in history] == [(-15, 'evt_2')]
+
+def test_stripe_webhook_invalid_signature(test_app):
+    payload, headers = sign_stripe_event(checkout_completed_event('evt_1', 'test_user', 1500), secret='whsec_other')
+    response = test_app.post('/stripe/webhook', content=payload, headers=headers)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Invalid signature'
+
+    response = test_app.post('/stripe/webhook', content=payload)
+    assert response.status_code == 400
+    assert stripe_events.count() == 0
+
+def test_stripe_webhook_ignores_other_events(test_app):
+    payload, headers = sign_stripe_event({'id': 'evt_1', 'object': 'event', 'type': 'customer.created', 'data': {'object': {}}})
+    response = test_app.post('/stripe/webhook', content=payload, headers=headers)
+    assert response.status_code == 200
+    assert stripe_events.count() == 0
+
+def test_mongo_pool_metrics(test_app):
+    response = test_app.get('/mongo/pool/metrics')
+    assert response.status_code == 200
+    assert {'checkouts', 'avg_wait_time', 'max_wait_time', 'max_pool_size'} <= set(response.json()['metrics'])
+
+def test_prometheus_metrics(test_app, mocker):
+    loyalty_manager.add_transaction('test_user', 100, 'Test points')
+    loyalty_manager.add_transaction('test_user', 50, 'Test points')
+    assert test_app.get('/loyalty/points/test_user').status_code == 200
+    # Refreshed in the background, not by the scrape
+    history_size_stats = mocker.spy(loyalty_manager.async_manager, 'get_history_size_stats')
+    asyncio.run(update_document_sizes())
+    assert history_size_stats.call_count == 1
+
+    response = test_app.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    content = response.text
+    assert 'payments_request_duration_seconds_count{method="GET",route="/loyalty/points/{user_id}",status_code="200"}' in content
+    assert 'payments_manager_operation_duration_seconds_count{manager="loyalty",method="get_total_points"}' in content
+    assert 'payments_document_entries{collection="loyalty",field="history",stat="max"} 2.0' in content
+    assert 'payments_threadpool_queue_depth{pool="anyio"}' in content
+    assert history_size_stats.call_count == 1
+
+def test_threadpool_queue_depth():
+    def queue_depth():
+        return REGISTRY.get_sample_value('payments_threadpool_queue_depth', {'pool': 'asyncio'})
+    release = threading.Event()
+
+    async def run_queued():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+        running = asyncio.create_task(run_in_thread(release.wait))
+        queued = asyncio.create_task(run_in_thread(lambda: None))
+        await asyncio.sleep(0.1)
+        depth = queue_depth()
+        release.set()
+        await asyncio.gather(running, queued)
+        return depth
+    # Only the call without a free thread is waiting
+    assert asyncio.run(run_queued()) == 1
+    assert queue_depth() == 0
+
+def test_response_models_keep_payload_shape(test_app):
+    loyalty_manager.add_transaction('test_user', 100, 'Test points')
+    loyalty_manager.register_coupon_use('test_user', 'TEST_COUPON', 'Test coupon')
+    response = test_app.get('/loyalty/history/test_user')
+    assert response.status_code == 200
+    history = response.json()['history']
+    # Entries only have the keys they were stored with, no nulls are added
+    assert {frozenset(entry) for entry in history} == {
+        frozenset({'points', 'timestamp', 'description'}), frozenset({'coupon_id', 'timestamp', 'description'})}
+
+    coupons_manager.insert('TEST_COUPON', 10, '2099-01-01 00:00:00', category_rules=['category1'])
+    response = test_app.get('/coupons/all_coupons')
+    assert response.status_code == 200
+    coupon = response.json()['coupons'][0]
+    assert coupon['discount_percent'] == 10 and type(coupon['discount_percent']) == int
+    assert coupon['service_rules'] is None
+
+def test_request_models_keep_error_messages(test_app):
+    response = test_app.put('/loyalty/sum_points/test_user', json={'points': 10, 'description': 'Test', 'password': 'x'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Extra fields: {'password'}"
+
+    response = test_app.put('/loyalty/use_points/cash_coupon/test_user', json={})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Missing fields: {'CASH_DISCOUNT'}"
+
+    response = test_app.put('/coupons/activate/TEST_COUPON/test_user', json={'client_location': '10.0,20.0', 'category': 'category1', 'service_id': 'service1'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Missing fields: provider_id"
+
+    response = test_app.get('/coupons/all', params={'user_id': 'test_user', 'client_location': '10.0'})
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Invalid location (must be in the format 'longitude,latitude')"
+
+    response = test_app.get('/coupons/all', params={'client_location': '10.0,20.0'})
+    assert response.status_code == 422
+
+def test_buy_cash_coupon(test_app):
+    loyalty_manager.add_transaction('test_user', 100, 'Test points')
+    response = test_app.put('/loyalty/use_points/cash_coupon/test_user', json={'CASH_DISCOUNT': 5})
+    assert response.status_code == 200
+    coupon = coupons_manager.get(response.json()['coupon_code'])
+    assert coupon['max_discount'] == 5 and coupon['users_rules'] == ['test_user']
+    assert loyalty_manager.get_total_points('test_user') == 50
+
+    response = test_app.put('/loyalty/use_points/discount_coupon/test_user', json={'DISCOUNT': 1})
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Not enough points'
+    assert loyalty_manager.get_total_points('test_user') == 50
+
+def test_buy_cash_coupon_gives_back_points(test_app, mocker):
+    loyalty_manager._create_user_doc('test_user')
+    loyalty_manager.collection.update_one({'uuid': 'test_user'}, {'$set': {'points': [('2090-01-01', 30), ('2099-01-01', 40)]}})
+    mocker.patch.object(coupons_manager.async_manager, 'insert', return_value=False)
+
+    response = test_app.put('/loyalty/use_points/cash_coupon/test_user', json={'CASH_DISCOUNT': 5})
+    assert response.status_code == 500
+    # The points keep their expiration dates
+    points = loyalty_manager.collection.find_one({'uuid': 'test_user'})['points']
+    assert sorted(points) == [['2090-01-01', 30], ['2099-01-01', 20], ['2099-01-01', 20]]
+    assert loyalty_manager.get_total_points('test_user') == 70
+    # Given back points are not reported as issued
+    stats = test_app.get('/loyalty/stats').json()['totals']
+    assert (stats['points_issued'], stats['points_redeemed'], stats['points_restored']) == (0, 50, 50)
+
+def test_idempotency_key_replays_response(test_app):
+    headers = {'Idempotency-Key': 'payment-1'}
+    body = {'amount': 10, 'description': 'Test payment'}
+    response = test_app.post('/pay/test_user/paymentdone', json=body, headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+
+    response = test_app.post('/pay/test_user/paymentdone', json=body, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {'status': 'ok'}
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert len(loyalty_manager.collection.find_one({'uuid': 'test_user'})['history']) == 1
+
+    response = test_app.post('/pay/test_user/paymentdone', json={'amount': 20, 'description': 'Test payment'}, headers=headers)
+    assert response.status_code == 422
+
+    # Keys are scoped to the endpoint
+    response = test_app.put('/loyalty/sum_points/test_user', json={'points': 10, 'description': 'Test'}, headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+
+def test_idempotency_key_refund_coupon(test_app):
+    headers = {'Idempotency-Key': 'refund-1'}
+    first = test_app.post('/coupons/new_refund', json={'user_id': 'test_user', 'amount': 100}, headers=headers)
+    second = test_app.post('/coupons/new_refund', json={'user_id': 'test_user', 'amount': 100}, headers=headers)
+    assert first.json()['coupon_code'] == second.json()['coupon_code']
+    assert len(coupons_manager.get_refund_coupons('test_user')) == 1
+    assert notification_outbox.count('pending') == 1
+
+def test_idempotency_key_released_on_failure(test_app, mocker):
+    headers = {'Idempotency-Key': 'points-1'}
+    mocker.patch.object(loyalty_manager.async_manager, 'add_transaction', return_value=False)
+    response = test_app.put('/loyalty/sum_points/test_user', json={'points': 10, 'description': 'Test'}, headers=headers)
+    assert response.status_code == 500
+
+    mocker.stopall()
+    response = test_app.put('/loyalty/sum_points/test_user', json={'points': 10, 'description': 'Test'}, headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+
+def test_idempotency_key_completed_after_store_error(test_app, mocker):
+    mocker.patch('idempotency_keys_nosql.COMPLETE_RETRY_DELAY', 0)
+    headers = {'Idempotency-Key': 'points-1'}
+    body = {'points': 10, 'description': 'Test'}
+    update_one = idempotency_keys.async_manager.collection.update_one
+
+    async def flaky_update_one(*args, **kwargs):
+        flaky_update_one.calls += 1
+        if flaky_update_one.calls == 1:
+            raise AutoReconnect('Connection reset')
+        return await update_one(*args, **kwargs)
+    flaky_update_one.calls = 0
+    mocker.patch.object(idempotency_keys.async_manager.collection, 'update_one', flaky_update_one)
+    assert test_app.put('/loyalty/sum_points/test_user', json=body, headers=headers).status_code == 200
+
+    # The response was stored by the retry, the points are not added again
+    mocker.stopall()
+    response = test_app.put('/loyalty/sum_points/test_user', json=body, headers=headers)
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert loyalty_manager.get_total_points('test_user') == 10
+
+def test_idempotency_key_store_keeps_failing(test_app, mocker):
+    mocker.patch('idempotency_keys_nosql.COMPLETE_RETRY_DELAY', 0)
+    mocker.patch.object(idempotency_keys.async_manager.collection, 'update_one', side_effect=AutoReconnect('Connection reset'))
+    # The points were added, the request is not reported as failed
+    response = test_app.put('/loyalty/sum_points/test_user', json={'points': 10, 'description': 'Test'}, headers={'Idempotency-Key': 'points-1'})
+    assert response.status_code == 200
+    assert idempotency_keys.async_manager.collection.update_one.call_count == 3
+
+def test_rate_limit_per_user(test_app, mocker):
+    mocker.patch('payments_api.USER_RATE_LIMIT', (0.5, 2))
+    body = {'points': 10, 'description': 'Test'}
+    assert test_app.put('/loyalty/sum_points/test_user', json=body).status_code == 200
+    assert test_app.put('/loyalty/sum_points/test_user', json=body).status_code == 200
+    response = test_app.put('/loyalty/sum_points/test_user', json=body)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    # Other users have their own bucket
+    assert test_app.put('/loyalty/sum_points/other_user', json=body).status_code == 200
+
+    content = test_app.get('/metrics').text
+    assert 'payments_rate_limited_total{route="/loyalty/sum_points/{user_id}",scope="user"}' in content
+
+def test_rate_limit_shared_backend(test_app, mocker):
+    mocker.patch('payments_api.rate_limit_store', rate_limits.async_manager)
+    mocker.patch('payments_api.ROUTE_RATE_LIMIT', (1, 1))
+    body = {'user_id': 'test_user', 'amount': 100}
+    assert test_app.post('/coupons/new_refund', json=body).status_code == 200
+    response = test_app.post('/coupons/new_refund', json=body)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert rate_limits.collection.count_documents({'key': '/coupons/new_refund'}) == 1
+
+    async def acquire_concurrently():
+        return await asyncio.gather(*[rate_limits.async_manager.acquire('test_bucket', 0.001, 3) for _ in range(5)])
+    # Concurrent requests on the same bucket are not rejected while it has tokens
+    assert [retry_after == 0 for retry_after in asyncio.run(acquire_concurrently())].count(True) == 3
+
+def test_rate_limit_route_rejection_keeps_user_token(test_app, mocker):
+    mocker.patch('payments_api.USER_RATE_LIMIT', (0.001, 2))
+    mocker.patch('payments_api.ROUTE_RATE_LIMIT', (0.001, 1))
+    body = {'points': 10, 'description': 'Test'}
+    assert test_app.put('/loyalty/sum_points/test_user', json=body).status_code == 200
+    response = test_app.put('/loyalty/sum_points/test_user', json=body)
+    assert response.status_code == 429
+    content = test_app.get('/metrics').text
+    assert 'payments_rate_limited_total{route="/loyalty/sum_points/{user_id}",scope="route"}' in content
+
+    # The rejected request did not use the second token of the user
+    mocker.patch('payments_api.ROUTE_RATE_LIMIT', None)
+    assert test_app.put('/loyalty/sum_points/test_user', json=body).status_code == 200
+    assert test_app.put('/loyalty/sum_points/test_user', json=body).status_code == 429
@@ -0,0 +1,51 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+from lib.utils import get_sentry_options, make_traces_sampler, parse_route_rates, DEFAULT_TRACES_ROUTE_RATES
+
+# Run with the following command:
+# pytest PaymentsService/api_container/tests/test_sentry.py
+
+def sampling_context(path, parent_sampled=None):
+    return {'asgi_scope': {'type': 'http', 'path': path}, 'parent_sampled': parent_sampled}
+
+def test_parse_route_rates():
+    assert parse_route_rates("/loyalty/:0.5, /loyalty/points/:0.01,") == [('/loyalty/points/', 0.01), ('/loyalty/', 0.5)]
+    assert parse_route_rates(" ") == []
+
+def test_traces_sampler_route_rates():
+    sampler = make_traces_sampler(0.1, parse_route_rates(DEFAULT_TRACES_ROUTE_RATES))
+    assert sampler(sampling_context('/pay/service_1/paymentlink')) == 1.0
+    assert sampler(sampling_context('/stripe/webhook')) == 1.0
+    assert sampler(sampling_context('/loyalty/points/user_1')) == 0.01
+    assert sampler(sampling_context('/metrics')) == 0
+    assert sampler(sampling_context('/coupons/all')) == 0.1
+    assert sampler({}) == 0.1
+
+def test_traces_sampler_keeps_parent_decision():
+    sampler = make_traces_sampler(0.1, parse_route_rates(DEFAULT_TRACES_ROUTE_RATES))
+    assert sampler(sampling_context('/loyalty/points/user_1', parent_sampled=True)) == 1.0
+    assert sampler(sampling_context('/pay/service_1/paymentlink', parent_sampled=False)) == 0.0
+
+def test_sentry_options_from_env(monkeypatch):
+    monkeypatch.delenv('SENTRY_PROFILING', raising=False)
+    monkeypatch.setenv('SENTRY_TRACES_SAMPLE_RATE', '0.2')
+    monkeypatch.setenv('SENTRY_TRACES_ROUTE_RATES', '/coupons/:0.05')
+    options = get_sentry_options()
+    assert 'profile_session_sample_rate' not in options
+    assert options['sample_rate'] == 1.0  # All the errors are reported
+    assert options['traces_sampler'](sampling_context('/coupons/all')) == 0.05
+    assert options['traces_sampler'](sampling_context('/loyalty/history/user_1')) == 0.2
+
+    monkeypatch.setenv('SENTRY_PROFILING', 'trace')
+    monkeypatch.setenv('SENTRY_PROFILE_SESSION_SAMPLE_RATE', '0.5')
+    options = get_sentry_options()
+    assert options['profile_lifecycle'] == 'trace'
+    assert options['profile_session_sample_rate'] == 0.5
+
+    monkeypatch.setenv('SENTRY_PROFILING', 'always')
+    with pytest.raises(ValueError):
+        get_sentry_options()
@@ -0,0 +1,41 @@
+import json
+import subprocess
+import sys
+import os
+
+# Run with the following command:
+# pytest PaymentsService/api_container/tests/test_startup.py
+
+API_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+ROOT_DIR = os.path.abspath(os.path.join(API_DIR, '..'))
+
+# Seconds, for a cold import of the API in a new process. Override with STARTUP_BUDGET on slow machines.
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET') or 3)
+
+LAZY_MODULES = ['stripe', 'firebase_admin', 'geopy', 'sentry_sdk']
+
+STARTUP_SCRIPT = f"""
+import json, sys
+import payments_api
+print(json.dumps({{
+    'total': payments_api.startup_profiler.total(),
+    'phases': payments_api.startup_profiler.phases,
+    'loaded': [module for module in {LAZY_MODULES!r} if module in sys.modules]
+}}))
+"""
+
+def run_startup() -> dict:
+    env = {**os.environ, 'TESTING': '1', 'MONGOMOCK': '1', 'MONGO_TEST_DB': 'test_db', 'DEBUG_MODE': 'False',
+           'PYTHONPATH': os.pathsep.join([API_DIR, ROOT_DIR])}
+    env.pop('SENTRY_DSN', None)
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=API_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_startup_budget():
+    startup = run_startup()
+    assert {'imports', 'sentry_init', 'managers'} <= set(startup['phases'])
+    assert startup['total'] < STARTUP_BUDGET, f"Startup took {startup['total']:.2f}s: {startup['phases']}"
+
+def test_heavy_dependencies_are_lazy():
+    assert run_startup()['loaded'] == []
@@ -0,0 +1,171 @@
+import functools
+import inspect
+from typing import Optional
+from pymongo import AsyncMongoClient
+from lib.utils import get_mongo_client
+
+# Managers are written once, as async classes that work with pymongo's AsyncMongoClient.
+# The classes below let the same async code run on top of a synchronous client
+# (pymongo MongoClient or mongomock): every operation completes without suspending,
+# so the coroutines can be driven synchronously by SyncManager.
+
+
+class AwaitableCursor:
+    """
+    Cursor over a synchronous cursor with the AsyncCursor interface.
+    """
+
+    def __init__(self, cursor):
+        self.delegate = cursor
+
+    def sort(self, *args, **kwargs):
+        self.delegate = self.delegate.sort(*args, **kwargs)
+        return self
+
+    def skip(self, *args, **kwargs):
+        self.delegate = self.delegate.skip(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self.delegate = self.delegate.limit(*args, **kwargs)
+        return self
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        if length is None:
+            return list(self.delegate)
+        return [doc for _, doc in zip(range(length), self.delegate)]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.delegate)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AwaitableCollection:
+    """
+    Collection over a synchronous collection with the AsyncCollection interface.
+    """
+
+    def __init__(self, collection):
+        self.delegate = collection
+
+    @property
+    def name(self) -> str:
+        return self.delegate.name
+
+    def find(self, *args, **kwargs) -> AwaitableCursor:
+        return AwaitableCursor(self.delegate.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs) -> AwaitableCursor:
+        return AwaitableCursor(self.delegate.aggregate(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.delegate, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return attr(*args, **kwargs)
+        return method
+
+
+class AwaitableDatabase:
+    """
+    Database over a synchronous database with the AsyncDatabase interface.
+    """
+
+    def __init__(self, database):
+        self.delegate = database
+
+    def __getitem__(self, name: str) -> AwaitableCollection:
+        return AwaitableCollection(self.delegate[name])
+
+    async def command(self, *args, **kwargs):
+        return self.delegate.command(*args, **kwargs)
+
+
+class AwaitableClient:
+    """
+    Client over a synchronous client (pymongo MongoClient or mongomock) with the AsyncMongoClient interface.
+    """
+
+    def __init__(self, client):
+        self.delegate = client
+
+    def __getitem__(self, name: str) -> AwaitableDatabase:
+        return AwaitableDatabase(self.delegate[name])
+
+    @property
+    def admin(self) -> AwaitableDatabase:
+        return AwaitableDatabase(self.delegate.admin)
+
+
+def as_async_client(client):
+    if isinstance(client, (AsyncMongoClient, AwaitableClient)):
+        return client
+    return AwaitableClient(client)
+
+
+def run_sync(coroutine):
+    """
+    Runs a manager coroutine whose I/O is done by a synchronous client.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as result:
+        return result.value
+    coroutine.close()
+    raise RuntimeError("The coroutine suspended, it can not be run synchronously")
+
+
+class SyncManager:
+    """
+    Synchronous interface of an async manager ('async_class'), backed by a synchronous client.
+    Coroutine methods are run to completion and return their result, collections are
+    exposed as the underlying synchronous collections.
+    """
+    async_class = None
+
+    def __init__(self, test_client=None, test_db=None, client=None):
+        sync_client = client or test_client or get_mongo_client()
+        manager = self.async_class(test_client=test_client, test_db=test_db, client=AwaitableClient(sync_client))
+        object.__setattr__(self, 'async_manager', manager)
+        run_sync(manager.initialize())
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_manager, name)
+        if inspect.iscoroutinefunction(attr):
+            @functools.wraps(attr)
+            def method(*args, **kwargs):
+                return run_sync(attr(*args, **kwargs))
+            return method
+        if isinstance(attr, (AwaitableClient, AwaitableDatabase, AwaitableCollection)):
+            return attr.delegate
+        return attr
+
+    def __setattr__(self, name, value):
+        setattr(self.async_manager, name, value)
+
+
+async def supports_transactions(client) -> bool:
+    """
+    Multi-document transactions need a replica set (a single node one is enough) or a sharded cluster.
+    """
+    if not isinstance(client, AsyncMongoClient):
+        return False  # mongomock or a synchronous client
+    hello = await client.admin.command('hello')
+    return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+
+async def run_in_transaction(client: AsyncMongoClient, callback):
+    """
+    Runs callback(session) in a transaction and returns its result. The whole callback is retried on
+    TransientTransactionError (e.g. a write conflict) and the commit on UnknownTransactionCommitResult.
+    """
+    async with client.start_session() as session:
+        return await session.with_transaction(callback)
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import inspect
+import os
+import threading
+import time
+from typing import Optional
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+# Prometheus metrics of the API process, exposed by the /metrics endpoint.
+# With several workers PROMETHEUS_MULTIPROC_DIR must be set before this module is imported
+# (gunicorn.conf.py does it): every worker writes its samples there and /metrics aggregates all of them.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED_ROUTE = 'unmatched'  # Keeps unknown paths out of the route label
+
+REQUEST_LATENCY = Histogram(
+    'payments_request_duration_seconds', 'Request latency by route and status code',
+    ['method', 'route', 'status_code'], buckets=LATENCY_BUCKETS)
+MANAGER_LATENCY = Histogram(
+    'payments_manager_operation_duration_seconds', 'Latency of the data managers methods',
+    ['manager', 'method'], buckets=LATENCY_BUCKETS)
+MANAGER_ERRORS = Counter(
+    'payments_manager_operation_errors_total', 'Exceptions raised by the data managers methods',
+    ['manager', 'method'])
+DOCUMENT_ENTRIES = Gauge(
+    'payments_document_entries', 'Number of entries of the unbounded array/map fields',
+    ['collection', 'field', 'stat'], multiprocess_mode='mostrecent')
+THREADPOOL_IN_USE = Gauge(
+    'payments_threadpool_in_use', 'Busy threads of the threadpools', ['pool'], multiprocess_mode='liveall')
+RATE_LIMITED = Counter(
+    'payments_rate_limited_total', 'Requests rejected by the rate limiter', ['route', 'scope'])
+COALESCED_CALLS = Counter(
+    'payments_coalesced_calls_total', 'Coalesced calls by result: run (queried) or shared (reused)', ['name', 'result'])
+THREADPOOL_QUEUE_DEPTH = Gauge(
+    'payments_threadpool_queue_depth', 'Tasks waiting for a thread', ['pool'], multiprocess_mode='liveall')
+
+
+def instrument_manager(name: str):
+    """
+    Class decorator that records latency and errors of every coroutine method of a manager.
+    """
+    def decorator(cls):
+        for attr_name, attr in list(vars(cls).items()):
+            if inspect.iscoroutinefunction(attr):
+                setattr(cls, attr_name, _instrument_method(name, attr_name, attr))
+        return cls
+    return decorator
+
+
+def _instrument_method(manager: str, method_name: str, method):
+    latency = MANAGER_LATENCY.labels(manager, method_name)
+    errors = MANAGER_ERRORS.labels(manager, method_name)
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+    return wrapper
+
+
+def observe_request(method: str, route: Optional[str], status_code: int, duration: float) -> None:
+    REQUEST_LATENCY.labels(method, route or UNMATCHED_ROUTE, str(status_code)).observe(duration)
+
+
+def observe_rate_limited(route: str, scope: str) -> None:
+    RATE_LIMITED.labels(route, scope).inc()
+
+
+def observe_coalesced_call(name: str, result: str) -> None:
+    COALESCED_CALLS.labels(name, result).inc()
+
+
+def set_document_entries(collection: str, field: str, stats: dict) -> None:
+    for stat, value in stats.items():
+        DOCUMENT_ENTRIES.labels(collection, field, stat).set(value or 0)
+
+
+def update_threadpool_metrics() -> None:
+    """
+    Must run in the event loop. 'anyio' is the pool of Starlette's sync endpoints and
+    dependencies. The queue depth of 'asyncio', the default executor, is kept by run_in_thread.
+    """
+    import anyio.to_thread
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    statistics = limiter.statistics()
+    THREADPOOL_IN_USE.labels('anyio').set(statistics.borrowed_tokens)
+    THREADPOOL_QUEUE_DEPTH.labels('anyio').set(statistics.tasks_waiting)
+
+
+async def run_in_thread(func, *args):
+    """
+    asyncio.to_thread that keeps the queue depth of the default executor ('asyncio' pool):
+    the call is counted from its submission until a thread starts it (or it is cancelled before).
+    """
+    queue_depth = THREADPOOL_QUEUE_DEPTH.labels('asyncio')
+    queue_depth.inc()
+    lock = threading.Lock()
+    waiting = [True]
+
+    def leave_queue():
+        with lock:
+            if waiting[0]:
+                waiting[0] = False
+                queue_depth.dec()
+
+    def run():
+        leave_queue()
+        return func(*args)
+    try:
+        return await asyncio.to_thread(run)
+    finally:
+        leave_queue()
+
+
+def render_metrics():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    # Removes the live gauges of a worker that exited
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
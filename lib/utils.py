@@ -1,14 +1,20 @@
+import asyncio
 import datetime
+import hashlib
+import math
 import os
+import threading
 import time
-from typing import Optional, Union
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Tuple, Union
 from fastapi import HTTPException
+from pymongo import AsyncMongoClient, monitoring
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 import logging as logger
 import re
-import geopy.distance
-import sentry_sdk
+from lib.metrics import observe_coalesced_call
 
 DAY = 24 * 60 * 60
 HOUR = 60 * 60
@@ -23,18 +29,318 @@ def time_to_string(time_in_seconds: float) -> str:
     millis = int((time_in_seconds - int(time_in_seconds)) * MILLISECOND)
     return f"{minutes}m {seconds}s {millis}ms"
 
+class StartupProfiler:
+    """
+    Splits the startup time in phases. 'mark' closes the phase that started at the
+    previous mark, 'phase' times a block.
+    """
+
+    def __init__(self, start: Optional[float] = None):
+        self.start = start or time.time()
+        self.phases = {}
+        self._last = self.start
+
+    def mark(self, name: str) -> None:
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._last
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str):
+        self._last = time.time()
+        try:
+            yield
+        finally:
+            self.mark(name)
+
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def summary(self) -> str:
+        return ", ".join(f"{name}: {time_to_string(duration)}" for name, duration in self.phases.items())
+
+class LRUCache:
+    """
+    Thread safe in-process LRU cache with an optional time to live (seconds) per entry.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, stored_at = self._data[key]
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __contains__(self, key) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self) -> list:
+        with self._lock:
+            return [(key, value) for key, (value, _) in self._data.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+def parse_rate_limit(value: Optional[str]) -> Optional[Tuple[float, int]]:
+    # "rate,burst" (requests per second, max requests at once), empty or a zero rate disables the limit
+    if not value or float(value.split(',')[0]) <= 0:
+        return None
+    rate, burst = value.split(',')
+    return float(rate), int(burst)
+
+def gcra(tat: Optional[float], now: float, rate: float, burst: int) -> Tuple[float, float]:
+    """
+    Token bucket as a generic cell rate algorithm: the state of a bucket is only its theoretical
+    arrival time (tat). Returns the new tat and 0 if the request is allowed,
+    or the unchanged tat and the seconds to wait if it is not.
+    """
+    interval = 1 / rate
+    new_tat = max(tat or now, now) + interval
+    retry_after = new_tat - now - burst * interval
+    if retry_after > 0:
+        return tat, retry_after
+    return new_tat, 0.0
+
+class InProcessRateLimits:
+    """
+    Thread safe token buckets of this process, the least recently used ones are dropped after max_keys.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._tats = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        """
+        Returns 0 if the request is allowed, otherwise the seconds to wait.
+        """
+        with self._lock:
+            tat, retry_after = gcra(self._tats.get(key), time.time(), rate, burst)
+            self._tats[key] = tat
+            self._tats.move_to_end(key)
+            while len(self._tats) > self.max_keys:
+                self._tats.popitem(last=False)
+            return retry_after
+
+    async def release(self, key: str, rate: float) -> None:
+        """
+        Gives back a token taken by acquire (the request was rejected by another bucket).
+        """
+        with self._lock:
+            if key in self._tats:
+                self._tats[key] -= 1 / rate
+
+    def reset(self) -> None:
+        with self._lock:
+            self._tats.clear()
+
+class SingleFlight:
+    """
+    Coalesces the calls with the same key: the first one runs and the calls made while it runs,
+    or up to 'window' seconds after it started, get its result. Failed calls are not reused.
+    Without a running event loop (synchronous managers) every call runs.
+    """
+
+    def __init__(self, name: str, window: float, max_keys: int = 1_000):
+        self.name = name
+        self.window = window
+        self.max_keys = max_keys
+        self._calls = OrderedDict()  # key -> (task, started_at)
+
+    async def run(self, key, factory):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return await factory()
+
+        now = time.monotonic()
+        call = self._calls.get(key)
+        if call is None or now - call[1] > self.window or self._failed(call[0]):
+            call = (asyncio.ensure_future(factory()), now)
+            self._calls[key] = call
+            self._calls.move_to_end(key)
+            while len(self._calls) > self.max_keys:
+                self._calls.popitem(last=False)
+            observe_coalesced_call(self.name, 'run')
+        else:
+            observe_coalesced_call(self.name, 'shared')
+        # Shielded: a cancelled request does not cancel the call the others are waiting for
+        return await asyncio.shield(call[0])
+
+    @staticmethod
+    def _failed(task) -> bool:
+        return task.done() and (task.cancelled() or task.exception() is not None)
+
+    def clear(self) -> None:
+        self._calls.clear()
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that keeps checkout counters and wait times of the shared clients.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.checked_out = 0  # Connections in use
+            self.open_connections = 0
+            self.total_wait_time = 0.0
+            self.max_wait_time = 0.0
+            self.pools_cleared = 0
+
+    def _waited(self, duration: Optional[float]) -> None:
+        duration = duration or 0.0
+        self.total_wait_time += duration
+        self.max_wait_time = max(self.max_wait_time, duration)
+
+    def connection_checked_out(self, event) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self._waited(event.duration)
+
+    def connection_check_out_failed(self, event) -> None:
+        with self._lock:
+            self.checkout_failures += 1
+            self._waited(event.duration)
+
+    def connection_checked_in(self, event) -> None:
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event) -> None:
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event) -> None:
+        with self._lock:
+            self.open_connections -= 1
+
+    def pool_cleared(self, event) -> None:
+        with self._lock:
+            self.pools_cleared += 1
+
+    def connection_check_out_started(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            attempts = self.checkouts + self.checkout_failures
+            return {
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'checked_out': self.checked_out,
+                'open_connections': self.open_connections,
+                'pools_cleared': self.pools_cleared,
+                'avg_wait_time': self.total_wait_time / attempts if attempts else 0.0,
+                'max_wait_time': self.max_wait_time
+            }
+
+mongo_pool_metrics = MongoPoolMetrics()
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+
+def get_mongo_uri() -> str:
+    return os.getenv('MONGO_URI') or f"mongodb+srv://{os.getenv('MONGO_USER')}:{os.getenv('MONGO_PASSWORD')}@{os.getenv('MONGO_HOST')}/?retryWrites=true&w=majority&appName={os.getenv('MONGO_APP_NAME')}"
+
+def mask_mongo_uri(uri: str) -> str:
+    return re.sub(r'://([^:/@]+):[^@]*@', r'://\1:****@', uri)
+
+def get_mongo_client_options() -> dict:
+    """
+    Options of the shared clients, from the MONGO_* environment variables.
+    """
+    options = {
+        'maxPoolSize': int(os.getenv('MONGO_MAX_POOL_SIZE') or 100),
+        'minPoolSize': int(os.getenv('MONGO_MIN_POOL_SIZE') or 0),
+        'maxIdleTimeMS': int(os.getenv('MONGO_MAX_IDLE_TIME_MS') or 0) or None,
+        'waitQueueTimeoutMS': int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS') or 0) or None,
+        'connectTimeoutMS': int(os.getenv('MONGO_CONNECT_TIMEOUT_MS') or 10_000),
+        'serverSelectionTimeoutMS': int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS') or 10_000),
+        'socketTimeoutMS': int(os.getenv('MONGO_SOCKET_TIMEOUT_MS') or 0) or None,
+        'readPreference': os.getenv('MONGO_READ_PREFERENCE') or 'primary',
+        'event_listeners': [mongo_pool_metrics]
+    }
+    if os.getenv('MONGO_COMPRESSORS'):
+        # zstd and snappy need the pymongo[zstd] and pymongo[snappy] extras, zlib is always available
+        options['compressors'] = os.getenv('MONGO_COMPRESSORS')
+    if os.getenv('MONGO_READ_CONCERN'):
+        options['readConcernLevel'] = os.getenv('MONGO_READ_CONCERN')
+    if os.getenv('MONGO_WRITE_CONCERN'):
+        write_concern = os.getenv('MONGO_WRITE_CONCERN')
+        options['w'] = int(write_concern) if write_concern.isdigit() else write_concern
+    return {key: value for key, value in options.items() if value is not None}
+
+def _get_shared_client(client_class):
+    # One client (one pool and one set of monitor threads) per process, shared by every manager
+    with _mongo_clients_lock:
+        if client_class not in _mongo_clients:
+            uri = get_mongo_uri()
+            logger.info(f"Connecting to MongoDB: {mask_mongo_uri(uri)}")
+            logger.getLogger('pymongo').setLevel(logger.WARNING)
+            _mongo_clients[client_class] = client_class(uri, server_api=ServerApi('1'), **get_mongo_client_options())
+        return _mongo_clients[client_class]
+
 def get_mongo_client() -> MongoClient:
-    uri = f"mongodb+srv://{os.getenv('MONGO_USER')}:{os.getenv('MONGO_PASSWORD')}@{os.getenv('MONGO_HOST')}/?retryWrites=true&w=majority&appName={os.getenv('MONGO_APP_NAME')}"
-    print(f"Connecting to MongoDB: {uri}")
-    logger.getLogger('pymongo').setLevel(logger.WARNING)
-    return MongoClient(uri, server_api=ServerApi('1'))
+    return _get_shared_client(MongoClient)
+
+def get_async_mongo_client() -> AsyncMongoClient:
+    return _get_shared_client(AsyncMongoClient)
+
+def get_mongo_pool_metrics() -> dict:
+    return {**mongo_pool_metrics.snapshot(), 'max_pool_size': get_mongo_client_options()['maxPoolSize']}
 
 def get_actual_time() -> str:
     return datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
 
+FLOAT_PATTERN = re.compile(r'^-?\d+(\.\d+)?$')
+
 def is_float(value):
-    float_pattern = re.compile(r'^-?\d+(\.\d+)?$')
-    return bool(float_pattern.match(value))
+    return bool(FLOAT_PATTERN.match(value))
 
 def validate_fields(data: dict, required_fields: set, valid_fields: set) -> None:
     extra_fields = set(data.keys()) - valid_fields
@@ -61,16 +367,46 @@ def validate_location(client_location, required_fields):
     client_location = {key: float(value) for key, value in client_location.items()}
     return client_location
 
+EARTH_RADIUS = 6378.1  # Kilometers, the radius used by MongoDB spherical queries
+
+def spherical_distance(longitude1: float, latitude1: float, longitude2: float, latitude2: float) -> float:
+    # Great circle distance in kilometers (haversine), as $geoNear with spherical=True
+    longitude1, latitude1, longitude2, latitude2 = map(math.radians, (longitude1, latitude1, longitude2, latitude2))
+    a = math.sin((latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
 def calculate_distance(location1: dict, location2: dict) -> float:
     coords1 = (location1['latitude'], location1['longitude'])
     coords2 = (location2['latitude'], location2['longitude'])
+    import geopy.distance  # Only needed by coupons with a location rule
     return geopy.distance.distance(coords1, coords2).km
 
 def get_timestamp_after_days(days: int) -> str:
-    return datetime.datetime.fromtimestamp(time.time() + days * DAY).strftime('%Y-%m-%d %H:%M:%S')
+    return get_timestamp_after_seconds(days * DAY)
+
+def get_timestamp_after_seconds(seconds: float) -> str:
+    return datetime.datetime.fromtimestamp(time.time() + seconds).strftime('%Y-%m-%d %H:%M:%S')
 
 
-def verify_coupon_rules(coupon, user_id, category, service_id, provider_id, client_location):
+def make_etag(*parts) -> str:
+    """
+    Strong ETag (quoted) of a representation identified by the given parts (ids and version counters).
+    """
+    return '"' + hashlib.sha256(repr(parts).encode()).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match uses the weak comparison: W/ prefixes are ignored and '*' matches any representation.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+
+def verify_coupon_rules(coupon, user_id, category, service_id, provider_id, client_location: dict):
+    # client_location is already parsed (validate_location or the request model)
     validate = lambda item, rule: len(coupon.get(rule) or []) == 0 or item in coupon[rule]
     
     if user_id in coupon.get('used_by', {}):
@@ -78,6 +414,9 @@ def verify_coupon_rules(coupon, user_id, category, service_id, provider_id, clie
     
     if get_actual_time() > coupon['expiration_date']:
         return False, "Coupon expired"
+
+    if coupon.get('max_redemptions') is not None and coupon.get('redemption_count', 0) >= coupon['max_redemptions']:
+        return False, "Coupon redemption limit reached"
     
     if not validate(category, 'category_rules'):
         return False, "Category rule not satisfied"
@@ -89,8 +428,7 @@ def verify_coupon_rules(coupon, user_id, category, service_id, provider_id, clie
         return False, "Provider rule not satisfied"
     
     if 'location_rule' in coupon and coupon['location_rule']:
-        location = validate_location(client_location, REQUIRED_LOCATION_FIELDS)
-        distance = calculate_distance(location, coupon['location_rule'])
+        distance = calculate_distance(client_location, coupon['location_rule'])
         if distance > coupon['max_distance']:
             return False, "Location rule not satisfied"
         
@@ -99,20 +437,62 @@ def verify_coupon_rules(coupon, user_id, category, service_id, provider_id, clie
     
     return True, ""
 
-def sentry_init():
-    sentry_sdk.init(
-        dsn=os.getenv('SENTRY_DSN'),
+# Routes sampled with their own rate, by path prefix. Overridden with SENTRY_TRACES_ROUTE_RATES
+# ("prefix:rate,prefix:rate"). Error events are not affected, they use SENTRY_ERRORS_SAMPLE_RATE.
+DEFAULT_TRACES_ROUTE_RATES = "/pay/:1.0,/stripe/webhook:1.0,/loyalty/points/:0.01,/metrics:0,/mongo/pool/metrics:0"
+DEFAULT_TRACES_SAMPLE_RATE = 0.1
+SENTRY_PROFILING_MODES = {'off', 'trace', 'continuous'}
+
+def parse_route_rates(route_rates: str) -> list:
+    rates = []
+    for item in filter(None, (item.strip() for item in route_rates.split(','))):
+        prefix, rate = item.rsplit(':', 1)
+        rates.append((prefix, float(rate)))
+    # Longest prefix first, so specific routes win over generic ones
+    return sorted(rates, key=lambda item: len(item[0]), reverse=True)
+
+def make_traces_sampler(default_rate: float, route_rates: list):
+    def traces_sampler(sampling_context: dict) -> float:
+        # Keep the decision of the caller, so distributed traces are complete
+        if sampling_context.get('parent_sampled') is not None:
+            return float(sampling_context['parent_sampled'])
+        path = (sampling_context.get('asgi_scope') or {}).get('path') or ''
+        for prefix, rate in route_rates:
+            if path.startswith(prefix):
+                return rate
+        return default_rate
+    return traces_sampler
+
+def get_sentry_options() -> dict:
+    """
+    Sentry options from the SENTRY_* environment variables.
+    SENTRY_PROFILING: 'off' (default), 'trace' (profiles while a sampled transaction runs)
+    or 'continuous' (the profiler runs all the time, the previous behaviour).
+    """
+    profiling = (os.getenv('SENTRY_PROFILING') or 'off').lower()
+    if profiling not in SENTRY_PROFILING_MODES:
+        raise ValueError(f"Invalid SENTRY_PROFILING '{profiling}', must be one of {SENTRY_PROFILING_MODES}")
+    options = {
+        'dsn': os.getenv('SENTRY_DSN'),
         # Add data like request headers and IP for users,
         # see https://docs.sentry.io/platforms/python/data-management/data-collected/ for more info
-        send_default_pii=True,
-        # Set traces_sample_rate to 1.0 to capture 100%
-        # of transactions for tracing.
-        traces_sample_rate=1.0,
-        _experiments={
-            # Set continuous_profiling_auto_start to True
-            # to automatically start the profiler on when
-            # possible.
-            "continuous_profiling_auto_start": True,
-        },
-    )
-    
\ No newline at end of file
+        'send_default_pii': True,
+        'sample_rate': float(os.getenv('SENTRY_ERRORS_SAMPLE_RATE') or 1.0),
+        'traces_sampler': make_traces_sampler(
+            float(os.getenv('SENTRY_TRACES_SAMPLE_RATE') or DEFAULT_TRACES_SAMPLE_RATE),
+            parse_route_rates(os.getenv('SENTRY_TRACES_ROUTE_RATES') or DEFAULT_TRACES_ROUTE_RATES)),
+    }
+    if profiling != 'off':
+        options['profile_session_sample_rate'] = float(os.getenv('SENTRY_PROFILE_SESSION_SAMPLE_RATE') or 1.0)
+        options['profile_lifecycle'] = 'trace' if profiling == 'trace' else 'manual'
+    return options
+
+def sentry_init(**overrides):
+    options = {**get_sentry_options(), **overrides}
+    if not options.get('dsn'):
+        # Without a DSN Sentry sends nothing, skip loading the SDK
+        return
+    import sentry_sdk
+    sentry_sdk.init(**options)
+    if options.get('profile_lifecycle') == 'manual':
+        sentry_sdk.profiler.start_profiler()